@@ -1,14 +1,58 @@
 import asyncio
+from typing import List
+
 from fastapi import APIRouter
 from lnbits.db import Database
 from lnbits.helpers import template_renderer
+from lnbits.tasks import catch_everything_and_restart
+from loguru import logger
+
+from .metrics import TimedRoute
 
 db = Database("ext_subscriptions")
 
-subscriptions_ext: APIRouter = APIRouter(prefix="/subscriptions", tags=["subscriptions"])
+subscriptions_ext: APIRouter = APIRouter(
+    prefix="/subscriptions", tags=["subscriptions"], route_class=TimedRoute
+)
+
+scheduled_tasks: List[asyncio.Task] = []
+
+
+def subscriptions_renderer():
+    return template_renderer(["subscriptions/templates"])
+
 
 from .views import *  # noqa
 from .views_api import *  # noqa
+from .tasks import (
+    run_archive_worker,
+    run_dunning_worker,
+    run_expiry_worker,
+    run_renewal_worker,
+    run_stats_reconcile_worker,
+    wait_for_paid_invoices,
+)
+from .webhooks import run_webhook_worker
 
-def subscriptions_renderer():
-    return template_renderer(["subscriptions/templates"]) 
\ No newline at end of file
+
+def subscriptions_start():
+    loop = asyncio.get_event_loop()
+    for job in (
+        wait_for_paid_invoices,
+        run_renewal_worker,
+        run_dunning_worker,
+        run_expiry_worker,
+        run_archive_worker,
+        run_stats_reconcile_worker,
+        run_webhook_worker,
+    ):
+        task = loop.create_task(catch_everything_and_restart(job))
+        scheduled_tasks.append(task)
+
+
+def subscriptions_stop():
+    for task in scheduled_tasks:
+        try:
+            task.cancel()
+        except Exception as ex:
+            logger.warning(ex)
@@ -0,0 +1,66 @@
+"""
+Benchmark for batch billing-period computation.
+
+Run from the LNbits root with:
+
+    python -m lnbits.extensions.subscriptions.benchmarks.billing
+
+Computes the next period end for 100k subscriptions with mixed intervals and
+anchor days, through the vectorised batch API and the scalar fallback, and
+checks that both agree. With numpy installed the batch call should take well
+under a second.
+"""
+
+import random
+import time
+from datetime import datetime, timedelta
+
+from .. import billing
+
+SUBSCRIPTIONS = 100_000
+INTERVALS = ["daily", "weekly", "monthly", "yearly"]
+
+
+def dataset(size: int):
+    rng = random.Random(42)
+    base = datetime(2024, 1, 1)
+    starts = [
+        base + timedelta(seconds=rng.randrange(3 * 365 * 86400)) for _ in range(size)
+    ]
+    intervals = [rng.choice(INTERVALS) for _ in range(size)]
+    anchors = [rng.choice([None, None, 29, 30, 31]) for _ in range(size)]
+    return starts, intervals, anchors
+
+
+def timed(fn, *args):
+    start = time.perf_counter()
+    result = fn(*args)
+    return result, time.perf_counter() - start
+
+
+def main():
+    starts, intervals, anchors = dataset(SUBSCRIPTIONS)
+
+    numpy = billing.np
+    billing.np = None
+    scalar, scalar_seconds = timed(billing.period_ends, starts, intervals, anchors)
+    billing.np = numpy
+    print(f"{'path':>10} {'rows':>10} {'seconds':>10} {'rows/s':>12}")
+    print(
+        f"{'scalar':>10} {SUBSCRIPTIONS:>10} {scalar_seconds:>10.3f} "
+        f"{SUBSCRIPTIONS / scalar_seconds:>12.0f}"
+    )
+
+    if numpy is None:
+        print("numpy is not installed; only the scalar path was measured")
+        return
+    vector, vector_seconds = timed(billing.period_ends, starts, intervals, anchors)
+    print(
+        f"{'numpy':>10} {SUBSCRIPTIONS:>10} {vector_seconds:>10.3f} "
+        f"{SUBSCRIPTIONS / vector_seconds:>12.0f}"
+    )
+    assert vector == scalar, "vectorised and scalar period ends differ"
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+"""
+Concurrency stress test for plan capacity enforcement.
+
+Fires thousands of simultaneous signups at a plan with a small cap and checks
+that no more than `max_subscriptions` were created. Run from the LNbits root,
+against a database the extension has already been migrated on:
+
+    python -m lnbits.extensions.subscriptions.benchmarks.capacity
+"""
+
+import asyncio
+import time
+
+from lnbits.helpers import urlsafe_short_hash
+
+from .. import db
+from ..crud import (
+    create_subscription,
+    create_subscription_plan,
+    delete_subscription,
+    delete_subscription_plan,
+    get_subscription_plan,
+    get_subscriptions_by_plan,
+)
+from ..models import CreateSubscription, CreateSubscriptionPlan
+
+CAPACITY = 50
+SIGNUPS = 5_000
+
+
+async def main():
+    wallet_id = f"bench_{urlsafe_short_hash()}"
+    plan = await create_subscription_plan(
+        wallet_id,
+        CreateSubscriptionPlan(
+            name="Capacity benchmark",
+            amount=1000,
+            interval="monthly",
+            max_subscriptions=CAPACITY,
+        ),
+    )
+    data = CreateSubscription(plan_id=plan.id)
+
+    async def signup() -> bool:
+        try:
+            await create_subscription(plan.id, wallet_id, data)
+            return True
+        except ValueError:
+            return False
+
+    start = time.perf_counter()
+    results = await asyncio.gather(*[signup() for _ in range(SIGNUPS)])
+    elapsed = time.perf_counter() - start
+
+    created = await get_subscriptions_by_plan(plan.id)
+    counter = (await get_subscription_plan(plan.id)).active_subscriptions
+    print(f"database:      {db.type}")
+    print(f"signups:       {SIGNUPS} concurrent against a cap of {CAPACITY}")
+    print(f"accepted:      {sum(results)}")
+    print(f"rows created:  {len(created)}")
+    print(f"plan counter:  {counter}")
+    print(f"throughput:    {SIGNUPS / elapsed:.0f} signups/s ({elapsed:.2f}s)")
+
+    for subscription in created:
+        await delete_subscription(subscription.id)
+    await delete_subscription_plan(plan.id)
+
+    assert len(created) <= CAPACITY, f"oversold: {len(created)} > {CAPACITY}"
+    assert counter == len(created), f"counter drift: {counter} != {len(created)}"
+    print("OK: zero oversells")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,75 @@
+"""
+Load check for Idempotency-Key handling.
+
+Run from the LNbits root with:
+
+    python -m lnbits.extensions.subscriptions.benchmarks.idempotency
+
+Simulates public subscribe traffic where 20% of requests are client retries,
+half sent while the original is still in flight and half after it finished.
+Every logical request must run its operation exactly once.
+"""
+
+import asyncio
+import random
+import time
+from collections import Counter
+
+from ..idempotency import IdempotencyStore, request_fingerprint
+
+REQUESTS = 10_000
+RETRY_RATE = 0.2
+OPERATION_SECONDS = 0.005
+CONCURRENCY = 200
+
+
+async def main():
+    rng = random.Random(7)
+    store = IdempotencyStore()
+    executions: Counter = Counter()
+
+    def operation(key: str):
+        async def create():
+            executions[key] += 1
+            await asyncio.sleep(OPERATION_SECONDS)
+            return {"subscription": key}
+
+        return create
+
+    async def send(key: str, delay: float = 0.0):
+        await asyncio.sleep(delay)
+        fingerprint = request_fingerprint("public_subscribe", {"key": key})
+        result, _ = await store.run(key, fingerprint, operation(key))
+        assert result == {"subscription": key}
+
+    calls = []
+    for i in range(REQUESTS):
+        key = f"key-{i}"
+        calls.append(send(key))
+        if rng.random() < RETRY_RATE:
+            # Half retry mid-flight, half after the first attempt returned
+            late = rng.random() < 0.5
+            calls.append(send(key, OPERATION_SECONDS * (3 if late else 0.5)))
+
+    semaphore = asyncio.Semaphore(CONCURRENCY)
+
+    async def bounded(call):
+        async with semaphore:
+            await call
+
+    start = time.perf_counter()
+    await asyncio.gather(*[bounded(call) for call in calls])
+    elapsed = time.perf_counter() - start
+
+    duplicates = sum(count - 1 for count in executions.values() if count > 1)
+    stats = store.stats()
+    print(f"requests:   {len(calls)} ({len(calls) - REQUESTS} retries)")
+    print(f"executions: {sum(executions.values())} for {len(executions)} keys")
+    print(f"duplicates: {duplicates}")
+    print(f"replayed:   {stats['replays']}, coalesced in flight: {stats['coalesced']}")
+    print(f"elapsed:    {elapsed:.2f}s")
+    assert duplicates == 0, "retries ran the operation more than once"
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
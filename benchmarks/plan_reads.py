@@ -0,0 +1,58 @@
+"""
+Thundering-herd check for coalesced plan reads.
+
+Run from the LNbits root with:
+
+    python -m lnbits.extensions.subscriptions.benchmarks.plan_reads
+
+Fires waves of concurrent reads for one plan at a read-through cache with a
+short TTL and a simulated 5 ms query. A cold wave must cost one query, and a
+wave after expiry must be answered from the stale entry while one query
+refreshes it.
+"""
+
+import asyncio
+import time
+
+from ..cache import TTLCache
+
+VISITORS = 1_000
+QUERY_SECONDS = 0.005
+TTL_SECONDS = 0.05
+
+
+async def main():
+    cache = TTLCache(ttl=TTL_SECONDS, max_size=100, stale_ttl=60)
+    queries = 0
+
+    async def load_plan():
+        nonlocal queries
+        queries += 1
+        await asyncio.sleep(QUERY_SECONDS)
+        return {"id": "plan", "version": queries}
+
+    async def wave(label: str):
+        before = queries
+        start = time.perf_counter()
+        results = await asyncio.gather(
+            *[cache.get_or_load("plan", load_plan) for _ in range(VISITORS)]
+        )
+        elapsed = (time.perf_counter() - start) * 1000
+        await asyncio.sleep(QUERY_SECONDS * 2)  # let background refreshes land
+        print(
+            f"{label:>12} {VISITORS:>9} {queries - before:>8} {elapsed:>10.1f}"
+            f" {'v' + str(results[0]['version']):>8}"
+        )
+        return queries - before
+
+    print(f"{'wave':>12} {'visitors':>9} {'queries':>8} {'ms':>10} {'served':>8}")
+    cold = await wave("cold")
+    warm = await wave("warm")
+    await asyncio.sleep(TTL_SECONDS * 2)
+    stale = await wave("expired")
+    print(cache.stats())
+    assert (cold, warm, stale) == (1, 0, 1), "reads were not coalesced"
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,57 @@
+"""
+Micro-benchmark for the in-process rate limiter.
+
+Run from the LNbits root with:
+
+    python -m lnbits.extensions.subscriptions.benchmarks.rate_limit
+
+Latency per check should stay flat as the number of distinct clients grows.
+"""
+
+import asyncio
+import statistics
+import time
+
+from ..rate_limit import MemoryBackend, RateLimitPolicy
+
+POLICY = RateLimitPolicy("bench", 5, 60)
+CLIENT_COUNTS = [1_000, 10_000, 100_000]
+CHECKS = 200_000
+
+
+async def bench(clients: int) -> dict:
+    backend = MemoryBackend(max_keys=clients * 2)
+    now = time.time()
+
+    # Warm the backend so every client already has a counter
+    for i in range(clients):
+        await backend.hit(f"10.{i >> 16 & 255}.{i >> 8 & 255}.{i & 255}", POLICY, now)
+
+    samples = []
+    for batch in range(CHECKS // 1000):
+        start = time.perf_counter()
+        for j in range(1000):
+            i = (batch * 1000 + j) * 7919 % clients
+            await backend.hit(f"10.{i >> 16 & 255}.{i >> 8 & 255}.{i & 255}", POLICY, now)
+        samples.append((time.perf_counter() - start) / 1000 * 1e6)
+
+    return {
+        "clients": clients,
+        "tracked_keys": len(backend),
+        "mean_us": statistics.mean(samples),
+        "p99_us": sorted(samples)[int(len(samples) * 0.99) - 1],
+    }
+
+
+async def main():
+    print(f"{'clients':>10} {'keys':>10} {'mean us':>10} {'p99 us':>10}")
+    for clients in CLIENT_COUNTS:
+        result = await bench(clients)
+        print(
+            f"{result['clients']:>10} {result['tracked_keys']:>10} "
+            f"{result['mean_us']:>10.2f} {result['p99_us']:>10.2f}"
+        )
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
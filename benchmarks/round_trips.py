@@ -0,0 +1,89 @@
+"""
+Count database round trips per CRUD operation.
+
+Every statement sent through `lnbits.db.Connection` is counted while each
+operation runs once. Run from the LNbits root, against a database the
+extension has already been migrated on:
+
+    python -m lnbits.extensions.subscriptions.benchmarks.round_trips
+"""
+
+import asyncio
+from datetime import datetime, timedelta
+
+from lnbits.db import Connection
+from lnbits.helpers import urlsafe_short_hash
+
+from .. import db
+from ..crud import (
+    RETURNING_SUPPORTED,
+    cancel_subscription,
+    create_subscription,
+    create_subscription_payment,
+    create_subscription_plan,
+    delete_subscription,
+    delete_subscription_plan,
+    settle_subscription_payment,
+    update_payment_status,
+    update_subscription_plan,
+    update_subscription_status,
+)
+from ..models import CreateSubscription, CreateSubscriptionPlan
+
+_statements = 0
+
+
+def _counting(method):
+    async def wrapper(self, *args, **kwargs):
+        global _statements
+        _statements += 1
+        return await method(self, *args, **kwargs)
+
+    return wrapper
+
+
+for _name in ("execute", "fetchone", "fetchall"):
+    setattr(Connection, _name, _counting(getattr(Connection, _name)))
+
+
+async def count(label: str, operation) -> object:
+    global _statements
+    _statements = 0
+    result = await operation
+    print(f"{label:<40} {_statements:>3}")
+    return result
+
+
+async def main():
+    print(f"database: {db.type}, RETURNING: {RETURNING_SUPPORTED}\n")
+    print(f"{'operation':<40} {'round trips':>3}")
+
+    wallet_id = f"bench_{urlsafe_short_hash()}"
+    plan_data = CreateSubscriptionPlan(name="Round trips", amount=1000, interval="monthly")
+    plan = await count("create_subscription_plan", create_subscription_plan(wallet_id, plan_data))
+    await count("update_subscription_plan", update_subscription_plan(plan.id, plan_data))
+
+    data = CreateSubscription(plan_id=plan.id)
+    subscription = await count(
+        "create_subscription", create_subscription(plan.id, wallet_id, data)
+    )
+    now = datetime.now()
+    payment_hash = urlsafe_short_hash()
+    payment = await count(
+        "create_subscription_payment",
+        create_subscription_payment(
+            subscription.id, payment_hash, 1000, now, now + timedelta(days=30)
+        ),
+    )
+    await count("update_payment_status", update_payment_status(payment.id, "failed"))
+    await count("settle_subscription_payment", settle_subscription_payment(payment_hash))
+    await count("update_subscription_status", update_subscription_status(subscription.id, "past_due"))
+    await count("cancel_subscription (at period end)", cancel_subscription(subscription.id, True))
+    await count("cancel_subscription (immediately)", cancel_subscription(subscription.id, False))
+
+    await delete_subscription(subscription.id)
+    await delete_subscription_plan(plan.id)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,361 @@
+"""
+Reproducible load benchmark for the extension's API and renewal sweep.
+
+Run from the LNbits root with:
+
+    python -m lnbits.extensions.subscriptions.benchmarks.suite --subscriptions 10000
+
+The extension router is mounted in-process on a FastAPI app and exercised
+through httpx's ASGI transport. The database is fresh and migrated for the
+run: SQLite in a temporary LNbits data folder by default, or an empty scratch
+Postgres database passed with --postgres. Invoice creation is stubbed, so no
+Lightning node is involved, and the public rate limits are lifted.
+Invoices come from the extension's fake invoice provider, which settles them
+after --settle-ms, so the checkout scenario times the whole
+subscribe -> invoice -> paid -> active pipeline.
+
+Every scenario reports throughput and p50/p95/p99 latency. Results are saved
+as JSON (--output); pass an earlier file with --compare to print the change
+per scenario.
+"""
+
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import platform
+import random
+import re
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+from .. import db, migrations, rate_limit, subscriptions_ext, tasks
+from ..crud import create_subscription_plan, create_subscriptions_batch, get_payment_by_hash
+from ..invoices import FakeInvoiceProvider, set_invoice_provider
+from ..models import CreateSubscription, CreateSubscriptionPlan
+from ..notifications import add_payment_waiter, remove_payment_waiter
+
+# Set in the child process that runs against the temporary database
+CHILD_ENV = "SUBSCRIPTIONS_BENCH_CHILD"
+WALLET_ID = "benchwallet"
+SEED_BATCH_SIZE = 500
+INTERVALS = ["daily", "weekly", "monthly", "yearly"]
+CHECKOUT_TIMEOUT = 30
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--plans", type=int, default=10)
+    parser.add_argument("--subscriptions", type=int, default=10_000)
+    parser.add_argument("--requests", type=int, default=2_000, help="requests per HTTP scenario")
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--sweep-due", type=int, default=2_000, help="subscriptions due for renewal")
+    parser.add_argument("--invoice-latency-ms", type=float, default=0.0)
+    parser.add_argument("--settle-ms", type=float, default=10.0, help="delay before invoices are paid")
+    parser.add_argument("--postgres", help="URL of an empty scratch Postgres database")
+    parser.add_argument("--output", default="subscriptions_bench.json")
+    parser.add_argument("--compare", help="earlier results file to compare against")
+    parser.add_argument("--seed", type=int, default=1)
+    return parser.parse_args()
+
+
+def summarize(latencies: list, elapsed: float, errors: int) -> dict:
+    ordered = sorted(latencies)
+
+    def percentile(q: float) -> float:
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))] * 1000 if ordered else 0.0
+
+    return {
+        "operations": len(ordered),
+        "errors": errors,
+        "seconds": round(elapsed, 3),
+        "throughput": round(len(ordered) / elapsed, 1) if elapsed else 0.0,
+        "p50_ms": round(percentile(0.50), 2),
+        "p95_ms": round(percentile(0.95), 2),
+        "p99_ms": round(percentile(0.99), 2),
+    }
+
+
+async def drive(requests: int, concurrency: int, send) -> dict:
+    """Run `send(n)` `requests` times from `concurrency` workers and summarise it."""
+    counter = itertools.count()
+    latencies: list = []
+    errors = 0
+
+    async def worker():
+        nonlocal errors
+        while True:
+            n = next(counter)
+            if n >= requests:
+                return
+            start = time.perf_counter()
+            ok = await send(n)
+            latencies.append(time.perf_counter() - start)
+            if not ok:
+                errors += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    return summarize(latencies, time.perf_counter() - start, errors)
+
+
+class AllowAll:
+    async def hit(self, key, policy, now) -> bool:
+        return True
+
+
+def install_stubs(args) -> FakeInvoiceProvider:
+    provider = FakeInvoiceProvider(
+        latency=args.invoice_latency_ms / 1000,
+        settle_after=args.settle_ms / 1000,
+        seed=args.seed,
+    )
+    set_invoice_provider(provider)
+    rate_limit.rate_limiter.backend = AllowAll()
+    return provider
+
+
+async def migrate() -> None:
+    steps = sorted(
+        (name, step) for name, step in vars(migrations).items() if re.match(r"m\d{3}_", name)
+    )
+    for _, step in steps:
+        await step(db)
+
+
+async def seed(args, rng: random.Random) -> list:
+    plans = []
+    for i in range(args.plans):
+        plan = await create_subscription_plan(
+            WALLET_ID,
+            CreateSubscriptionPlan(
+                name=f"Bench plan {i}",
+                amount=1000 + i,
+                interval=INTERVALS[i % len(INTERVALS)],
+                trial_days=0,
+            ),
+        )
+        plans.append(plan.id)
+
+    for start in range(0, args.subscriptions, SEED_BATCH_SIZE):
+        batch = [
+            (
+                n,
+                CreateSubscription(
+                    plan_id=rng.choice(plans), subscriber_email=f"seed{n}@example.com"
+                ),
+            )
+            for n in range(start, min(start + SEED_BATCH_SIZE, args.subscriptions))
+        ]
+        await create_subscriptions_batch(WALLET_ID, batch)
+    return plans
+
+
+async def bench_renewals(args) -> dict:
+    """Make `--sweep-due` subscriptions due and time one renewal sweep per chunk."""
+    await db.execute(
+        """
+        UPDATE subscriptions.subscriptions SET next_payment_date = ?
+        WHERE id IN (
+            SELECT id FROM subscriptions.subscriptions ORDER BY id LIMIT ?
+        )
+        """,
+        (datetime.now() - timedelta(minutes=1), args.sweep_due),
+    )
+
+    latencies: list = []
+    apply_renewals = tasks.apply_renewals
+
+    async def timed_apply(renewals):
+        start = time.perf_counter()
+        try:
+            return await apply_renewals(renewals)
+        finally:
+            latencies.append(time.perf_counter() - start)
+
+    tasks.apply_renewals = timed_apply
+    try:
+        start = time.perf_counter()
+        renewed = await tasks.process_due_renewals()
+        elapsed = time.perf_counter() - start
+    finally:
+        tasks.apply_renewals = apply_renewals
+
+    result = summarize(latencies, elapsed, args.sweep_due - renewed)
+    result["operations"] = renewed
+    result["throughput"] = round(renewed / elapsed, 1) if elapsed else 0.0
+    result["chunks"] = len(latencies)
+    return result
+
+
+async def run(args) -> dict:
+    import httpx
+    from fastapi import FastAPI
+    from lnbits.decorators import get_key_type, require_admin_key
+
+    rng = random.Random(args.seed)
+    provider = install_stubs(args)
+    await migrate()
+    settlements = asyncio.ensure_future(tasks.wait_for_paid_invoices())
+
+    start = time.perf_counter()
+    plans = await seed(args, rng)
+    print(f"seeded {args.plans} plans, {args.subscriptions} subscriptions "
+          f"in {time.perf_counter() - start:.1f}s on {db.type}")
+
+    app = FastAPI()
+    app.include_router(subscriptions_ext)
+    key = SimpleNamespace(wallet_type=0, wallet=SimpleNamespace(id=WALLET_ID, user="bench"))
+    app.dependency_overrides[get_key_type] = lambda: key
+    app.dependency_overrides[require_admin_key] = lambda: key
+
+    transport = httpx.ASGITransport(app=app)
+    client = httpx.AsyncClient(transport=transport, base_url="http://bench")
+
+    def http(method: str, path, params=None, body=None):
+        async def send(n: int) -> bool:
+            response = await client.request(
+                method,
+                path(n),
+                params=params(n) if params else None,
+                json=body(n) if body else None,
+            )
+            return response.status_code < 400
+
+        return send
+
+    def plan(n: int) -> str:
+        return plans[n % len(plans)]
+
+    def subscriber(prefix: str):
+        return lambda n: {"plan_id": plan(n), "subscriber_email": f"{prefix}{n}@example.com"}
+
+    async def checkout(n: int) -> bool:
+        response = await client.post(
+            f"/subscriptions/api/v1/public/subscribe/{plan(n)}", json=subscriber("checkout")(n)
+        )
+        if response.status_code >= 400:
+            return False
+        payment_hash = response.json()["payment_hash"]
+        queue = add_payment_waiter(payment_hash)
+        try:
+            payment = await get_payment_by_hash(payment_hash)
+            if payment and payment.status == "paid":
+                return True
+            return await asyncio.wait_for(queue.get(), timeout=CHECKOUT_TIMEOUT) == "paid"
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            remove_payment_waiter(payment_hash, queue)
+
+    scenarios = {
+        "plan_fetch": http("GET", lambda n: f"/subscriptions/api/v1/public/plans/{plan(n)}"),
+        "public_subscribe": http(
+            "POST",
+            lambda n: f"/subscriptions/api/v1/public/subscribe/{plan(n)}",
+            body=subscriber("new"),
+        ),
+        "checkout_to_active": checkout,
+        "list_subscriptions": http(
+            "GET",
+            lambda n: "/subscriptions/api/v1/subscriptions",
+            params=lambda n: {"limit": 100, **({"status": "active"} if n % 2 else {})},
+        ),
+        "list_plan_subscriptions": http(
+            "GET",
+            lambda n: f"/subscriptions/api/v1/plans/{plan(n)}/subscriptions",
+            params=lambda n: {"limit": 100},
+        ),
+        "stats": http("GET", lambda n: "/subscriptions/api/v1/stats"),
+    }
+
+    results = {}
+    try:
+        for name, send in scenarios.items():
+            results[name] = await drive(args.requests, args.concurrency, send)
+            report(name, results[name])
+        results["renewal_sweep"] = await bench_renewals(args)
+        report("renewal_sweep", results["renewal_sweep"])
+    finally:
+        await client.aclose()
+        settlements.cancel()
+    print(f"invoices: {provider.stats()}")
+
+    return {
+        "meta": {
+            "created_at": datetime.now().isoformat(),
+            "database": db.type,
+            "python": platform.python_version(),
+            "commit": git_commit(),
+            "args": {k: v for k, v in vars(args).items() if k not in ("output", "compare")},
+        },
+        "results": results,
+    }
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL,
+        ).decode().strip()
+    except Exception:
+        return "unknown"
+
+
+def report(name: str, result: dict) -> None:
+    print(
+        f"{name:<24} {result['operations']:>8} {result['errors']:>6} "
+        f"{result['throughput']:>10.1f} {result['p50_ms']:>9.2f} "
+        f"{result['p95_ms']:>9.2f} {result['p99_ms']:>9.2f}"
+    )
+
+
+def compare(current: dict, path: str) -> None:
+    with open(path) as f:
+        previous = json.load(f)["results"]
+    print(f"\nchange vs {path}")
+    print(f"{'scenario':<24} {'throughput':>11} {'p95':>9}")
+    for name, result in current["results"].items():
+        before = previous.get(name)
+        if not before:
+            continue
+
+        def change(key: str) -> str:
+            if not before[key]:
+                return "n/a"
+            return f"{(result[key] - before[key]) / before[key] * 100:+.1f}%"
+
+        print(f"{name:<24} {change('throughput'):>11} {change('p95_ms'):>9}")
+
+
+def main():
+    args = parse_args()
+    if not os.environ.get(CHILD_ENV):
+        # LNbits reads its database settings at import time, so the run itself
+        # happens in a child process pointed at a throwaway data folder
+        with tempfile.TemporaryDirectory() as data_folder:
+            env = {**os.environ, CHILD_ENV: "1", "LNBITS_DATA_FOLDER": data_folder}
+            env.pop("LNBITS_DATABASE_URL", None)
+            if args.postgres:
+                env["LNBITS_DATABASE_URL"] = args.postgres
+            sys.exit(subprocess.call([sys.executable, "-m", __spec__.name, *sys.argv[1:]], env=env))
+
+    print(f"{'scenario':<24} {'ops':>8} {'errors':>6} {'ops/s':>10} "
+          f"{'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+    results = asyncio.run(run(args))
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"\nresults written to {args.output}")
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+"""Calendar-accurate billing periods and batch schedule computation."""
+
+import calendar
+from datetime import datetime, timedelta
+from typing import List, Optional, Sequence
+
+try:
+    import numpy as np
+except ImportError:  # pragma: no cover - numpy is optional
+    np = None
+
+# Fixed-length intervals, in days
+INTERVAL_DAYS = {"daily": 1, "weekly": 7}
+# Calendar intervals, in months
+INTERVAL_MONTHS = {"monthly": 1, "yearly": 12}
+
+
+def add_months(start: datetime, months: int, anchor_day: Optional[int] = None) -> datetime:
+    """
+    Add calendar months to `start`, keeping the time of day.
+
+    The day of month is `anchor_day` (default: the day of `start`), clamped to
+    the length of the target month, so a subscription anchored on the 31st
+    bills on Jan 31, Feb 28, Mar 31 instead of drifting.
+    """
+    month_index = start.year * 12 + start.month - 1 + months
+    year, month = divmod(month_index, 12)
+    month += 1
+    day = min(anchor_day or start.day, calendar.monthrange(year, month)[1])
+    return start.replace(year=year, month=month, day=day)
+
+
+def period_end(start: datetime, interval: str, anchor_day: Optional[int] = None) -> datetime:
+    """Return the end of a billing period of `interval` starting at `start`."""
+    if interval in INTERVAL_DAYS:
+        return start + timedelta(days=INTERVAL_DAYS[interval])
+    if interval in INTERVAL_MONTHS:
+        return add_months(start, INTERVAL_MONTHS[interval], anchor_day)
+    raise ValueError("Invalid interval")
+
+
+# date.toordinal() of 1970-01-01, the datetime64 epoch
+_EPOCH_ORDINAL = 719163
+
+
+def _split_datetimes(values: Sequence[datetime]):
+    """
+    Convert datetimes to (datetime64[D] dates, timedelta64[us] times of day).
+
+    Reading the integer fields is several times faster than letting numpy
+    parse datetime objects one by one.
+    """
+    count = len(values)
+    ordinals = np.fromiter((value.toordinal() for value in values), np.int64, count)
+    seconds = np.fromiter(
+        (value.hour * 3600 + value.minute * 60 + value.second for value in values),
+        np.int64,
+        count,
+    )
+    micros = np.fromiter((value.microsecond for value in values), np.int64, count)
+    days = (ordinals - _EPOCH_ORDINAL).astype("datetime64[D]")
+    time_of_day = (seconds * 1_000_000 + micros).astype("timedelta64[us]")
+    return days, time_of_day
+
+
+def period_ends(
+    starts: Sequence[datetime],
+    intervals: Sequence[str],
+    anchor_days: Optional[Sequence[Optional[int]]] = None,
+) -> List[datetime]:
+    """
+    Compute `period_end` for many subscriptions at once.
+
+    Uses vectorised datetime64 arithmetic when numpy is installed, so a
+    renewal sweep prices a whole chunk in one call; falls back to the scalar
+    functions otherwise. Results match `period_end` element for element.
+    """
+    if anchor_days is None:
+        anchor_days = [None] * len(starts)
+    if np is None or not starts:
+        return [
+            period_end(start, interval, anchor)
+            for start, interval, anchor in zip(starts, intervals, anchor_days)
+        ]
+
+    unknown = set(intervals) - set(INTERVAL_DAYS) - set(INTERVAL_MONTHS)
+    if unknown:
+        raise ValueError("Invalid interval")
+
+    days, time_of_day = _split_datetimes(starts)
+    moments = days + time_of_day
+    months = days.astype("datetime64[M]")
+    day_of_month = (days - months.astype("datetime64[D]")).astype(np.int64) + 1
+
+    interval_array = np.array(intervals)
+    step_days = np.zeros(len(starts), dtype=np.int64)
+    step_months = np.zeros(len(starts), dtype=np.int64)
+    for name, count in INTERVAL_DAYS.items():
+        step_days[interval_array == name] = count
+    for name, count in INTERVAL_MONTHS.items():
+        step_months[interval_array == name] = count
+
+    anchors = np.array(
+        [anchor or 0 for anchor in anchor_days], dtype=np.int64
+    )
+    anchors = np.where(anchors > 0, anchors, day_of_month)
+
+    target_month = months + step_months.astype("timedelta64[M]")
+    month_start = target_month.astype("datetime64[D]")
+    month_length = ((target_month + 1).astype("datetime64[D]") - month_start).astype(np.int64)
+    calendar_end = (
+        month_start
+        + (np.minimum(anchors, month_length) - 1).astype("timedelta64[D]")
+        + time_of_day
+    )
+    fixed_end = moments + step_days.astype("timedelta64[D]")
+
+    ends = np.where(step_months > 0, calendar_end, fixed_end)
+    return ends.astype("datetime64[us]").tolist()
@@ -0,0 +1,236 @@
+"""Streaming bulk import and export of subscriptions."""
+
+import csv
+import io
+import json
+from datetime import datetime
+from typing import AsyncIterator, List, Optional, Tuple
+
+from loguru import logger
+
+from .crud import (
+    create_subscriptions_batch,
+    encode_cursor,
+    get_subscriptions,
+    get_wallet_payments_page,
+)
+from .models import CreateSubscription, PaymentLedgerEntry
+
+# Rows validated and inserted per transaction
+IMPORT_BATCH_SIZE = 500
+# Cap on per-row errors echoed back in the import report
+MAX_REPORTED_ERRORS = 1000
+# Rows fetched per keyset page while exporting
+EXPORT_PAGE_SIZE = 1000
+
+IMPORT_CSV_FIELDS = ("plan_id", "subscriber_email", "subscriber_name", "metadata")
+EXPORT_FIELDS = (
+    "id", "plan_id", "wallet", "subscriber_email", "subscriber_name", "status",
+    "current_period_start", "current_period_end", "trial_end", "cancel_at_period_end",
+    "canceled_at", "metadata", "last_payment_id", "last_payment_date",
+    "failed_payment_count", "next_payment_date", "created_at", "updated_at",
+)
+LEDGER_FIELDS = tuple(PaymentLedgerEntry.__fields__)
+
+
+async def _lines(
+    stream: AsyncIterator[bytes],
+) -> AsyncIterator[Tuple[int, Optional[str], Optional[str]]]:
+    """
+    Split a byte stream into numbered, non-empty text lines, yielding
+    (line number, text, error) with an error for lines that aren't UTF-8.
+    """
+    buffer = b""
+    number = 0
+    async for chunk in stream:
+        buffer += chunk
+        *lines, buffer = buffer.split(b"\n")
+        for line in lines:
+            number += 1
+            if line.strip():
+                yield _decode(number, line)
+    if buffer.strip():
+        yield _decode(number + 1, buffer)
+
+
+def _decode(number: int, line: bytes) -> Tuple[int, Optional[str], Optional[str]]:
+    try:
+        return number, line.decode("utf-8").rstrip("\r"), None
+    except UnicodeDecodeError:
+        return number, None, "Malformed row: not valid UTF-8"
+
+
+def _parse_line(line: str, fmt: str, header: Optional[List[str]]) -> dict:
+    if fmt != "csv":
+        return json.loads(line)
+    values = next(csv.reader([line]))
+    record = {key: value or None for key, value in zip(header or [], values)}
+    if record.get("metadata"):
+        record["metadata"] = json.loads(record["metadata"])
+    return record
+
+
+async def _records(
+    stream: AsyncIterator[bytes], fmt: str
+) -> AsyncIterator[Tuple[int, Optional[dict], Optional[str]]]:
+    """Yield (line number, record, parse error) for every non-empty line."""
+    header: Optional[List[str]] = None
+    async for number, line, error in _lines(stream):
+        if error and fmt == "csv" and header is None:
+            raise ValueError("CSV header is not valid UTF-8")
+        if error:
+            yield number, None, error
+            continue
+        if fmt == "csv" and header is None:
+            header = [field.strip() for field in next(csv.reader([line]))]
+            unknown = set(header) - set(IMPORT_CSV_FIELDS)
+            if unknown:
+                raise ValueError(f"Unknown CSV columns: {', '.join(sorted(unknown))}")
+            continue
+        try:
+            yield number, _parse_line(line, fmt, header), None
+        except ValueError as e:
+            yield number, None, f"Malformed row: {e}"
+
+
+async def import_subscriptions(
+    wallet_id: str, stream: AsyncIterator[bytes], fmt: str = "ndjson"
+) -> dict:
+    """
+    Import subscriptions from an NDJSON or CSV byte stream.
+
+    Rows are validated with `CreateSubscription` and inserted in batches of
+    IMPORT_BATCH_SIZE, so memory stays flat regardless of the upload size.
+    Raises ValueError if the CSV header names unknown columns.
+    """
+    created = 0
+    failed = 0
+    errors: List[dict] = []
+    batch: List[Tuple[int, CreateSubscription]] = []
+
+    def report(line: int, error: str) -> None:
+        nonlocal failed
+        failed += 1
+        if len(errors) < MAX_REPORTED_ERRORS:
+            errors.append({"line": line, "error": error})
+
+    async def flush() -> None:
+        nonlocal created
+        try:
+            batch_created, batch_errors = await create_subscriptions_batch(wallet_id, batch)
+        except Exception as e:
+            logger.error(f"Error importing subscription batch: {e}")
+            batch_errors = [(line, "Could not import row") for line, _ in batch]
+            batch_created = 0
+        created += batch_created
+        for line, error in batch_errors:
+            report(line, error)
+        batch.clear()
+
+    async for number, record, error in _records(stream, fmt):
+        if error:
+            report(number, error)
+            continue
+        try:
+            batch.append((number, CreateSubscription.parse_obj(record)))
+        except ValueError as e:
+            report(number, str(e))
+
+        if len(batch) >= IMPORT_BATCH_SIZE:
+            await flush()
+
+    if batch:
+        await flush()
+
+    return {
+        "created": created,
+        "failed": failed,
+        "errors": errors,
+        "errors_truncated": failed > len(errors),
+    }
+
+
+def _export_value(value):
+    if isinstance(value, dict):
+        return json.dumps(value)
+    if hasattr(value, "isoformat"):
+        return value.isoformat()
+    return value
+
+
+async def export_subscriptions(
+    wallet_id: str,
+    fmt: str = "ndjson",
+    status: Optional[str] = None,
+    plan_id: Optional[str] = None,
+) -> AsyncIterator[str]:
+    """Stream a wallet's subscriptions page by page as NDJSON or CSV text."""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    if fmt == "csv":
+        writer.writerow(EXPORT_FIELDS)
+
+    cursor = None
+    while True:
+        page = await get_subscriptions(
+            wallet_id, limit=EXPORT_PAGE_SIZE, cursor=cursor, status=status, plan_id=plan_id
+        )
+        for subscription in page:
+            row = subscription.dict()
+            if fmt == "csv":
+                writer.writerow([_export_value(row[field]) for field in EXPORT_FIELDS])
+            else:
+                buffer.write(json.dumps(row, default=_export_value) + "\n")
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+
+        if len(page) < EXPORT_PAGE_SIZE:
+            break
+        cursor = encode_cursor(page[-1].created_at, page[-1].id)
+
+
+async def export_payments(
+    wallet_id: str,
+    fmt: str = "ndjson",
+    status: Optional[str] = None,
+    created_after: Optional[datetime] = None,
+    created_before: Optional[datetime] = None,
+    after: Optional[Tuple[datetime, str]] = None,
+    include_archive: bool = False,
+) -> AsyncIterator[str]:
+    """
+    Stream a wallet's payment ledger oldest first as NDJSON or CSV text.
+
+    Rows are read in keyset pages, so memory is constant in the ledger size;
+    an interrupted export resumes by passing the (created_at, id) of the last
+    row received as `after`.
+    """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    if fmt == "csv" and not after:
+        writer.writerow(LEDGER_FIELDS)
+
+    while True:
+        page = await get_wallet_payments_page(
+            wallet_id,
+            limit=EXPORT_PAGE_SIZE,
+            after=after,
+            status=status,
+            created_after=created_after,
+            created_before=created_before,
+            include_archive=include_archive,
+        )
+        for entry in page:
+            row = entry.dict()
+            if fmt == "csv":
+                writer.writerow([_export_value(row[field]) for field in LEDGER_FIELDS])
+            else:
+                buffer.write(json.dumps(row, default=_export_value) + "\n")
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+
+        if len(page) < EXPORT_PAGE_SIZE:
+            break
+        after = (page[-1].created_at, page[-1].id)
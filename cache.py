@@ -0,0 +1,167 @@
+"""Small in-process caches for hot, rarely changing reads."""
+
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional
+
+from loguru import logger
+
+
+class TTLCache:
+    """
+    Size-bounded cache whose entries expire `ttl` seconds after being set.
+
+    Entries are kept in least-recently-used order and the oldest one is
+    evicted once `max_size` is exceeded. Hits, misses and evictions are
+    counted for instrumentation.
+
+    With `stale_ttl`, `get_or_load` keeps serving an expired entry for that
+    much longer while one background load refreshes it, and concurrent loads
+    of the same key share a single call (single-flight).
+    """
+
+    def __init__(self, ttl: float, max_size: int, stale_ttl: float = 0):
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.max_size = max_size
+        # key -> (fresh until, stale until, value)
+        self._entries: "OrderedDict[Hashable, tuple]" = OrderedDict()
+        self._loads: Dict[Hashable, asyncio.Future] = {}
+        self._refreshes: Dict[Hashable, asyncio.Task] = {}
+        # Per-key write counts while a load is in flight, so a load that raced
+        # a write to its key doesn't store old data
+        self._versions: Dict[Hashable, int] = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.stale_hits = 0
+        self.loads = 0
+        self.coalesced = 0
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        fresh_until, stale_until, value = entry
+        now = time.monotonic()
+        if fresh_until <= now:
+            if stale_until <= now:
+                del self._entries[key]
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key: Hashable, value: Any) -> None:
+        self._bump(key)
+        self._store(key, value)
+
+    def _bump(self, key: Hashable) -> None:
+        if key in self._versions:
+            self._versions[key] += 1
+
+    def _store(self, key: Hashable, value: Any) -> None:
+        fresh_until = time.monotonic() + self.ttl
+        self._entries[key] = (fresh_until, fresh_until + self.stale_ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    async def get_or_load(
+        self, key: Hashable, loader: Callable[[], Awaitable[Any]]
+    ) -> Optional[Any]:
+        """
+        Return the cached value for `key`, loading it with `loader` on a miss.
+
+        Concurrent misses for one key await the same load. An entry past its
+        ttl but within `stale_ttl` is returned as is while a single background
+        load refreshes it. A None result is returned but not cached.
+        """
+        entry = self._entries.get(key)
+        if entry is not None:
+            fresh_until, stale_until, value = entry
+            now = time.monotonic()
+            if fresh_until > now:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return value
+            if stale_until > now:
+                self.stale_hits += 1
+                if key not in self._loads and key not in self._refreshes:
+                    self._refreshes[key] = asyncio.ensure_future(self._refresh(key, loader))
+                return value
+        self.misses += 1
+        return await self._load(key, loader)
+
+    async def _load(self, key: Hashable, loader: Callable[[], Awaitable[Any]]) -> Optional[Any]:
+        future = self._loads.get(key)
+        if future is not None:
+            self.coalesced += 1
+            try:
+                return await asyncio.shield(future)
+            except asyncio.CancelledError:
+                if not future.cancelled():
+                    raise
+                # The caller running the load went away: load it ourselves
+                return await self._load(key, loader)
+
+        self.loads += 1
+        self._versions[key] = 0
+        future = asyncio.get_event_loop().create_future()
+        self._loads[key] = future
+        try:
+            value = await loader()
+        except BaseException as e:
+            if isinstance(e, asyncio.CancelledError):
+                future.cancel()
+            else:
+                future.set_exception(e)
+                future.exception()
+            raise
+        finally:
+            self._loads.pop(key, None)
+            written = self._versions.pop(key, 0)
+        if value is not None and not written:
+            self._store(key, value)
+        future.set_result(value)
+        return value
+
+    async def _refresh(self, key: Hashable, loader: Callable[[], Awaitable[Any]]) -> None:
+        try:
+            value = await self._load(key, loader)
+        except Exception as e:
+            logger.warning(f"Background cache refresh failed for {key}: {e}")
+            return
+        finally:
+            self._refreshes.pop(key, None)
+        if value is None:
+            self.invalidate(key)
+
+    def invalidate(self, key: Hashable) -> None:
+        self._bump(key)
+        self._entries.pop(key, None)
+
+    def clear(self) -> None:
+        for key in self._versions:
+            self._versions[key] += 1
+        self._entries.clear()
+
+    def stats(self) -> dict:
+        requests = self.loads + self.coalesced
+        return {
+            "size": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "stale_hits": self.stale_hits,
+            "loads": self.loads,
+            "coalesced": self.coalesced,
+            "coalescing_ratio": round(self.coalesced / requests, 4) if requests else 0.0,
+        }
+
+    def __len__(self) -> int:
+        return len(self._entries)
@@ -1,62 +1,254 @@
 import json
+import secrets
+import sqlite3
+from base64 import urlsafe_b64decode, urlsafe_b64encode
 from datetime import datetime, timedelta
-from typing import List, Optional
+from typing import Dict, List, Optional, Tuple
 
+from lnbits.db import POSTGRES, SQLITE, Connection
 from lnbits.helpers import urlsafe_short_hash
+from pydantic import BaseModel
 
-from . import db
+from . import db as extension_db
 from .models import (
     CreateSubscriptionPlan,
     SubscriptionPlan,
     CreateSubscription,
     Subscription,
     SubscriptionPayment,
+    DueSubscription,
+    DunningEntry,
+    PaymentLedgerEntry,
+    PlanCounters,
+    WebhookEvent,
+    PlanStats,
+    WalletStats,
 )
+from .billing import period_end
+from .cache import TTLCache
+from .metrics import CountingDatabase, observe_crud
+
+# Statements sent through `db` are counted per CRUD function
+db = CountingDatabase(extension_db)
+
+
+def calculate_period_end(
+    period_start: datetime, interval: str, anchor_day: Optional[int] = None
+) -> datetime:
+    """Return the end of a billing period starting at `period_start`."""
+    return period_end(period_start, interval, anchor_day)
+
+
+# UPDATE ... RETURNING is available on Postgres/CockroachDB and SQLite >= 3.35
+RETURNING_SUPPORTED = db.type != SQLITE or sqlite3.sqlite_version_info >= (3, 35, 0)
+
+# Subscription id ranges compare byte-wise on every backend, so shard
+# boundaries picked in Python split the table without gaps or overlap
+ID_COLLATE = ' COLLATE "C"' if db.type == POSTGRES else ""
+
+# A [start, end) range of subscription ids; None leaves that side open
+IdRange = Tuple[Optional[str], Optional[str]]
+
+# Monthly revenue multipliers per billing interval, as used by the dashboard
+MONTHLY_FACTORS = {"daily": 30, "weekly": 4.33, "monthly": 1, "yearly": 1 / 12}
+
+# Statuses that hold one of a plan's max_subscriptions slots
+LIVE_STATUSES = ("active", "trialing", "past_due")
+
+# Subscription statuses counted in plan_stats, and their columns
+STATUS_COUNT_COLUMNS = {
+    "trialing": "trialing_count",
+    "active": "active_count",
+    "past_due": "past_due_count",
+    "canceled": "canceled_count",
+}
+
+# Webhook events emitted when a subscription enters a status
+STATUS_EVENTS = {
+    "past_due": "subscription.past_due",
+    "canceled": "subscription.canceled",
+}
+
+# Window over which cancellations count towards churn
+CHURN_WINDOW_DAYS = 30
+
+# Per-wallet dashboard summaries; writes invalidate them, the TTL bounds staleness
+wallet_stats_cache = TTLCache(ttl=60, max_size=10_000)
+
+# Read-through plan lookups for the public routes; writes in this process
+# invalidate them, the TTL bounds staleness across worker processes. Expired
+# plans are served for up to stale_ttl more while one query refreshes them,
+# and concurrent misses for a plan share one query.
+plan_cache = TTLCache(ttl=30, max_size=5_000, stale_ttl=300)
+
+
+def encode_cursor(created_at: datetime, row_id: str) -> str:
+    """Encode the (created_at, id) keyset position of a row as an opaque cursor."""
+    raw = f"{created_at.isoformat()}|{row_id}".encode()
+    return urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> Tuple[datetime, str]:
+    """Decode a cursor from `encode_cursor`, raising ValueError if malformed."""
+    try:
+        raw = urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+        created_at, row_id = raw.split("|", 1)
+        return datetime.fromisoformat(created_at), row_id
+    except Exception:
+        raise ValueError("Invalid cursor")
+
+
+def _list_filters(
+    cursor: Optional[str] = None,
+    status: Optional[str] = None,
+    created_after: Optional[datetime] = None,
+    created_before: Optional[datetime] = None,
+) -> Tuple[str, list]:
+    """Build the shared status/date-range/keyset clauses for newest-first lists."""
+    clauses = []
+    values: list = []
+    if status:
+        clauses.append("status = ?")
+        values.append(status)
+    if created_after:
+        clauses.append("created_at >= ?")
+        values.append(created_after)
+    if created_before:
+        clauses.append("created_at < ?")
+        values.append(created_before)
+    if cursor:
+        created_at, row_id = decode_cursor(cursor)
+        clauses.append("(created_at < ? OR (created_at = ? AND id < ?))")
+        values += [created_at, created_at, row_id]
+    return "".join(f" AND {clause}" for clause in clauses), values
+
+
+def _id_range_filter(column: str, id_range: Optional[IdRange]) -> Tuple[str, list]:
+    """Conditions, each prefixed with AND, keeping `column` inside `id_range`."""
+    clauses, values = [], []
+    if id_range and id_range[0] is not None:
+        clauses.append(f"AND {column}{ID_COLLATE} >= ?")
+        values.append(id_range[0])
+    if id_range and id_range[1] is not None:
+        clauses.append(f"AND {column}{ID_COLLATE} < ?")
+        values.append(id_range[1])
+    return " ".join(clauses), values
+
+
+async def _update_returning(
+    query: str, values: tuple, table: str, row_id: str, conn: Optional[Connection] = None
+):
+    """Run an UPDATE and return the updated row, in one round trip where possible."""
+    if RETURNING_SUPPORTED:
+        return await (conn or db).fetchone(f"{query} RETURNING *", values)
+    await (conn or db).execute(query, values)
+    return await (conn or db).fetchone(
+        f"SELECT * FROM subscriptions.{table} WHERE id = ?", (row_id,)
+    )
+
+
+async def _update_ids(conn: Connection, query: str, values: tuple, ids: List[str]) -> set:
+    """
+    Run a conditional UPDATE over `ids` and return the ids it changed. Without
+    RETURNING (SQLite < 3.35) the open transaction keeps other writers out, so
+    the rows the caller just checked are the rows it changes.
+    """
+    if RETURNING_SUPPORTED:
+        return {row["id"] for row in await conn.fetchall(f"{query} RETURNING id", values)}
+    await conn.execute(query, values)
+    return set(ids)
 
 
 # Subscription Plans CRUD
+@observe_crud
 async def create_subscription_plan(
     wallet_id: str, data: CreateSubscriptionPlan
 ) -> SubscriptionPlan:
     plan_id = urlsafe_short_hash()
+    webhook_secret = secrets.token_hex(32)
     now = datetime.now()
     
-    await db.execute(
-        """
-        INSERT INTO subscriptions.plans (id, wallet, name, description, amount, interval, 
-                                       trial_days, max_subscriptions, webhook_url, 
-                                       success_message, success_url, created_at, updated_at)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        """,
-        (
-            plan_id,
-            wallet_id,
-            data.name,
-            data.description,
-            data.amount,
-            data.interval,
-            data.trial_days or 0,
-            data.max_subscriptions,
-            data.webhook_url,
-            data.success_message,
-            data.success_url,
-            now,
-            now,
-        ),
+    async with db.connect() as conn:
+        await conn.execute(
+            """
+            INSERT INTO subscriptions.plans (id, wallet, name, description, amount, interval, 
+                                           trial_days, max_subscriptions, webhook_url, 
+                                           success_message, success_url, webhook_secret,
+                                           dunning_schedule, created_at, updated_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """,
+            (
+                plan_id,
+                wallet_id,
+                data.name,
+                data.description,
+                data.amount,
+                data.interval,
+                data.trial_days or 0,
+                data.max_subscriptions,
+                data.webhook_url,
+                data.success_message,
+                data.success_url,
+                webhook_secret,
+                json.dumps(data.dunning_schedule) if data.dunning_schedule else None,
+                now,
+                now,
+            ),
+        )
+        await conn.execute(
+            """
+            INSERT INTO subscriptions.plan_stats (plan_id, revenue_month_start, updated_at)
+            VALUES (?, ?, ?)
+            """,
+            (plan_id, _month_start(now), now),
+        )
+
+    wallet_stats_cache.invalidate(wallet_id)
+    plan = SubscriptionPlan(
+        id=plan_id,
+        wallet=wallet_id,
+        name=data.name,
+        description=data.description,
+        amount=data.amount,
+        interval=data.interval,
+        trial_days=data.trial_days or 0,
+        max_subscriptions=data.max_subscriptions,
+        active_subscriptions=0,
+        webhook_url=data.webhook_url,
+        success_message=data.success_message,
+        success_url=data.success_url,
+        webhook_secret=webhook_secret,
+        dunning_schedule=data.dunning_schedule,
+        created_at=now,
+        updated_at=now,
     )
-    
-    plan = await get_subscription_plan(plan_id)
-    assert plan, "Newly created plan couldn't be retrieved"
+    plan_cache.set(plan_id, plan)
     return plan
 
 
-async def get_subscription_plan(plan_id: str) -> Optional[SubscriptionPlan]:
-    row = await db.fetchone(
+async def _fetch_subscription_plan(
+    plan_id: str, conn: Optional[Connection] = None
+) -> Optional[SubscriptionPlan]:
+    row = await (conn or db).fetchone(
         "SELECT * FROM subscriptions.plans WHERE id = ?", (plan_id,)
     )
     return SubscriptionPlan.from_row(row) if row else None
 
 
+@observe_crud
+async def get_subscription_plan(
+    plan_id: str, conn: Optional[Connection] = None
+) -> Optional[SubscriptionPlan]:
+    if conn is None:
+        return await plan_cache.get_or_load(
+            plan_id, lambda: _fetch_subscription_plan(plan_id)
+        )
+    # Reads inside a transaction must see its writes, and must not cache rows
+    # that may still roll back, so they bypass the cache
+    return await _fetch_subscription_plan(plan_id, conn)
+
+
+@observe_crud
 async def get_subscription_plans(wallet_id: str) -> List[SubscriptionPlan]:
     rows = await db.fetchall(
         "SELECT * FROM subscriptions.plans WHERE wallet = ? ORDER BY created_at DESC",
@@ -65,15 +257,16 @@ async def get_subscription_plans(wallet_id: str) -> List[SubscriptionPlan]:
     return [SubscriptionPlan.from_row(row) for row in rows]
 
 
+@observe_crud
 async def update_subscription_plan(
     plan_id: str, data: CreateSubscriptionPlan
 ) -> Optional[SubscriptionPlan]:
-    await db.execute(
+    row = await _update_returning(
         """
         UPDATE subscriptions.plans SET 
         name = ?, description = ?, amount = ?, interval = ?, trial_days = ?,
         max_subscriptions = ?, webhook_url = ?, success_message = ?, success_url = ?,
-        updated_at = ?
+        dunning_schedule = ?, updated_at = ?
         WHERE id = ?
         """,
         (
@@ -86,156 +279,572 @@ async def update_subscription_plan(
             data.webhook_url,
             data.success_message,
             data.success_url,
+            json.dumps(data.dunning_schedule) if data.dunning_schedule else None,
             datetime.now(),
             plan_id,
         ),
+        "plans",
+        plan_id,
     )
-    return await get_subscription_plan(plan_id)
+    if not row:
+        plan_cache.invalidate(plan_id)
+        return None
+    plan = SubscriptionPlan.from_row(row)
+    plan_cache.set(plan_id, plan)
+    wallet_stats_cache.invalidate(plan.wallet)
+    return plan
 
 
-async def delete_subscription_plan(plan_id: str) -> None:
-    await db.execute("DELETE FROM subscriptions.plans WHERE id = ?", (plan_id,))
+@observe_crud
+async def delete_subscription_plan(plan_id: str) -> bool:
+    """
+    Delete a plan unless it still has live subscriptions, checked against the
+    stored counter in the same statement. Returns whether it was deleted.
+    """
+    async with db.connect() as conn:
+        result = await conn.execute(
+            "DELETE FROM subscriptions.plans WHERE id = ? AND active_subscriptions = 0",
+            (plan_id,),
+        )
+        if result.rowcount == 0:
+            return False
+        await conn.execute(
+            "DELETE FROM subscriptions.plan_stats WHERE plan_id = ?", (plan_id,)
+        )
+    plan_cache.invalidate(plan_id)
+    # Deletions are rare, so drop every summary rather than look up the wallet
+    wallet_stats_cache.clear()
+    return True
 
 
 # Subscriptions CRUD
-async def create_subscription(
-    plan_id: str, wallet_id: str, data: CreateSubscription
+SUBSCRIPTION_COLUMNS = (
+    "id", "plan_id", "wallet", "subscriber_email", "subscriber_name", "status",
+    "current_period_start", "current_period_end", "trial_end", "cancel_at_period_end",
+    "metadata", "next_payment_date", "billing_anchor", "created_at", "updated_at",
+)
+
+
+def _new_subscription(
+    plan: SubscriptionPlan,
+    wallet_id: str,
+    data: CreateSubscription,
+    now: datetime,
+    first_period_invoiced: bool,
 ) -> Subscription:
-    plan = await get_subscription_plan(plan_id)
-    if not plan:
-        raise ValueError("Plan not found")
-    
-    subscription_id = urlsafe_short_hash()
-    now = datetime.now()
-    
-    # Calculate trial period and first payment date
+    """
+    Build a new subscription with its trial or first billing period. Unless
+    the caller invoices the first period itself, it is left for the renewal
+    sweep, which bills it from now.
+    """
     if plan.trial_days > 0:
         trial_end = now + timedelta(days=plan.trial_days)
-        current_period_start = now
         current_period_end = trial_end
         next_payment_date = trial_end
         status = "trialing"
+    elif first_period_invoiced:
+        trial_end = None
+        current_period_end = calculate_period_end(now, plan.interval)
+        # Renewals bill from the end of the period invoiced at signup
+        next_payment_date = current_period_end
+        status = "active"
     else:
         trial_end = None
-        current_period_start = now
-        
-        # Calculate period end based on interval
-        if plan.interval == "daily":
-            current_period_end = now + timedelta(days=1)
-        elif plan.interval == "weekly":
-            current_period_end = now + timedelta(weeks=1)
-        elif plan.interval == "monthly":
-            current_period_end = now + timedelta(days=30)
-        elif plan.interval == "yearly":
-            current_period_end = now + timedelta(days=365)
-        else:
-            raise ValueError("Invalid interval")
-        
+        # Like a trial ending now: the sweep invoices the period starting here
+        current_period_end = now
         next_payment_date = now
         status = "active"
-    
-    await db.execute(
-        """
-        INSERT INTO subscriptions.subscriptions 
-        (id, plan_id, wallet, subscriber_email, subscriber_name, status,
-         current_period_start, current_period_end, trial_end, cancel_at_period_end,
-         metadata, next_payment_date, created_at, updated_at)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        """,
-        (
-            subscription_id,
-            plan_id,
-            wallet_id,
-            data.subscriber_email,
-            data.subscriber_name,
-            status,
-            current_period_start,
-            current_period_end,
-            trial_end,
-            False,
-            json.dumps(data.metadata) if data.metadata else None,
-            next_payment_date,
-            now,
-            now,
-        ),
+
+    return Subscription(
+        id=urlsafe_short_hash(),
+        plan_id=plan.id,
+        wallet=wallet_id,
+        subscriber_email=data.subscriber_email,
+        subscriber_name=data.subscriber_name,
+        status=status,
+        current_period_start=now,
+        current_period_end=current_period_end,
+        trial_end=trial_end,
+        cancel_at_period_end=False,
+        canceled_at=None,
+        metadata=data.metadata or None,
+        created_at=now,
+        updated_at=now,
+        last_payment_id=None,
+        last_payment_date=None,
+        failed_payment_count=0,
+        next_payment_date=next_payment_date,
+        # Renewals keep the day of month the first paid period started on
+        billing_anchor=(trial_end or now).day,
+    )
+
+
+def _subscription_values(subscription: Subscription) -> tuple:
+    return (
+        subscription.id,
+        subscription.plan_id,
+        subscription.wallet,
+        subscription.subscriber_email,
+        subscription.subscriber_name,
+        subscription.status,
+        subscription.current_period_start,
+        subscription.current_period_end,
+        subscription.trial_end,
+        subscription.cancel_at_period_end,
+        json.dumps(subscription.metadata) if subscription.metadata else None,
+        subscription.next_payment_date,
+        subscription.billing_anchor,
+        subscription.created_at,
+        subscription.updated_at,
     )
+
+
+@observe_crud
+async def create_subscription(
+    plan_id: str,
+    wallet_id: str,
+    data: CreateSubscription,
+    first_period_invoiced: bool = False,
+) -> Subscription:
+    """
+    Create a subscription, taking one of its plan's slots. Pass
+    `first_period_invoiced` when the caller issues the first period's
+    invoice; otherwise the renewal sweep bills it.
+    """
+    plan = await get_subscription_plan(plan_id)
+    if not plan:
+        raise ValueError("Plan not found")
     
-    # Update plan's active subscription count
-    await db.execute(
-        """
-        UPDATE subscriptions.plans 
-        SET active_subscriptions = active_subscriptions + 1 
-        WHERE id = ?
-        """,
-        (plan_id,),
+    subscription = _new_subscription(
+        plan, wallet_id, data, datetime.now(), first_period_invoiced
     )
     
-    subscription = await get_subscription(subscription_id)
-    assert subscription, "Newly created subscription couldn't be retrieved"
+    async with db.connect() as conn:
+        # Reserve a slot with one conditional update so concurrent signups
+        # can never push the plan over max_subscriptions
+        result = await conn.execute(
+            """
+            UPDATE subscriptions.plans
+            SET active_subscriptions = active_subscriptions + 1
+            WHERE id = ?
+            AND (max_subscriptions IS NULL OR active_subscriptions < max_subscriptions)
+            """,
+            (plan_id,),
+        )
+        if result.rowcount == 0:
+            raise ValueError("Plan has reached maximum number of subscriptions")
+
+        await _insert_rows(
+            conn, "subscriptions", SUBSCRIPTION_COLUMNS, [_subscription_values(subscription)]
+        )
+        await _adjust_plan_stats(conn, plan_id, {subscription.status: 1})
+        await enqueue_webhook_events(
+            conn, [(plan_id, "subscription.created", {"subscription": subscription})]
+        )
+    
+    plan_cache.invalidate(plan_id)
+    wallet_stats_cache.invalidate(wallet_id)
     return subscription
 
 
-async def get_subscription(subscription_id: str) -> Optional[Subscription]:
-    row = await db.fetchone(
+async def _reserve_plan_slots(conn: Connection, plan_id: str, wanted: int) -> int:
+    """
+    Take up to `wanted` of a plan's free slots and return how many were
+    taken. The update re-checks the cap, so a concurrent signup that took a
+    slot in between makes it read the counter again.
+    """
+    while True:
+        row = await conn.fetchone(
+            "SELECT active_subscriptions, max_subscriptions FROM subscriptions.plans WHERE id = ?",
+            (plan_id,),
+        )
+        if not row:
+            return 0
+        if row["max_subscriptions"] is None:
+            count = wanted
+        else:
+            count = min(wanted, row["max_subscriptions"] - row["active_subscriptions"])
+        if count <= 0:
+            return 0
+        result = await conn.execute(
+            """
+            UPDATE subscriptions.plans
+            SET active_subscriptions = active_subscriptions + ?
+            WHERE id = ?
+            AND (max_subscriptions IS NULL OR active_subscriptions + ? <= max_subscriptions)
+            """,
+            (count, plan_id, count),
+        )
+        if result.rowcount:
+            return count
+
+
+@observe_crud
+async def create_subscriptions_batch(
+    wallet_id: str, batch: List[Tuple[int, CreateSubscription]]
+) -> Tuple[int, List[Tuple[int, str]]]:
+    """
+    Import a batch of (line number, subscription) rows for a wallet.
+
+    Plan slots are reserved once per plan per batch, filling a capped plan up
+    to its limit and rejecting the rest, and all rows are inserted
+    with multi-row statements in one transaction. Returns the number of rows
+    created and a list of (line number, error) for rejected rows. Imported
+    subscriptions are existing customers who paid their current period
+    before the import, so it is not invoiced again and no
+    subscription.created webhook is emitted for them.
+    """
+    errors: List[Tuple[int, str]] = []
+    by_plan: dict = {}
+    for line, data in batch:
+        plan = await get_subscription_plan(data.plan_id)
+        if not plan or plan.wallet != wallet_id:
+            errors.append((line, "Plan not found"))
+            continue
+        by_plan.setdefault(plan.id, (plan, []))[1].append((line, data))
+
+    now = datetime.now()
+    created = 0
+    async with db.connect() as conn:
+        rows = []
+        for plan_id, (plan, plan_rows) in by_plan.items():
+            # Fill the plan up to its cap; only the overflow rows are rejected
+            taken = await _reserve_plan_slots(conn, plan_id, len(plan_rows))
+            errors += [
+                (line, "Plan has reached maximum number of subscriptions")
+                for line, _ in plan_rows[taken:]
+            ]
+            plan_rows = plan_rows[:taken]
+            if not plan_rows:
+                continue
+            subscriptions = [
+                _new_subscription(plan, wallet_id, data, now, first_period_invoiced=True)
+                for _, data in plan_rows
+            ]
+            rows += [_subscription_values(subscription) for subscription in subscriptions]
+            statuses: Dict[str, int] = {}
+            for subscription in subscriptions:
+                statuses[subscription.status] = statuses.get(subscription.status, 0) + 1
+            await _adjust_plan_stats(conn, plan_id, statuses)
+        await _insert_rows(conn, "subscriptions", SUBSCRIPTION_COLUMNS, rows)
+        created = len(rows)
+
+    for plan_id in by_plan:
+        plan_cache.invalidate(plan_id)
+    wallet_stats_cache.invalidate(wallet_id)
+    return created, errors
+
+
+@observe_crud
+async def get_subscription(
+    subscription_id: str, conn: Optional[Connection] = None
+) -> Optional[Subscription]:
+    row = await (conn or db).fetchone(
         "SELECT * FROM subscriptions.subscriptions WHERE id = ?", (subscription_id,)
     )
     return Subscription.from_row(row) if row else None
 
 
-async def get_subscriptions(wallet_id: str) -> List[Subscription]:
+@observe_crud
+async def get_subscriptions(
+    wallet_id: str,
+    limit: Optional[int] = None,
+    cursor: Optional[str] = None,
+    status: Optional[str] = None,
+    plan_id: Optional[str] = None,
+    created_after: Optional[datetime] = None,
+    created_before: Optional[datetime] = None,
+) -> List[Subscription]:
+    filters, values = _list_filters(cursor, status, created_after, created_before)
+    if plan_id:
+        filters = f" AND plan_id = ?{filters}"
+        values = [plan_id, *values]
     rows = await db.fetchall(
-        "SELECT * FROM subscriptions.subscriptions WHERE wallet = ? ORDER BY created_at DESC",
-        (wallet_id,),
+        f"""
+        SELECT * FROM subscriptions.subscriptions WHERE wallet = ?{filters}
+        ORDER BY created_at DESC, id DESC {"LIMIT ?" if limit else ""}
+        """,
+        (wallet_id, *values, *([limit] if limit else [])),
     )
     return [Subscription.from_row(row) for row in rows]
 
 
-async def get_subscriptions_by_plan(plan_id: str) -> List[Subscription]:
+@observe_crud
+async def get_subscriptions_by_plan(
+    plan_id: str,
+    limit: Optional[int] = None,
+    cursor: Optional[str] = None,
+    status: Optional[str] = None,
+    created_after: Optional[datetime] = None,
+    created_before: Optional[datetime] = None,
+) -> List[Subscription]:
+    filters, values = _list_filters(cursor, status, created_after, created_before)
     rows = await db.fetchall(
-        "SELECT * FROM subscriptions.subscriptions WHERE plan_id = ? ORDER BY created_at DESC",
-        (plan_id,),
+        f"""
+        SELECT * FROM subscriptions.subscriptions WHERE plan_id = ?{filters}
+        ORDER BY created_at DESC, id DESC {"LIMIT ?" if limit else ""}
+        """,
+        (plan_id, *values, *([limit] if limit else [])),
     )
     return [Subscription.from_row(row) for row in rows]
 
 
-async def update_subscription_status(
-    subscription_id: str, status: str, canceled_at: Optional[datetime] = None
+async def _adjust_plan_counter(conn: Connection, plan_id: str, delta: int) -> None:
+    await conn.execute(
+        """
+        UPDATE subscriptions.plans
+        SET active_subscriptions = CASE
+            WHEN active_subscriptions + ? < 0 THEN 0
+            ELSE active_subscriptions + ?
+        END
+        WHERE id = ?
+        """,
+        (delta, delta, plan_id),
+    )
+    plan_cache.invalidate(plan_id)
+
+
+def _month_start(moment: datetime) -> datetime:
+    return datetime(moment.year, moment.month, 1)
+
+
+async def _adjust_plan_stats(
+    conn: Connection,
+    plan_id: str,
+    statuses: Optional[Dict[str, int]] = None,
+    paid: int = 0,
+    failed: int = 0,
+    revenue: int = 0,
+    month_revenue: Optional[int] = None,
+    paid_at: Optional[datetime] = None,
+) -> None:
+    """
+    Apply deltas to a plan's plan_stats row inside the caller's transaction.
+
+    `statuses` maps subscription statuses to count deltas. Revenue counts
+    towards the month of `paid_at` (default now); the first settlement of a
+    new month restarts revenue_month. `month_revenue` overrides the part of
+    `revenue` that falls in that month.
+    """
+    assignments = []
+    values: list = []
+    for status, delta in (statuses or {}).items():
+        column = STATUS_COUNT_COLUMNS.get(status)
+        if column and delta:
+            assignments.append(f"{column} = {column} + ?")
+            values.append(delta)
+    if failed:
+        assignments.append("failed_payments = failed_payments + ?")
+        values.append(failed)
+    if paid or revenue:
+        month = _month_start(paid_at or datetime.now())
+        month_revenue = revenue if month_revenue is None else month_revenue
+        assignments += [
+            "paid_payments = paid_payments + ?",
+            "revenue_total = revenue_total + ?",
+            "revenue_month = CASE WHEN revenue_month_start < ? THEN ? ELSE revenue_month + ? END",
+            "revenue_month_start = CASE WHEN revenue_month_start < ? THEN ? ELSE revenue_month_start END",
+        ]
+        values += [paid, revenue, month, month_revenue, month_revenue, month, month]
+    if not assignments:
+        return
+    await conn.execute(
+        f"""
+        UPDATE subscriptions.plan_stats SET {", ".join(assignments)}, updated_at = ?
+        WHERE plan_id = ?
+        """,
+        (*values, datetime.now(), plan_id),
+    )
+
+
+async def _transition_subscription(
+    conn: Connection,
+    subscription_id: str,
+    status: str,
+    canceled_at: Optional[datetime] = None,
 ) -> Optional[Subscription]:
-    await db.execute(
+    """
+    Move a subscription to `status`, releasing or taking a plan slot when it
+    leaves or enters LIVE_STATUSES. Returns the updated subscription, or None
+    if the row is missing or changed concurrently.
+    """
+    row = await conn.fetchone(
+        "SELECT * FROM subscriptions.subscriptions WHERE id = ?", (subscription_id,)
+    )
+    if not row:
+        return None
+    previous = Subscription.from_row(row)
+    now = datetime.now()
+    result = await conn.execute(
         """
         UPDATE subscriptions.subscriptions 
         SET status = ?, canceled_at = ?, updated_at = ?
-        WHERE id = ?
+        WHERE id = ? AND status = ?
         """,
-        (status, canceled_at, datetime.now(), subscription_id),
+        (status, canceled_at, now, subscription_id, previous.status),
     )
-    return await get_subscription(subscription_id)
+    if result.rowcount == 0:
+        return None
+    delta = int(status in LIVE_STATUSES) - int(previous.status in LIVE_STATUSES)
+    if delta:
+        await _adjust_plan_counter(conn, previous.plan_id, delta)
+    if status != previous.status:
+        await _adjust_plan_stats(conn, previous.plan_id, {previous.status: -1, status: 1})
+    if status not in LIVE_STATUSES:
+        await conn.execute(
+            "DELETE FROM subscriptions.dunning_queue WHERE subscription_id = ?",
+            (subscription_id,),
+        )
+    subscription = previous.copy(
+        update={"status": status, "canceled_at": canceled_at, "updated_at": now}
+    )
+    if status in STATUS_EVENTS and status != previous.status:
+        await enqueue_webhook_events(
+            conn, [(subscription.plan_id, STATUS_EVENTS[status], {"subscription": subscription})]
+        )
+    return subscription
+
+
+@observe_crud
+async def update_subscription_status(
+    subscription_id: str, status: str, canceled_at: Optional[datetime] = None
+) -> Optional[Subscription]:
+    async with db.connect() as conn:
+        subscription = await _transition_subscription(
+            conn, subscription_id, status, canceled_at
+        )
+    if not subscription:
+        # Missing, or raced with another writer: report what is stored now
+        return await get_subscription(subscription_id)
+    wallet_stats_cache.invalidate(subscription.wallet)
+    return subscription
 
 
+@observe_crud
 async def cancel_subscription(subscription_id: str, at_period_end: bool = True) -> Optional[Subscription]:
     if at_period_end:
-        await db.execute(
+        row = await _update_returning(
             """
             UPDATE subscriptions.subscriptions 
             SET cancel_at_period_end = ?, updated_at = ?
             WHERE id = ?
             """,
             (True, datetime.now(), subscription_id),
+            "subscriptions",
+            subscription_id,
         )
+        subscription = Subscription.from_row(row) if row else None
     else:
-        await db.execute(
+        async with db.connect() as conn:
+            subscription = await _transition_subscription(
+                conn, subscription_id, "canceled", canceled_at=datetime.now()
+            )
+        if not subscription:
+            return await get_subscription(subscription_id)
+    
+    if subscription:
+        wallet_stats_cache.invalidate(subscription.wallet)
+    return subscription
+
+
+@observe_crud
+async def delete_subscription(subscription_id: str) -> None:
+    """
+    Delete a subscription and its payments, releasing its plan slot. A
+    subscription.deleted event follows any event already queued for it, such
+    as the subscription.created of a signup rolled back here.
+    """
+    async with db.connect() as conn:
+        row = await conn.fetchone(
+            "SELECT * FROM subscriptions.subscriptions WHERE id = ?", (subscription_id,)
+        )
+        if not row:
+            return
+        # Its payments leave plan_stats along with it
+        now = datetime.now()
+        totals = await conn.fetchall(
             """
-            UPDATE subscriptions.subscriptions 
-            SET status = ?, canceled_at = ?, updated_at = ?
-            WHERE id = ?
+            SELECT status, COUNT(*) AS payments, SUM(amount) AS amount,
+                SUM(CASE WHEN payment_date >= ? THEN amount ELSE 0 END) AS month_amount
+            FROM (
+                SELECT status, amount, payment_date FROM subscriptions.payments
+                WHERE subscription_id = ?
+                UNION ALL
+                SELECT status, amount, payment_date FROM subscriptions.payments_archive
+                WHERE subscription_id = ?
+            ) AS p
+            WHERE status IN ('paid', 'failed')
+            GROUP BY status
             """,
-            ("canceled", datetime.now(), datetime.now(), subscription_id),
+            (_month_start(now), subscription_id, subscription_id),
         )
-    
-    return await get_subscription(subscription_id)
+        paid = next((t for t in totals if t["status"] == "paid"), None)
+        failed = next((t for t in totals if t["status"] == "failed"), None)
+        await _adjust_plan_stats(
+            conn,
+            row["plan_id"],
+            {row["status"]: -1},
+            paid=-paid["payments"] if paid else 0,
+            failed=-failed["payments"] if failed else 0,
+            revenue=-paid["amount"] if paid else 0,
+            month_revenue=-paid["month_amount"] if paid else 0,
+            paid_at=now,
+        )
+        await conn.execute(
+            "DELETE FROM subscriptions.payments WHERE subscription_id = ?",
+            (subscription_id,),
+        )
+        await conn.execute(
+            "DELETE FROM subscriptions.payments_archive WHERE subscription_id = ?",
+            (subscription_id,),
+        )
+        await conn.execute(
+            "DELETE FROM subscriptions.dunning_queue WHERE subscription_id = ?",
+            (subscription_id,),
+        )
+        await conn.execute(
+            "DELETE FROM subscriptions.subscriptions WHERE id = ?", (subscription_id,)
+        )
+        if row["status"] in LIVE_STATUSES:
+            await _adjust_plan_counter(conn, row["plan_id"], -1)
+        await enqueue_webhook_events(
+            conn,
+            [
+                (
+                    row["plan_id"],
+                    "subscription.deleted",
+                    {"subscription": Subscription.from_row(row)},
+                )
+            ],
+        )
+    wallet_stats_cache.invalidate(row["wallet"])
+
+
+# Payments an invoice settlement has already been recorded for
+SETTLED_STATUSES = ("paid", "refund_due")
+
+
+async def _settle_payment(
+    conn: Connection, payment_hash: str, previous: str
+) -> Optional[SubscriptionPayment]:
+    """Mark the payment paid if its status is still `previous`."""
+    query = """
+        UPDATE subscriptions.payments
+        SET status = 'paid', payment_date = ?, failure_reason = NULL
+        WHERE payment_hash = ? AND status = ?
+    """
+    values = (datetime.now(), payment_hash, previous)
+    if RETURNING_SUPPORTED:
+        row = await conn.fetchone(f"{query} RETURNING *", values)
+        return SubscriptionPayment.from_row(row) if row else None
+    result = await conn.execute(query, values)
+    if result.rowcount == 0:
+        return None
+    return await get_payment_by_hash(payment_hash, conn=conn)
 
 
 # Subscription Payments CRUD
+@observe_crud
 async def create_subscription_payment(
     subscription_id: str, payment_hash: str, amount: int, period_start: datetime, period_end: datetime
 ) -> SubscriptionPayment:
@@ -251,52 +860,1298 @@ async def create_subscription_payment(
         (payment_id, subscription_id, payment_hash, amount, "pending", period_start, period_end, now),
     )
     
-    payment = await get_subscription_payment(payment_id)
-    assert payment, "Newly created payment couldn't be retrieved"
-    return payment
+    return SubscriptionPayment(
+        id=payment_id,
+        subscription_id=subscription_id,
+        payment_hash=payment_hash,
+        amount=amount,
+        status="pending",
+        period_start=period_start,
+        period_end=period_end,
+        payment_date=None,
+        failure_reason=None,
+        created_at=now,
+    )
 
 
-async def get_subscription_payment(payment_id: str) -> Optional[SubscriptionPayment]:
-    row = await db.fetchone(
+@observe_crud
+async def get_subscription_payment(
+    payment_id: str, conn: Optional[Connection] = None
+) -> Optional[SubscriptionPayment]:
+    row = await (conn or db).fetchone(
         "SELECT * FROM subscriptions.payments WHERE id = ?", (payment_id,)
     )
     return SubscriptionPayment.from_row(row) if row else None
 
 
-async def get_subscription_payments(subscription_id: str) -> List[SubscriptionPayment]:
+PAYMENT_FIELDS = (
+    "id, subscription_id, payment_hash, amount, status, period_start, period_end, "
+    "payment_date, failure_reason, created_at"
+)
+
+# Payments final for good; they move to payments_archive past the horizon
+ARCHIVABLE_STATUSES = ("paid", "failed", "expired")
+
+
+def _payment_tables(include_archive: bool) -> List[str]:
+    tables = ["subscriptions.payments"]
+    if include_archive:
+        tables.append("subscriptions.payments_archive")
+    return tables
+
+
+def _union_pages(branches: List[str], order: str, limit: Optional[int]) -> str:
+    """
+    Combine per-table SELECTs into one ordered query. With a limit, each
+    branch is cut to its own top rows first so it can stop early on its index.
+    """
+    if len(branches) == 1:
+        return f"{branches[0]} ORDER BY {order}{' LIMIT ?' if limit else ''}"
+    if limit:
+        branches = [
+            f"SELECT * FROM ({branch} ORDER BY {order} LIMIT ?) AS part{i}"
+            for i, branch in enumerate(branches)
+        ]
+    union = " UNION ALL ".join(branches)
+    return f"{union} ORDER BY {order}{' LIMIT ?' if limit else ''}"
+
+
+@observe_crud
+async def get_subscription_payments(
+    subscription_id: str,
+    limit: Optional[int] = None,
+    cursor: Optional[str] = None,
+    status: Optional[str] = None,
+    created_after: Optional[datetime] = None,
+    created_before: Optional[datetime] = None,
+    include_archive: bool = False,
+) -> List[SubscriptionPayment]:
+    """
+    Get a subscription's payments newest first. Archived payments are only
+    read when `include_archive` is set.
+    """
+    filters, values = _list_filters(cursor, status, created_after, created_before)
+    tables = _payment_tables(include_archive)
+    branches = [
+        f"SELECT {PAYMENT_FIELDS} FROM {table} WHERE subscription_id = ?{filters}"
+        for table in tables
+    ]
+    branch_values = [subscription_id, *values, *([limit] if limit and len(tables) > 1 else [])]
     rows = await db.fetchall(
-        "SELECT * FROM subscriptions.payments WHERE subscription_id = ? ORDER BY created_at DESC",
-        (subscription_id,),
+        _union_pages(branches, "created_at DESC, id DESC", limit),
+        (*branch_values * len(tables), *([limit] if limit else [])),
     )
     return [SubscriptionPayment.from_row(row) for row in rows]
 
 
+@observe_crud
+async def get_wallet_payments_page(
+    wallet_id: str,
+    limit: int,
+    after: Optional[Tuple[datetime, str]] = None,
+    status: Optional[str] = None,
+    created_after: Optional[datetime] = None,
+    created_before: Optional[datetime] = None,
+    include_archive: bool = False,
+) -> List[PaymentLedgerEntry]:
+    """
+    Get one oldest-first page of a wallet's payment ledger, joined with the
+    subscription and plan of each payment. Pass the (created_at, id) of the
+    last row already seen as `after` to continue from it. Archived payments
+    are only read when `include_archive` is set.
+    """
+    clauses = []
+    values: list = [wallet_id]
+    if status:
+        clauses.append("p.status = ?")
+        values.append(status)
+    if created_after:
+        clauses.append("p.created_at >= ?")
+        values.append(created_after)
+    if created_before:
+        clauses.append("p.created_at < ?")
+        values.append(created_before)
+    if after:
+        clauses.append("(p.created_at > ? OR (p.created_at = ? AND p.id > ?))")
+        values += [after[0], after[0], after[1]]
+    filters = "".join(f" AND {clause}" for clause in clauses)
+    tables = _payment_tables(include_archive)
+    branches = [
+        f"""
+        SELECT p.id, p.subscription_id, p.payment_hash, p.amount, p.status,
+               p.period_start, p.period_end, p.payment_date, p.failure_reason,
+               p.created_at, s.plan_id, pl.name AS plan_name, pl.interval,
+               s.subscriber_email, s.subscriber_name
+        FROM {table} p
+        JOIN subscriptions.subscriptions s ON s.id = p.subscription_id
+        JOIN subscriptions.plans pl ON pl.id = s.plan_id
+        WHERE s.wallet = ?{filters}
+        """
+        for table in tables
+    ]
+    branch_values = [*values, *([limit] if len(tables) > 1 else [])]
+    rows = await db.fetchall(
+        _union_pages(branches, "created_at, id", limit),
+        (*branch_values * len(tables), limit),
+    )
+    return [PaymentLedgerEntry.from_row(row) for row in rows]
+
+
+@observe_crud
+async def archive_payments(before: datetime, limit: int = 1000) -> int:
+    """
+    Move up to `limit` final payments created before `before` into
+    payments_archive in one transaction, returning how many moved. Archived
+    rows leave the selection, so callers repeat until fewer than `limit` move.
+    """
+    final = _placeholders(list(ARCHIVABLE_STATUSES))
+    async with db.connect() as conn:
+        rows = await conn.fetchall(
+            f"""
+            SELECT id FROM subscriptions.payments
+            WHERE status IN ({final}) AND created_at < ?
+            ORDER BY created_at
+            LIMIT ?
+            """,
+            (*ARCHIVABLE_STATUSES, before, limit),
+        )
+        ids = [row["id"] for row in rows]
+        if not ids:
+            return 0
+        await conn.execute(
+            f"""
+            INSERT INTO subscriptions.payments_archive ({PAYMENT_FIELDS}, archived_at)
+            SELECT {PAYMENT_FIELDS}, ? FROM subscriptions.payments
+            WHERE id IN ({_placeholders(ids)})
+            """,
+            (datetime.now(), *ids),
+        )
+        await conn.execute(
+            f"DELETE FROM subscriptions.payments WHERE id IN ({_placeholders(ids)})",
+            tuple(ids),
+        )
+    return len(ids)
+
+
+@observe_crud
+async def get_payment_by_hash(
+    payment_hash: str, conn: Optional[Connection] = None
+) -> Optional[SubscriptionPayment]:
+    row = await (conn or db).fetchone(
+        "SELECT * FROM subscriptions.payments WHERE payment_hash = ?", (payment_hash,)
+    )
+    return SubscriptionPayment.from_row(row) if row else None
+
+
+@observe_crud
 async def update_payment_status(
-    payment_id: str, status: str, failure_reason: Optional[str] = None
+    payment_id: str,
+    status: str,
+    failure_reason: Optional[str] = None,
+    conn: Optional[Connection] = None,
 ) -> Optional[SubscriptionPayment]:
+    if conn is None:
+        # The payment_failed webhook must commit together with the update
+        async with db.connect() as conn:
+            return await update_payment_status(payment_id, status, failure_reason, conn=conn)
+
     payment_date = datetime.now() if status == "paid" else None
+    previous = await get_subscription_payment(payment_id, conn=conn)
     
-    await db.execute(
+    row = await _update_returning(
         """
         UPDATE subscriptions.payments 
         SET status = ?, payment_date = ?, failure_reason = ?
         WHERE id = ?
         """,
         (status, payment_date, failure_reason, payment_id),
+        "payments",
+        payment_id,
+        conn=conn,
+    )
+    if not row:
+        return None
+    payment = SubscriptionPayment.from_row(row)
+    subscription = await get_subscription(payment.subscription_id, conn=conn)
+    if subscription and previous and previous.status != status:
+        moved = {previous.status: -1, status: 1}
+        revenue = moved.get("paid", 0) * payment.amount
+        # Un-paying only takes revenue out of this month if it was paid this month
+        this_month = previous.status != "paid" or (
+            previous.payment_date is not None
+            and _month_start(previous.payment_date) == _month_start(datetime.now())
+        )
+        await _adjust_plan_stats(
+            conn,
+            subscription.plan_id,
+            paid=moved.get("paid", 0),
+            failed=moved.get("failed", 0),
+            revenue=revenue,
+            month_revenue=revenue if this_month else 0,
+        )
+    if status == "failed":
+        if subscription:
+            await enqueue_webhook_events(
+                conn,
+                [
+                    (
+                        subscription.plan_id,
+                        "subscription.payment_failed",
+                        {"subscription": subscription, "payment": payment},
+                    )
+                ],
+            )
+    return payment
+
+
+@observe_crud
+async def activate_subscription(
+    subscription_id: str,
+    payment_id: str,
+    payment_date: datetime,
+    conn: Optional[Connection] = None,
+) -> Optional[Subscription]:
+    """Mark a subscription active after one of its invoices was paid."""
+    if conn is None:
+        async with db.connect() as conn:
+            return await activate_subscription(subscription_id, payment_id, payment_date, conn)
+
+    previous = await conn.fetchone(
+        "SELECT status FROM subscriptions.subscriptions WHERE id = ?", (subscription_id,)
+    )
+    row = await _update_returning(
+        """
+        UPDATE subscriptions.subscriptions
+        SET status = 'active', last_payment_id = ?, last_payment_date = ?,
+            failed_payment_count = 0, updated_at = ?
+        WHERE id = ? AND status != 'canceled'
+        """,
+        (payment_id, payment_date, datetime.now(), subscription_id),
+        "subscriptions",
+        subscription_id,
+        conn=conn,
+    )
+    if not row:
+        return None
+    subscription = Subscription.from_row(row)
+    if previous and previous["status"] != "active":
+        await _adjust_plan_stats(conn, subscription.plan_id, {previous["status"]: -1, "active": 1})
+    return subscription
+
+
+@observe_crud
+async def settle_subscription_payment(payment_hash: str) -> Optional[SubscriptionPayment]:
+    """
+    Mark the payment for `payment_hash` paid and activate its subscription in
+    one transaction. Returns None if the hash is unknown or already settled.
+
+    A pending invoice is settled with one update on the unique payment_hash
+    index; only unknown, settled or lapsed (failed, expired) hashes cost an
+    extra lookup. A payment whose subscription was canceled before it
+    settled, e.g. an invoice paid after it expired, is marked refund_due
+    instead: it is not counted as revenue and the plan gets a
+    subscription.payment_refund_due event so the merchant can pay it back.
+    """
+    async with db.connect() as conn:
+        previous = "pending"
+        payment = await _settle_payment(conn, payment_hash, previous)
+        if not payment:
+            row = await conn.fetchone(
+                "SELECT status FROM subscriptions.payments WHERE payment_hash = ?",
+                (payment_hash,),
+            )
+            if not row or row["status"] in SETTLED_STATUSES:
+                return None
+            previous = row["status"]
+            payment = await _settle_payment(conn, payment_hash, previous)
+            if not payment:
+                return None
+        subscription = await activate_subscription(
+            payment.subscription_id, payment.id, payment.payment_date, conn=conn
+        )
+        event = "subscription.payment_succeeded"
+        if not subscription:
+            await conn.execute(
+                """
+                UPDATE subscriptions.payments SET status = 'refund_due', failure_reason = ?
+                WHERE id = ?
+                """,
+                ("Paid after the subscription was canceled", payment.id),
+            )
+            payment = await get_payment_by_hash(payment_hash, conn=conn)
+            subscription = await get_subscription(payment.subscription_id, conn=conn)
+            event = "subscription.payment_refund_due"
+        if subscription:
+            await _adjust_plan_stats(
+                conn,
+                subscription.plan_id,
+                paid=1 if payment.status == "paid" else 0,
+                failed=-1 if previous == "failed" else 0,
+                revenue=payment.amount if payment.status == "paid" else 0,
+                paid_at=payment.payment_date,
+            )
+        await conn.execute(
+            "DELETE FROM subscriptions.dunning_queue WHERE subscription_id = ?",
+            (payment.subscription_id,),
+        )
+        if subscription:
+            await enqueue_webhook_events(
+                conn,
+                [
+                    (
+                        subscription.plan_id,
+                        event,
+                        {"subscription": subscription, "payment": payment},
+                    )
+                ],
+            )
+    return payment
+
+
+@observe_crud
+async def get_due_subscriptions(
+    limit: int = 500,
+    after: Optional[Tuple[datetime, str]] = None,
+    now: Optional[datetime] = None,
+    id_range: Optional[IdRange] = None,
+) -> List[DueSubscription]:
+    """
+    Get one page of subscriptions that are due for payment.
+
+    Pages are keyset-ordered on (next_payment_date, id); pass the key of the
+    last row of the previous page as `after` to fetch the next one.
+    `id_range` restricts the page to one shard of the subscription ids.
+    Trials whose trial_end passed are included so they get their first
+    invoice. Subscriptions with an unpaid renewal are left to dunning until it
+    resolves, and those set to cancel at period end are never billed again.
+    """
+    now = now or datetime.now()
+    keyset = ""
+    values: list = [now, now, False]
+    if after:
+        keyset = "AND (s.next_payment_date > ? OR (s.next_payment_date = ? AND s.id > ?))"
+        values += [after[0], after[0], after[1]]
+    shard, shard_values = _id_range_filter("s.id", id_range)
+    rows = await db.fetchall(
+        f"""
+        SELECT s.id, s.plan_id, s.wallet, s.status, s.current_period_end, s.next_payment_date,
+               s.billing_anchor, p.amount, p.interval, p.name AS plan_name, p.dunning_schedule
+        FROM subscriptions.subscriptions s
+        JOIN subscriptions.plans p ON p.id = s.plan_id
+        WHERE s.status IN ('active', 'trialing')
+        AND s.next_payment_date <= ?
+        AND (s.canceled_at IS NULL OR s.canceled_at > ?)
+        AND s.cancel_at_period_end = ?
+        AND NOT EXISTS (
+            SELECT 1 FROM subscriptions.dunning_queue d WHERE d.subscription_id = s.id
+        )
+        {keyset}
+        {shard}
+        ORDER BY s.next_payment_date, s.id
+        LIMIT ?
+        """,
+        (*values, *shard_values, limit),
+    )
+    return [DueSubscription.from_row(row) for row in rows]
+
+
+@observe_crud
+async def apply_renewals(
+    renewals: List[Tuple[DueSubscription, str, datetime, datetime]]
+) -> int:
+    """
+    Record a chunk of renewal invoices and advance their subscriptions.
+
+    Each renewal is (subscription, payment_hash, period_start, period_end). All
+    writes happen in one transaction; a subscription whose next_payment_date
+    moved since it was read is skipped so it is never billed twice. Every new
+    invoice is queued for dunning at the first step of its plan's schedule.
+    Trialing subscriptions billed here for their first period become active.
+    """
+    if not renewals:
+        return 0
+
+    now = datetime.now()
+    payments = []
+    trials = []
+    dunning = []
+    renewed = []
+    async with db.connect() as conn:
+        for subscription, payment_hash, period_start, period_end in renewals:
+            result = await conn.execute(
+                """
+                UPDATE subscriptions.subscriptions
+                SET current_period_start = ?, current_period_end = ?,
+                    next_payment_date = ?, updated_at = ?
+                WHERE id = ? AND next_payment_date = ?
+                """,
+                (
+                    period_start,
+                    period_end,
+                    period_end,
+                    now,
+                    subscription.id,
+                    subscription.next_payment_date,
+                ),
+            )
+            if result.rowcount == 0:
+                continue
+            payment = (
+                urlsafe_short_hash(),
+                subscription.id,
+                payment_hash,
+                subscription.amount,
+                "pending",
+                period_start,
+                period_end,
+                now,
+            )
+            payments.append(payment)
+            if subscription.status == "trialing":
+                trials.append(subscription)
+            dunning.append(
+                (
+                    subscription.id,
+                    payment[0],
+                    0,
+                    now,
+                    now + timedelta(days=subscription.dunning_schedule[0]),
+                    now,
+                )
+            )
+            renewed.append((subscription, payment))
+
+        if trials:
+            trial_ids = [subscription.id for subscription in trials]
+            activated = await _update_ids(
+                conn,
+                f"""
+                UPDATE subscriptions.subscriptions SET status = 'active'
+                WHERE id IN ({_placeholders(trial_ids)}) AND status = 'trialing'
+                """,
+                tuple(trial_ids),
+                trial_ids,
+            )
+            converted: Dict[str, int] = {}
+            for subscription in trials:
+                if subscription.id in activated:
+                    converted[subscription.plan_id] = converted.get(subscription.plan_id, 0) + 1
+            for plan_id, count in converted.items():
+                await _adjust_plan_stats(conn, plan_id, {"trialing": -count, "active": count})
+        await _insert_rows(conn, "payments", PAYMENT_COLUMNS, payments)
+        await _insert_rows(conn, "dunning_queue", DUNNING_COLUMNS, dunning)
+
+        # Events carry the advanced rows, in the same shape as every other event
+        if renewed:
+            ids = [subscription.id for subscription, _ in renewed]
+            current = {
+                row["id"]: Subscription.from_row(row)
+                for row in await conn.fetchall(
+                    f"SELECT * FROM subscriptions.subscriptions WHERE id IN ({_placeholders(ids)})",
+                    tuple(ids),
+                )
+            }
+            await enqueue_webhook_events(
+                conn,
+                [
+                    (
+                        subscription.plan_id,
+                        "subscription.trial_ended"
+                        if subscription.status == "trialing"
+                        else "subscription.renewed",
+                        {
+                            "subscription": current[subscription.id],
+                            "payment": dict(zip(PAYMENT_COLUMNS, payment)),
+                        },
+                    )
+                    for subscription, payment in renewed
+                ],
+            )
+
+    return len(payments)
+
+
+@observe_crud
+async def finalize_scheduled_cancellations(
+    limit: int = 500, now: Optional[datetime] = None
+) -> int:
+    """
+    Cancel up to `limit` subscriptions flagged cancel_at_period_end whose
+    period has ended, returning how many were canceled.
+
+    The whole batch is moved with one UPDATE and plan slots are released with
+    one statement per plan, in one transaction. Canceled rows leave the
+    selection, so callers repeat until fewer than `limit` are returned.
+    """
+    now = now or datetime.now()
+    live = _placeholders(list(LIVE_STATUSES))
+    async with db.connect() as conn:
+        rows = await conn.fetchall(
+            f"""
+            SELECT id, status FROM subscriptions.subscriptions
+            WHERE cancel_at_period_end = ? AND current_period_end <= ?
+            AND status IN ({live})
+            ORDER BY current_period_end, id
+            LIMIT ?
+            """,
+            (True, now, *LIVE_STATUSES, limit),
+        )
+        ids = [row["id"] for row in rows]
+        previous = {row["id"]: row["status"] for row in rows}
+        if not ids:
+            return 0
+
+        query = f"""
+            UPDATE subscriptions.subscriptions
+            SET status = 'canceled', canceled_at = current_period_end, updated_at = ?
+            WHERE id IN ({_placeholders(ids)}) AND status IN ({live})
+            """
+        values = (now, *ids, *LIVE_STATUSES)
+        if RETURNING_SUPPORTED:
+            rows = await conn.fetchall(f"{query} RETURNING *", values)
+        else:
+            await conn.execute(query, values)
+            rows = await conn.fetchall(
+                f"SELECT * FROM subscriptions.subscriptions WHERE id IN ({_placeholders(ids)})",
+                tuple(ids),
+            )
+        canceled = [Subscription.from_row(row) for row in rows]
+
+        await conn.execute(
+            f"DELETE FROM subscriptions.dunning_queue WHERE subscription_id IN ({_placeholders(ids)})",
+            tuple(ids),
+        )
+        await _release_canceled(conn, canceled, previous)
+
+    for wallet in {subscription.wallet for subscription in canceled}:
+        wallet_stats_cache.invalidate(wallet)
+    return len(ids)
+
+
+async def _release_canceled(
+    conn: Connection, canceled: List[Subscription], previous: Dict[str, str]
+) -> None:
+    """
+    Release the plan slots and move the plan_stats counts of subscriptions
+    just canceled from their `previous` statuses, and queue canceled events.
+    """
+    released: Dict[str, int] = {}
+    moved: Dict[str, Dict[str, int]] = {}
+    for subscription in canceled:
+        released[subscription.plan_id] = released.get(subscription.plan_id, 0) + 1
+        statuses = moved.setdefault(subscription.plan_id, {"canceled": 0})
+        status = previous[subscription.id]
+        statuses[status] = statuses.get(status, 0) - 1
+        statuses["canceled"] += 1
+    for plan_id, count in released.items():
+        await _adjust_plan_counter(conn, plan_id, -count)
+        await _adjust_plan_stats(conn, plan_id, moved[plan_id])
+    await enqueue_webhook_events(
+        conn,
+        [
+            (subscription.plan_id, STATUS_EVENTS["canceled"], {"subscription": subscription})
+            for subscription in canceled
+        ],
+    )
+
+
+@observe_crud
+async def expire_pending_payments(
+    cutoff: datetime, limit: int = 500, now: Optional[datetime] = None
+) -> Tuple[int, int]:
+    """
+    Mark up to `limit` pending payments created before `cutoff` expired and
+    cancel the never-activated subscriptions they were opening, releasing
+    their plan slots. Returns (payments expired, subscriptions canceled).
+
+    Renewal invoices are left to dunning. Expired rows leave the selection,
+    so callers repeat until fewer than `limit` payments are returned.
+    """
+    now = now or datetime.now()
+    async with db.connect() as conn:
+        rows = await conn.fetchall(
+            """
+            SELECT p.id, p.subscription_id FROM subscriptions.payments p
+            WHERE p.status = 'pending' AND p.created_at < ?
+            AND NOT EXISTS (
+                SELECT 1 FROM subscriptions.dunning_queue d
+                WHERE d.subscription_id = p.subscription_id AND d.payment_id = p.id
+            )
+            ORDER BY p.created_at
+            LIMIT ?
+            """,
+            (cutoff, limit),
+        )
+        if not rows:
+            return 0, 0
+        payment_ids = [row["id"] for row in rows]
+        await conn.execute(
+            f"""
+            UPDATE subscriptions.payments SET status = 'expired', failure_reason = ?
+            WHERE id IN ({_placeholders(payment_ids)}) AND status = 'pending'
+            """,
+            ("Invoice expired", *payment_ids),
+        )
+
+        # Only subscriptions that were never paid for are closed; one whose
+        # later invoice expired keeps the periods it already paid for
+        ids = list({row["subscription_id"] for row in rows})
+        query = f"""
+            UPDATE subscriptions.subscriptions
+            SET status = 'canceled', canceled_at = ?, updated_at = ?
+            WHERE id IN ({_placeholders(ids)}) AND status = 'active'
+            AND last_payment_id IS NULL
+            """
+        values = (now, now, *ids)
+        if RETURNING_SUPPORTED:
+            canceled_rows = await conn.fetchall(f"{query} RETURNING *", values)
+        else:
+            await conn.execute(query, values)
+            canceled_rows = await conn.fetchall(
+                f"""
+                SELECT * FROM subscriptions.subscriptions
+                WHERE id IN ({_placeholders(ids)}) AND status = 'canceled' AND canceled_at = ?
+                """,
+                (*ids, now),
+            )
+        canceled = [Subscription.from_row(row) for row in canceled_rows]
+        await _release_canceled(
+            conn, canceled, {subscription.id: "active" for subscription in canceled}
+        )
+
+    for wallet in {subscription.wallet for subscription in canceled}:
+        wallet_stats_cache.invalidate(wallet)
+    return len(payment_ids), len(canceled)
+
+
+# Bound parameters per multi-row INSERT, under SQLite's default limit of 999
+INSERT_MAX_PARAMS = 900
+
+PAYMENT_COLUMNS = (
+    "id", "subscription_id", "payment_hash", "amount", "status",
+    "period_start", "period_end", "created_at",
+)
+
+DUNNING_COLUMNS = (
+    "subscription_id", "payment_id", "attempt", "due_at", "next_attempt_at", "created_at",
+)
+
+
+async def _insert_rows(
+    conn: Connection, table: str, columns: Tuple[str, ...], rows: List[tuple]
+) -> None:
+    """Insert rows with as few multi-row INSERT statements as the backend allows."""
+    per_statement = max(1, INSERT_MAX_PARAMS // len(columns))
+    row_placeholders = f"({', '.join(['?'] * len(columns))})"
+    for i in range(0, len(rows), per_statement):
+        batch = rows[i : i + per_statement]
+        await conn.execute(
+            f"""
+            INSERT INTO subscriptions.{table} ({', '.join(columns)})
+            VALUES {', '.join([row_placeholders] * len(batch))}
+            """,
+            tuple(value for row in batch for value in row),
+        )
+
+
+@observe_crud
+async def get_wallet_stats(wallet_id: str) -> WalletStats:
+    """
+    Return per-plan status counts, normalised monthly revenue and churn for a
+    wallet, cached until the next write. Status counts come from plan_stats,
+    so only the wallet's plans and its recent cancellations are read.
+    """
+    cached = wallet_stats_cache.get(wallet_id)
+    if cached is not None:
+        return cached
+
+    churn_since = datetime.now() - timedelta(days=CHURN_WINDOW_DAYS)
+    rows = await db.fetchall(
+        """
+        SELECT p.id AS plan_id, p.name, p.interval, p.amount,
+            COALESCE(ps.active_count, 0) AS active,
+            COALESCE(ps.trialing_count, 0) AS trialing,
+            COALESCE(ps.past_due_count, 0) AS past_due
+        FROM subscriptions.plans p
+        LEFT JOIN subscriptions.plan_stats ps ON ps.plan_id = p.id
+        WHERE p.wallet = ?
+        """,
+        (wallet_id,),
     )
-    return await get_subscription_payment(payment_id)
+    canceled = {
+        row["plan_id"]: row["canceled"]
+        for row in await db.fetchall(
+            """
+            SELECT plan_id, COUNT(*) AS canceled FROM subscriptions.subscriptions
+            WHERE wallet = ? AND canceled_at >= ? AND status = 'canceled'
+            GROUP BY plan_id
+            """,
+            (wallet_id, churn_since),
+        )
+    }
+
+    plans = []
+    for row in rows:
+        plan = PlanStats(**dict(row), canceled_recently=canceled.get(row["plan_id"], 0))
+        plan.monthly_revenue = round(
+            plan.amount * MONTHLY_FACTORS.get(plan.interval, 0) * (plan.active + plan.trialing)
+        )
+        plans.append(plan)
+
+    live = sum(p.active + p.trialing + p.past_due for p in plans)
+    churned = sum(p.canceled_recently for p in plans)
+    stats = WalletStats(
+        total_plans=len(plans),
+        active_subscriptions=sum(p.active + p.trialing for p in plans),
+        monthly_revenue=sum(p.monthly_revenue for p in plans),
+        churn_rate=round(churned / (live + churned), 4) if live + churned else 0.0,
+        plans=plans,
+    )
+    wallet_stats_cache.set(wallet_id, stats)
+    return stats
+
+
+# Plan stats
+PLAN_COUNTER_FIELDS = (
+    "trialing_count", "active_count", "past_due_count", "canceled_count",
+    "paid_payments", "failed_payments", "revenue_total", "revenue_month",
+)
+
+
+@observe_crud
+async def get_plan_counters(plan_ids: List[str]) -> Dict[str, PlanCounters]:
+    """Read the plan_stats rows of `plan_ids` by primary key."""
+    if not plan_ids:
+        return {}
+    rows = await db.fetchall(
+        f"SELECT * FROM subscriptions.plan_stats WHERE plan_id IN ({_placeholders(plan_ids)})",
+        tuple(plan_ids),
+    )
+    month = _month_start(datetime.now())
+    counters = {}
+    for row in rows:
+        counter = PlanCounters.from_row(row)
+        if counter.revenue_month_start < month:
+            # Nothing was settled yet this month
+            counter = counter.copy(update={"revenue_month": 0, "revenue_month_start": month})
+        counters[counter.plan_id] = counter
+    return counters
+
+
+@observe_crud
+async def reconcile_plan_stats(fix: bool = True) -> List[str]:
+    """
+    Recompute every plan's counters from the subscriptions, payments and
+    payment archive tables, and return the ids of plans whose plan_stats row
+    drifted or was missing. With `fix`, those rows are rewritten.
+
+    Writes committed while the recount runs can make a plan look drifted;
+    the next pass settles it, so this is meant for a quiet periodic job.
+    """
+    month = _month_start(datetime.now())
+    async with db.connect() as conn:
+        expected = {
+            row["id"]: dict.fromkeys(PLAN_COUNTER_FIELDS, 0)
+            for row in await conn.fetchall("SELECT id FROM subscriptions.plans")
+        }
+        for row in await conn.fetchall(
+            """
+            SELECT plan_id, status, COUNT(*) AS subscriptions
+            FROM subscriptions.subscriptions GROUP BY plan_id, status
+            """
+        ):
+            column = STATUS_COUNT_COLUMNS.get(row["status"])
+            if column and row["plan_id"] in expected:
+                expected[row["plan_id"]][column] = row["subscriptions"]
+        for row in await conn.fetchall(
+            """
+            SELECT s.plan_id, p.status, COUNT(*) AS payments, SUM(p.amount) AS amount,
+                SUM(CASE WHEN p.payment_date >= ? THEN p.amount ELSE 0 END) AS month_amount
+            FROM (
+                SELECT subscription_id, status, amount, payment_date FROM subscriptions.payments
+                UNION ALL
+                SELECT subscription_id, status, amount, payment_date
+                FROM subscriptions.payments_archive
+            ) AS p
+            JOIN subscriptions.subscriptions s ON s.id = p.subscription_id
+            WHERE p.status IN ('paid', 'failed')
+            GROUP BY s.plan_id, p.status
+            """,
+            (month,),
+        ):
+            counters = expected.get(row["plan_id"])
+            if counters is None:
+                continue
+            if row["status"] == "failed":
+                counters["failed_payments"] = row["payments"]
+            else:
+                counters["paid_payments"] = row["payments"]
+                counters["revenue_total"] = row["amount"] or 0
+                counters["revenue_month"] = row["month_amount"] or 0
+
+        stored = {
+            row["plan_id"]: row
+            for row in await conn.fetchall("SELECT * FROM subscriptions.plan_stats")
+        }
+        drifted = []
+        for plan_id, counters in expected.items():
+            row = stored.get(plan_id)
+            if row is not None:
+                current = {field: row[field] for field in PLAN_COUNTER_FIELDS}
+                if PlanCounters.from_row(row).revenue_month_start < month:
+                    current["revenue_month"] = 0
+                if current == counters:
+                    continue
+            drifted.append(plan_id)
+            if not fix:
+                continue
+            await conn.execute(
+                "DELETE FROM subscriptions.plan_stats WHERE plan_id = ?", (plan_id,)
+            )
+            await conn.execute(
+                f"""
+                INSERT INTO subscriptions.plan_stats
+                (plan_id, {", ".join(PLAN_COUNTER_FIELDS)}, revenue_month_start, updated_at)
+                VALUES (?, {_placeholders(list(PLAN_COUNTER_FIELDS))}, ?, ?)
+                """,
+                (plan_id, *counters.values(), month, datetime.now()),
+            )
+    return drifted
+
+
+# Dunning
+def _placeholders(values: list) -> str:
+    return ", ".join(["?"] * len(values))
 
 
-async def get_due_subscriptions() -> List[Subscription]:
-    """Get all subscriptions that are due for payment."""
+@observe_crud
+async def get_due_dunning(
+    limit: int = 500,
+    after: Optional[Tuple[datetime, str]] = None,
+    now: Optional[datetime] = None,
+    id_range: Optional[IdRange] = None,
+) -> List[DunningEntry]:
+    """
+    Get one page of unpaid renewals whose next dunning check is due.
+
+    Pages are keyset-ordered on (next_attempt_at, subscription_id), so a tick
+    only reads the due head of the queue index. `id_range` restricts the page
+    to one shard of the subscription ids.
+    """
+    now = now or datetime.now()
+    keyset = ""
+    values: list = [now]
+    if after:
+        keyset = "AND (d.next_attempt_at > ? OR (d.next_attempt_at = ? AND d.subscription_id > ?))"
+        values += [after[0], after[0], after[1]]
+    shard, shard_values = _id_range_filter("d.subscription_id", id_range)
+    rows = await db.fetchall(
+        f"""
+        SELECT d.subscription_id, d.payment_id, d.attempt, d.due_at, d.next_attempt_at,
+               s.plan_id, s.wallet, s.status, pay.period_start, pay.period_end,
+               pay.amount, p.name AS plan_name, p.dunning_schedule
+        FROM subscriptions.dunning_queue d
+        JOIN subscriptions.subscriptions s ON s.id = d.subscription_id
+        JOIN subscriptions.plans p ON p.id = s.plan_id
+        JOIN subscriptions.payments pay ON pay.id = d.payment_id
+        WHERE d.next_attempt_at <= ?
+        {keyset}
+        {shard}
+        ORDER BY d.next_attempt_at, d.subscription_id
+        LIMIT ?
+        """,
+        (*values, *shard_values, limit),
+    )
+    return [DunningEntry.from_row(row) for row in rows]
+
+
+@observe_crud
+async def apply_dunning(
+    retries: List[Tuple[DunningEntry, str]], cancellations: List[DunningEntry]
+) -> int:
+    """
+    Apply one chunk of dunning checks with set-based statements in one
+    transaction, returning the number of subscriptions handled.
+
+    Every entry's outstanding invoice is marked failed and its subscription's
+    failed_payment_count incremented. Retries, given as (entry, payment_hash
+    of a fresh invoice), become past_due and are requeued at the next step of
+    their plan's schedule; cancellations are canceled and release their plan
+    slots. Entries whose invoice was paid, whose queue row was replaced, or
+    whose subscription changed status since they were read are skipped, and
+    slot and stats changes follow the rows actually updated.
+    """
+    entries = [entry for entry, _ in retries] + cancellations
+    if not entries:
+        return 0
+
+    now = datetime.now()
+    async with db.connect() as conn:
+        # Skip entries changed since they were read: paid, requeued, or with a
+        # subscription that moved to another status (e.g. canceled) meanwhile
+        ids = [entry.subscription_id for entry in entries]
+        rows = await conn.fetchall(
+            f"""
+            SELECT d.subscription_id, d.payment_id, s.status
+            FROM subscriptions.dunning_queue d
+            JOIN subscriptions.subscriptions s ON s.id = d.subscription_id
+            JOIN subscriptions.payments p ON p.id = d.payment_id
+            WHERE d.subscription_id IN ({_placeholders(ids)}) AND p.status = 'pending'
+            """,
+            tuple(ids),
+        )
+        current = {(row["subscription_id"], row["payment_id"]): row["status"] for row in rows}
+        unchanged = {
+            entry.subscription_id
+            for entry in entries
+            if current.get((entry.subscription_id, entry.payment_id)) == entry.status
+        }
+        payment_ids = [entry.payment_id for entry in entries if entry.subscription_id in unchanged]
+        if not payment_ids:
+            return 0
+        failed_ids = await _update_ids(
+            conn,
+            f"""
+            UPDATE subscriptions.payments SET status = 'failed', failure_reason = ?
+            WHERE id IN ({_placeholders(payment_ids)}) AND status = 'pending'
+            """,
+            ("Invoice unpaid", *payment_ids),
+            payment_ids,
+        )
+        retries = [(entry, h) for entry, h in retries if entry.payment_id in failed_ids]
+        cancellations = [entry for entry in cancellations if entry.payment_id in failed_ids]
+        entries = [entry for entry, _ in retries] + cancellations
+        if not entries:
+            return 0
+
+        ids = [entry.subscription_id for entry in entries]
+        payment_ids = [entry.payment_id for entry in entries]
+        await conn.execute(
+            f"""
+            UPDATE subscriptions.subscriptions
+            SET failed_payment_count = failed_payment_count + 1, updated_at = ?
+            WHERE id IN ({_placeholders(ids)})
+            """,
+            (now, *ids),
+        )
+        await conn.execute(
+            f"""
+            DELETE FROM subscriptions.dunning_queue
+            WHERE payment_id IN ({_placeholders(payment_ids)})
+            """,
+            tuple(payment_ids),
+        )
+
+        # Retries move active subscriptions to past_due and the rest are
+        # canceled, each only if the status is still the one read above
+        moved: Dict[str, Dict[str, int]] = {}
+        past_due = set()
+        retrying = set()
+        canceled = set()
+        for status in {entry.status for entry in entries}:
+            retry_ids = [e.subscription_id for e, _ in retries if e.status == status]
+            if retry_ids:
+                target = "past_due" if status == "active" else status
+                changed = await _update_ids(
+                    conn,
+                    f"""
+                    UPDATE subscriptions.subscriptions SET status = ?
+                    WHERE id IN ({_placeholders(retry_ids)}) AND status = ?
+                    """,
+                    (target, *retry_ids, status),
+                    retry_ids,
+                )
+                retrying |= changed
+                if target != status:
+                    past_due |= changed
+            cancel_ids = [e.subscription_id for e in cancellations if e.status == status]
+            if cancel_ids:
+                canceled |= await _update_ids(
+                    conn,
+                    f"""
+                    UPDATE subscriptions.subscriptions SET status = 'canceled', canceled_at = ?
+                    WHERE id IN ({_placeholders(cancel_ids)}) AND status = ?
+                    """,
+                    (now, *cancel_ids, status),
+                    cancel_ids,
+                )
+
+        failures: Dict[str, int] = {}
+        for entry in entries:
+            failures[entry.plan_id] = failures.get(entry.plan_id, 0) + 1
+            statuses = moved.setdefault(entry.plan_id, {})
+            if entry.subscription_id in past_due:
+                statuses[entry.status] = statuses.get(entry.status, 0) - 1
+                statuses["past_due"] = statuses.get("past_due", 0) + 1
+        for plan_id, count in failures.items():
+            await _adjust_plan_stats(conn, plan_id, moved[plan_id], failed=count)
+
+        retries = [(entry, h) for entry, h in retries if entry.subscription_id in retrying]
+        retry_payments = {}
+        if retries:
+            for entry, payment_hash in retries:
+                retry_payments[entry.subscription_id] = (
+                    urlsafe_short_hash(),
+                    entry.subscription_id,
+                    payment_hash,
+                    entry.amount,
+                    "pending",
+                    entry.period_start,
+                    entry.period_end,
+                    now,
+                )
+            await _insert_rows(
+                conn, "payments", PAYMENT_COLUMNS, list(retry_payments.values())
+            )
+            await _insert_rows(
+                conn,
+                "dunning_queue",
+                DUNNING_COLUMNS,
+                [
+                    (
+                        entry.subscription_id,
+                        retry_payments[entry.subscription_id][0],
+                        entry.attempt + 1,
+                        entry.due_at,
+                        entry.due_at + timedelta(days=entry.dunning_schedule[entry.attempt + 1]),
+                        now,
+                    )
+                    for entry, _ in retries
+                ],
+            )
+
+        subscriptions = {
+            row["id"]: Subscription.from_row(row)
+            for row in await conn.fetchall(
+                f"SELECT * FROM subscriptions.subscriptions WHERE id IN ({_placeholders(ids)})",
+                tuple(ids),
+            )
+        }
+        failed = {
+            row["id"]: SubscriptionPayment.from_row(row)
+            for row in await conn.fetchall(
+                f"SELECT * FROM subscriptions.payments WHERE id IN ({_placeholders(payment_ids)})",
+                tuple(payment_ids),
+            )
+        }
+        if canceled:
+            await _release_canceled(
+                conn,
+                [subscriptions[i] for i in canceled if i in subscriptions],
+                {entry.subscription_id: entry.status for entry in cancellations},
+            )
+        events = []
+        for entry in entries:
+            subscription = subscriptions.get(entry.subscription_id)
+            if not subscription:
+                continue
+            data = {"subscription": subscription, "payment": failed.get(entry.payment_id)}
+            if entry.subscription_id in retry_payments:
+                data["retry_payment"] = dict(
+                    zip(PAYMENT_COLUMNS, retry_payments[entry.subscription_id])
+                )
+            events.append((entry.plan_id, "subscription.payment_failed", data))
+            if entry.subscription_id in past_due:
+                events.append(
+                    (
+                        entry.plan_id,
+                        STATUS_EVENTS["past_due"],
+                        {"subscription": subscription},
+                    )
+                )
+        await enqueue_webhook_events(conn, events)
+
+    for wallet in {entry.wallet for entry in entries}:
+        wallet_stats_cache.invalidate(wallet)
+    return len(entries)
+
+
+# Webhook outbox
+WEBHOOK_COLUMNS = (
+    "id", "plan_id", "url", "event", "payload", "status", "attempts",
+    "next_attempt_at", "created_at",
+)
+
+
+def _json_default(value):
+    if isinstance(value, BaseModel):
+        return value.dict()
+    if hasattr(value, "isoformat"):
+        return value.isoformat()
+    return str(value)
+
+
+@observe_crud
+async def enqueue_webhook_events(
+    conn: Connection, events: List[Tuple[str, str, dict]]
+) -> None:
+    """
+    Write (plan_id, event, data) webhook events to the outbox using the
+    caller's connection, so they commit or roll back with the state change.
+    Events for plans without a webhook URL are dropped.
+    """
+    now = datetime.now()
+    rows = []
+    for plan_id, event, data in events:
+        plan = await get_subscription_plan(plan_id, conn=conn)
+        if not plan or not plan.webhook_url:
+            continue
+        event_id = urlsafe_short_hash()
+        payload = json.dumps(
+            {"id": event_id, "event": event, "created_at": now, **data},
+            default=_json_default,
+        )
+        rows.append(
+            (event_id, plan_id, plan.webhook_url, event, payload, "pending", 0, now, now)
+        )
+    await _insert_rows(conn, "webhook_outbox", WEBHOOK_COLUMNS, rows)
+
+
+@observe_crud
+async def claim_due_webhooks(limit: int, lease_seconds: int) -> List[WebhookEvent]:
+    """
+    Fetch up to `limit` due outbox events and push their next attempt past a
+    lease, so a crashed delivery is retried once the lease runs out.
+    """
     now = datetime.now()
     rows = await db.fetchall(
         """
-        SELECT * FROM subscriptions.subscriptions 
-        WHERE status IN ('active', 'past_due') 
-        AND next_payment_date <= ?
-        AND (canceled_at IS NULL OR canceled_at > ?)
+        SELECT * FROM subscriptions.webhook_outbox
+        WHERE status = 'pending' AND next_attempt_at <= ?
+        ORDER BY next_attempt_at
+        LIMIT ?
+        """,
+        (now, limit),
+    )
+    events = [WebhookEvent.from_row(row) for row in rows]
+    if events:
+        placeholders = ", ".join(["?"] * len(events))
+        await db.execute(
+            f"""
+            UPDATE subscriptions.webhook_outbox SET next_attempt_at = ?
+            WHERE id IN ({placeholders})
+            """,
+            (now + timedelta(seconds=lease_seconds), *[event.id for event in events]),
+        )
+    return events
+
+
+@observe_crud
+async def record_webhook_results(
+    delivered: List[str],
+    retries: List[Tuple[str, int, Optional[datetime], str]],
+) -> None:
+    """
+    Record one delivery round: `delivered` event ids, and failed attempts as
+    (id, attempts, next attempt or None to give up, error).
+    """
+    now = datetime.now()
+    async with db.connect() as conn:
+        if delivered:
+            placeholders = ", ".join(["?"] * len(delivered))
+            await conn.execute(
+                f"""
+                UPDATE subscriptions.webhook_outbox
+                SET status = 'delivered', attempts = attempts + 1, delivered_at = ?,
+                    last_error = NULL
+                WHERE id IN ({placeholders})
+                """,
+                (now, *delivered),
+            )
+        for event_id, attempts, next_attempt_at, error in retries:
+            await conn.execute(
+                """
+                UPDATE subscriptions.webhook_outbox
+                SET status = ?, attempts = ?, next_attempt_at = ?, last_error = ?
+                WHERE id = ?
+                """,
+                (
+                    "pending" if next_attempt_at else "failed",
+                    attempts,
+                    next_attempt_at or now,
+                    error[:500],
+                    event_id,
+                ),
+            )
+
+
+@observe_crud
+async def count_pending_webhooks() -> int:
+    row = await db.fetchone(
+        "SELECT COUNT(*) AS count FROM subscriptions.webhook_outbox WHERE status = 'pending'"
+    )
+    return row["count"] if row else 0
+
+
+@observe_crud
+async def get_queue_depths(now: Optional[datetime] = None) -> dict:
+    """Count the work currently due for each background job, in one round trip."""
+    now = now or datetime.now()
+    row = await db.fetchone(
+        f"""
+        SELECT
+            (SELECT COUNT(*) FROM subscriptions.subscriptions
+             WHERE status IN ('active', 'trialing') AND next_payment_date <= ?
+             AND cancel_at_period_end = ?) AS renewals,
+            (SELECT COUNT(*) FROM subscriptions.subscriptions
+             WHERE cancel_at_period_end = ? AND current_period_end <= ?
+             AND status IN ({_placeholders(list(LIVE_STATUSES))})) AS period_ends,
+            (SELECT COUNT(*) FROM subscriptions.dunning_queue
+             WHERE next_attempt_at <= ?) AS dunning,
+            (SELECT COUNT(*) FROM subscriptions.webhook_outbox
+             WHERE status = 'pending') AS webhooks
+        """,
+        (now, False, True, now, *LIVE_STATUSES, now),
+    )
+    return dict(row) if row else {}
+
+
+@observe_crud
+async def purge_delivered_webhooks(before: datetime) -> None:
+    await db.execute(
+        """
+        DELETE FROM subscriptions.webhook_outbox
+        WHERE status = 'delivered' AND delivered_at < ?
+        """,
+        (before,),
+    )
+
+
+# Job leases
+@observe_crud
+async def claim_job_lease(name: str, owner: str, lease_seconds: int) -> bool:
+    """
+    Take or extend the lease `name` for `owner` until `lease_seconds` from
+    now. It is granted when it is free, expired or already held by `owner`;
+    the conditional update makes concurrent claims settle on one winner.
+    """
+    now = datetime.now()
+    async with db.connect() as conn:
+        await conn.execute(
+            """
+            INSERT INTO subscriptions.job_leases (name, owner, expires_at)
+            VALUES (?, ?, ?)
+            ON CONFLICT (name) DO NOTHING
+            """,
+            (name, "", now),
+        )
+        result = await conn.execute(
+            """
+            UPDATE subscriptions.job_leases SET owner = ?, expires_at = ?
+            WHERE name = ? AND (owner = ? OR expires_at <= ?)
+            """,
+            (owner, now + timedelta(seconds=lease_seconds), name, owner, now),
+        )
+    return result.rowcount > 0
+
+
+@observe_crud
+async def release_job_lease(name: str, owner: str) -> None:
+    """Expire the lease `name` right away if `owner` still holds it."""
+    await db.execute(
+        """
+        UPDATE subscriptions.job_leases SET expires_at = ?
+        WHERE name = ? AND owner = ?
         """,
-        (now, now),
+        (datetime.now(), name, owner),
     )
-    return [Subscription.from_row(row) for row in rows] 
\ No newline at end of file
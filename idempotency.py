@@ -0,0 +1,103 @@
+"""Idempotency-Key handling for non-idempotent API calls."""
+
+import asyncio
+import hashlib
+import json
+from typing import Any, Awaitable, Callable, Dict, Tuple
+
+from .cache import TTLCache
+
+# How long a completed response is replayed for, and how many are kept
+IDEMPOTENCY_TTL_SECONDS = 24 * 3600
+IDEMPOTENCY_MAX_KEYS = 100_000
+IDEMPOTENCY_KEY_MAX_LENGTH = 255
+
+
+class IdempotencyConflict(Exception):
+    """The key was already used for a request with a different body."""
+
+
+def request_fingerprint(*parts: Any) -> str:
+    """Stable hash of the parts of a request that must match on replay."""
+    raw = json.dumps(parts, sort_keys=True, default=str).encode()
+    return hashlib.sha256(raw).hexdigest()
+
+
+class IdempotencyStore:
+    """
+    Remembers successful results per key and coalesces concurrent duplicates.
+
+    A repeated key returns the stored result without running the operation
+    again. A duplicate that arrives while the first call is still running
+    waits for that call instead of starting its own. Failures are not stored,
+    so a retry after an error runs the operation again. Results live in a
+    bounded TTL cache local to this process.
+    """
+
+    def __init__(
+        self, ttl: float = IDEMPOTENCY_TTL_SECONDS, max_size: int = IDEMPOTENCY_MAX_KEYS
+    ):
+        self.results = TTLCache(ttl=ttl, max_size=max_size)
+        self._in_flight: Dict[str, Tuple[str, asyncio.Future]] = {}
+        self.replays = 0
+        self.coalesced = 0
+
+    async def run(
+        self, key: str, fingerprint: str, operation: Callable[[], Awaitable[Any]]
+    ) -> Tuple[Any, bool]:
+        """
+        Run `operation` once per key. Returns (result, replayed).
+        Raises IdempotencyConflict if the key was used with another fingerprint.
+        """
+        stored = self.results.get(key)
+        if stored is not None:
+            self._check(key, fingerprint, stored[0])
+            self.replays += 1
+            return stored[1], True
+
+        in_flight = self._in_flight.get(key)
+        if in_flight is not None:
+            self._check(key, fingerprint, in_flight[0])
+            self.coalesced += 1
+            try:
+                return await asyncio.shield(in_flight[1]), True
+            except asyncio.CancelledError:
+                if not in_flight[1].cancelled():
+                    raise
+                # The first caller went away mid-operation: take over
+                return await self.run(key, fingerprint, operation)
+
+        future = asyncio.get_event_loop().create_future()
+        self._in_flight[key] = (fingerprint, future)
+        try:
+            result = await operation()
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            # Mark retrieved so a failure nobody else awaited isn't logged
+            future.exception()
+            raise
+        else:
+            self.results.set(key, (fingerprint, result))
+            future.set_result(result)
+            return result, False
+        finally:
+            self._in_flight.pop(key, None)
+
+    @staticmethod
+    def _check(key: str, fingerprint: str, expected: str) -> None:
+        if fingerprint != expected:
+            raise IdempotencyConflict(key)
+
+    def stats(self) -> dict:
+        return {
+            **self.results.stats(),
+            "in_flight": len(self._in_flight),
+            "replays": self.replays,
+            "coalesced": self.coalesced,
+        }
+
+
+idempotency_store = IdempotencyStore()
@@ -0,0 +1,292 @@
+"""Pluggable source of Lightning invoices and their paid events."""
+
+import asyncio
+import hashlib
+import math
+import os
+import random
+import time
+from abc import ABC, abstractmethod
+from typing import List, Optional
+
+from lnbits.core import services
+from lnbits.tasks import register_invoice_listener
+from loguru import logger
+
+from .metrics import invoice_queue_wait, invoice_shed, observe_invoice
+
+# Invoice issuing limits, shared by API requests and background sweeps
+INVOICE_WORKERS = int(os.getenv("SUBSCRIPTIONS_INVOICE_WORKERS", "32"))
+INVOICE_WALLET_WORKERS = int(os.getenv("SUBSCRIPTIONS_INVOICE_WALLET_WORKERS", "8"))
+INVOICE_QUEUE_SIZE = int(os.getenv("SUBSCRIPTIONS_INVOICE_QUEUE_SIZE", "256"))
+INVOICE_TIMEOUT_SECONDS = float(os.getenv("SUBSCRIPTIONS_INVOICE_TIMEOUT_SECONDS", "10"))
+# How long issued invoices can be paid; unpaid ones are reaped after this
+INVOICE_EXPIRY_SECONDS = int(os.getenv("SUBSCRIPTIONS_INVOICE_EXPIRY_SECONDS", "3600"))
+
+
+class Invoice:
+    """An issued invoice, and the paid event emitted for it by fake providers."""
+
+    def __init__(self, payment_hash: str, bolt11: str, amount: int, extra: Optional[dict] = None):
+        self.payment_hash = payment_hash
+        self.bolt11 = bolt11
+        self.amount = amount
+        self.extra = extra or {}
+
+
+class InvoiceError(Exception):
+    """The provider could not issue an invoice."""
+
+
+class InvoiceTimeout(InvoiceError):
+    """The provider did not issue the invoice within the issuer's timeout."""
+
+
+class InvoiceBackpressure(InvoiceError):
+    """Too many invoices are waiting to be issued; retry after `retry_after` seconds."""
+
+    def __init__(self, retry_after: int):
+        super().__init__(f"Invoice queue is full, retry in {retry_after}s")
+        self.retry_after = retry_after
+
+
+class InvoiceProvider(ABC):
+    @abstractmethod
+    async def create_invoice(
+        self, wallet_id: str, amount: int, memo: str, extra: Optional[dict] = None
+    ) -> Invoice:
+        """Issue an invoice for `amount` sats into `wallet_id`."""
+
+    @abstractmethod
+    def register_listener(self, queue: asyncio.Queue) -> None:
+        """Deliver an object with `payment_hash` and `extra` to `queue` per paid invoice."""
+
+
+class LNbitsInvoiceProvider(InvoiceProvider):
+    """Issues invoices from the wallet's LNbits funding source."""
+
+    async def create_invoice(
+        self, wallet_id: str, amount: int, memo: str, extra: Optional[dict] = None
+    ) -> Invoice:
+        payment = await services.create_invoice(
+            wallet_id=wallet_id,
+            amount=amount,
+            memo=memo,
+            extra=extra,
+            expiry=INVOICE_EXPIRY_SECONDS,
+        )
+        return Invoice(payment.payment_hash, payment.bolt11, amount, extra)
+
+    def register_listener(self, queue: asyncio.Queue) -> None:
+        register_invoice_listener(queue, "ext_subscriptions")
+
+
+class FakeInvoiceProvider(InvoiceProvider):
+    """
+    Deterministic in-memory provider for offline load tests.
+
+    Each invoice takes `latency` seconds to issue and fails with probability
+    `failure_rate`. A `settle_rate` share of issued invoices is paid
+    `settle_after` seconds later; the rest stay pending unless `settle` is
+    called. Payment hashes and failure draws come from `seed`, so a run is
+    repeatable; without one a random seed is used, as payment hashes must
+    not repeat across restarts against the same database.
+    """
+
+    def __init__(
+        self,
+        latency: float = 0.0,
+        failure_rate: float = 0.0,
+        settle_after: Optional[float] = None,
+        settle_rate: float = 1.0,
+        seed: Optional[int] = None,
+    ):
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.settle_after = settle_after
+        self.settle_rate = settle_rate
+        self.seed = seed if seed is not None else random.getrandbits(64)
+        self._rng = random.Random(self.seed)
+        self._issued_count = 0
+        self._pending: dict = {}
+        self._listeners: List[asyncio.Queue] = []
+        self.issued = 0
+        self.failed = 0
+        self.settled = 0
+
+    async def create_invoice(
+        self, wallet_id: str, amount: int, memo: str, extra: Optional[dict] = None
+    ) -> Invoice:
+        self._issued_count += 1
+        # Draw both outcomes up front so concurrency doesn't reorder the stream
+        fails = self._rng.random() < self.failure_rate
+        settles = self._rng.random() < self.settle_rate
+        payment_hash = hashlib.sha256(
+            f"{self.seed}:{self._issued_count}".encode()
+        ).hexdigest()
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if fails:
+            self.failed += 1
+            raise InvoiceError("Fake invoice provider failure")
+
+        invoice = Invoice(payment_hash, f"lnbcrt{amount}n1fake{payment_hash}", amount, extra)
+        self._pending[payment_hash] = invoice
+        self.issued += 1
+        if settles and self.settle_after is not None:
+            asyncio.get_event_loop().call_later(self.settle_after, self.settle, payment_hash)
+        return invoice
+
+    def settle(self, payment_hash: str) -> bool:
+        """Mark a pending invoice paid and emit its paid event."""
+        invoice = self._pending.pop(payment_hash, None)
+        if invoice is None:
+            return False
+        self.settled += 1
+        for queue in self._listeners:
+            queue.put_nowait(invoice)
+        return True
+
+    def register_listener(self, queue: asyncio.Queue) -> None:
+        self._listeners.append(queue)
+
+    def stats(self) -> dict:
+        return {
+            "issued": self.issued,
+            "failed": self.failed,
+            "settled": self.settled,
+            "pending": len(self._pending),
+        }
+
+
+def _create_provider() -> InvoiceProvider:
+    if os.getenv("SUBSCRIPTIONS_INVOICE_PROVIDER", "lnbits") != "fake":
+        return LNbitsInvoiceProvider()
+    settle_after = os.getenv("SUBSCRIPTIONS_FAKE_INVOICE_SETTLE_SECONDS")
+    logger.warning("Subscriptions is issuing fake invoices; nothing will be really paid")
+    return FakeInvoiceProvider(
+        latency=float(os.getenv("SUBSCRIPTIONS_FAKE_INVOICE_LATENCY_MS", "0")) / 1000,
+        failure_rate=float(os.getenv("SUBSCRIPTIONS_FAKE_INVOICE_FAILURE_RATE", "0")),
+        settle_after=float(settle_after) if settle_after else None,
+        settle_rate=float(os.getenv("SUBSCRIPTIONS_FAKE_INVOICE_SETTLE_RATE", "1")),
+    )
+
+
+invoice_provider = _create_provider()
+
+
+def set_invoice_provider(provider: InvoiceProvider) -> None:
+    """Swap the provider used by every billing path, e.g. for a benchmark."""
+    global invoice_provider
+    invoice_provider = provider
+
+
+class InvoiceIssuer:
+    """
+    Bounds how many invoices are created at once, overall and per wallet.
+
+    Callers beyond those limits wait in line. Once `max_queue` callers are
+    waiting, new API requests are shed with InvoiceBackpressure instead of
+    piling up behind a slow node, while background sweeps (`shed=False`)
+    keep waiting. Each provider call is cut off after `timeout` seconds.
+    """
+
+    def __init__(
+        self,
+        workers: int = INVOICE_WORKERS,
+        wallet_workers: int = INVOICE_WALLET_WORKERS,
+        max_queue: int = INVOICE_QUEUE_SIZE,
+        timeout: float = INVOICE_TIMEOUT_SECONDS,
+    ):
+        self.workers = workers
+        self.wallet_workers = wallet_workers
+        self.max_queue = max_queue
+        self.timeout = timeout
+        # Created on first use so they bind to the running event loop
+        self._slots: Optional[asyncio.Semaphore] = None
+        # wallet id -> [semaphore, callers holding or waiting for it]
+        self._wallets: dict = {}
+        # Moving average of provider latency, used to suggest a retry delay
+        self._latency = 1.0
+        self.waiting = 0
+        self.active = 0
+
+    @property
+    def saturated(self) -> bool:
+        return self.waiting >= self.max_queue
+
+    def retry_after(self) -> int:
+        backlog = (self.waiting + self.active) / self.workers
+        return max(1, math.ceil(backlog * self._latency))
+
+    async def issue(
+        self,
+        wallet_id: str,
+        amount: int,
+        memo: str,
+        extra: Optional[dict] = None,
+        source: str = "api",
+        shed: bool = True,
+    ) -> Invoice:
+        if shed and self.saturated:
+            invoice_shed.inc(source)
+            raise InvoiceBackpressure(self.retry_after())
+
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.workers)
+        wallet = self._wallets.get(wallet_id)
+        if wallet is None:
+            wallet = self._wallets[wallet_id] = [asyncio.Semaphore(self.wallet_workers), 0]
+        wallet[1] += 1
+
+        try:
+            self.waiting += 1
+            queued_at = time.perf_counter()
+            try:
+                async with wallet[0], self._slots:
+                    self.waiting -= 1
+                    invoice_queue_wait.observe(time.perf_counter() - queued_at, source)
+                    queued_at = None
+                    return await self._create(wallet_id, amount, memo, extra, source)
+            finally:
+                if queued_at is not None:
+                    self.waiting -= 1
+        finally:
+            wallet[1] -= 1
+            if not wallet[1]:
+                del self._wallets[wallet_id]
+
+    async def _create(
+        self, wallet_id: str, amount: int, memo: str, extra: Optional[dict], source: str
+    ) -> Invoice:
+        self.active += 1
+        start = time.perf_counter()
+        try:
+            with observe_invoice(source):
+                return await asyncio.wait_for(
+                    invoice_provider.create_invoice(wallet_id, amount, memo, extra),
+                    self.timeout,
+                )
+        except asyncio.TimeoutError:
+            raise InvoiceTimeout(f"Invoice creation timed out after {self.timeout}s")
+        finally:
+            self.active -= 1
+            self._latency = 0.8 * self._latency + 0.2 * (time.perf_counter() - start)
+
+
+invoice_issuer = InvoiceIssuer()
+
+
+async def issue_invoice(
+    wallet_id: str,
+    amount: int,
+    memo: str,
+    extra: Optional[dict] = None,
+    source: str = "api",
+    shed: bool = True,
+) -> Invoice:
+    return await invoice_issuer.issue(wallet_id, amount, memo, extra, source, shed)
+
+
+def register_paid_listener(queue: asyncio.Queue) -> None:
+    invoice_provider.register_listener(queue)
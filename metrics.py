@@ -0,0 +1,330 @@
+"""Low-overhead in-process metrics exported in the Prometheus text format."""
+
+import os
+import time
+from bisect import bisect_left
+from contextlib import asynccontextmanager, contextmanager
+from contextvars import ContextVar
+from functools import wraps
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+from fastapi import HTTPException, Request
+from fastapi.routing import APIRoute
+
+# Bearer token required to scrape /api/v1/metrics; the endpoint is off without it
+METRICS_TOKEN: Optional[str] = os.getenv("SUBSCRIPTIONS_METRICS_TOKEN")
+
+# Latency buckets in seconds, from sub-millisecond queries to slow node calls
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(names: Tuple[str, ...], values: Tuple[str, ...], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labels: Tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+
+    def header(self) -> List[str]:
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labels: Tuple[str, ...] = ()):
+        super().__init__(name, documentation, labels)
+        self.values: Dict[tuple, float] = {}
+
+    def inc(self, *labels: str, amount: float = 1) -> None:
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def render(self) -> List[str]:
+        return self.header() + [
+            f"{self.name}{_format_labels(self.labels, labels)} {value}"
+            for labels, value in self.values.items()
+        ]
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def set(self, *labels: str, value: float) -> None:
+        self.values[labels] = value
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labels: Tuple[str, ...] = (),
+        buckets: Tuple[float, ...] = DEFAULT_BUCKETS,
+    ):
+        super().__init__(name, documentation, labels)
+        self.buckets = buckets
+        # labels -> [per-bucket counts (last is +Inf), sum]
+        self.values: Dict[tuple, list] = {}
+
+    def observe(self, value: float, *labels: str) -> None:
+        series = self.values.get(labels)
+        if series is None:
+            series = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+        series[0][bisect_left(self.buckets, value)] += 1
+        series[1] += value
+
+    @contextmanager
+    def time(self, *labels: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *labels)
+
+    def render(self) -> List[str]:
+        lines = self.header()
+        for labels, (counts, total) in self.values.items():
+            cumulative = 0
+            for bound, count in zip((*self.buckets, "+Inf"), counts):
+                cumulative += count
+                le = _format_labels(self.labels, labels, f'le="{bound}"')
+                lines.append(f"{self.name}_bucket{le} {cumulative}")
+            suffix = _format_labels(self.labels, labels)
+            lines.append(f"{self.name}_sum{suffix} {total}")
+            lines.append(f"{self.name}_count{suffix} {cumulative}")
+        return lines
+
+
+class Registry:
+    """Holds metrics plus async collectors that refresh gauges at scrape time."""
+
+    def __init__(self):
+        self.metrics: List[_Metric] = []
+        self.collectors: List[Callable[[], Awaitable[None]]] = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def collector(self, fn: Callable[[], Awaitable[None]]):
+        self.collectors.append(fn)
+        return fn
+
+    async def render(self) -> str:
+        for collect in self.collectors:
+            await collect()
+        lines: List[str] = []
+        for metric in self.metrics:
+            lines += metric.render()
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+http_request_duration = registry.register(
+    Histogram(
+        "subscriptions_http_request_duration_seconds",
+        "API request latency by route",
+        ("method", "route", "status"),
+    )
+)
+crud_duration = registry.register(
+    Histogram(
+        "subscriptions_crud_duration_seconds",
+        "Duration of CRUD calls, including their database round trips",
+        ("function",),
+    )
+)
+crud_errors = registry.register(
+    Counter("subscriptions_crud_errors_total", "CRUD calls that raised", ("function",))
+)
+crud_queries = registry.register(
+    Counter(
+        "subscriptions_crud_queries_total",
+        "Database statements sent by CRUD functions",
+        ("function",),
+    )
+)
+invoice_duration = registry.register(
+    Histogram(
+        "subscriptions_invoice_create_duration_seconds",
+        "Latency of creating Lightning invoices",
+        ("source",),
+    )
+)
+invoice_errors = registry.register(
+    Counter(
+        "subscriptions_invoice_create_errors_total",
+        "Failed Lightning invoice creations",
+        ("source",),
+    )
+)
+invoice_queue_wait = registry.register(
+    Histogram(
+        "subscriptions_invoice_queue_wait_seconds",
+        "Time spent waiting for an invoice issuing slot",
+        ("source",),
+    )
+)
+invoice_shed = registry.register(
+    Counter(
+        "subscriptions_invoice_shed_total",
+        "Invoice requests rejected because the issuing queue was full",
+        ("source",),
+    )
+)
+rate_limit_rejections = registry.register(
+    Counter(
+        "subscriptions_rate_limit_rejections_total",
+        "Requests rejected by the rate limiter",
+        ("policy",),
+    )
+)
+job_duration = registry.register(
+    Histogram(
+        "subscriptions_job_duration_seconds",
+        "Duration of background sweeps",
+        ("job",),
+        buckets=(0.01, 0.1, 0.5, 1, 5, 10, 30, 60, 300),
+    )
+)
+job_processed = registry.register(
+    Counter(
+        "subscriptions_job_processed_total",
+        "Subscriptions or events handled by background sweeps",
+        ("job",),
+    )
+)
+job_lease_skipped = registry.register(
+    Counter(
+        "subscriptions_job_lease_skipped_total",
+        "Background job runs skipped because another worker held the lease",
+        ("job",),
+    )
+)
+queue_depth = registry.register(
+    Gauge(
+        "subscriptions_queue_depth",
+        "Work waiting in background queues at scrape time",
+        ("queue",),
+    )
+)
+cache_stats = registry.register(
+    Gauge(
+        "subscriptions_cache",
+        "In-process cache counters by cache and statistic",
+        ("cache", "stat"),
+    )
+)
+
+
+# CRUD function whose statements are being counted; nested calls count as their own
+_crud_function: ContextVar[Optional[str]] = ContextVar("subscriptions_crud_function", default=None)
+
+
+class CountingDatabase:
+    """
+    Wraps the extension's database, or a connection from it, and counts each
+    statement against the CRUD function running it. Everything other than
+    sending statements is passed through to the wrapped object.
+    """
+
+    def __init__(self, target):
+        self._target = target
+
+    def __getattr__(self, name):
+        return getattr(self._target, name)
+
+    def _count(self) -> None:
+        name = _crud_function.get()
+        if name is not None:
+            crud_queries.inc(name)
+
+    async def execute(self, *args, **kwargs):
+        self._count()
+        return await self._target.execute(*args, **kwargs)
+
+    async def fetchone(self, *args, **kwargs):
+        self._count()
+        return await self._target.fetchone(*args, **kwargs)
+
+    async def fetchall(self, *args, **kwargs):
+        self._count()
+        return await self._target.fetchall(*args, **kwargs)
+
+    @asynccontextmanager
+    async def connect(self):
+        async with self._target.connect() as conn:
+            yield CountingDatabase(conn)
+
+
+def observe_crud(fn):
+    """Record the duration, failures and statements of a CRUD coroutine under its name."""
+    name = fn.__name__
+
+    @wraps(fn)
+    async def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        token = _crud_function.set(name)
+        try:
+            return await fn(*args, **kwargs)
+        except Exception:
+            crud_errors.inc(name)
+            raise
+        finally:
+            _crud_function.reset(token)
+            crud_duration.observe(time.perf_counter() - start, name)
+
+    return wrapper
+
+
+@contextmanager
+def observe_invoice(source: str):
+    """Time one invoice creation and count it as failed if it raises."""
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        invoice_errors.inc(source)
+        raise
+    finally:
+        invoice_duration.observe(time.perf_counter() - start, source)
+
+
+class TimedRoute(APIRoute):
+    """API route that records its latency by method, path template and status."""
+
+    def get_route_handler(self):
+        handler = super().get_route_handler()
+        path = self.path
+
+        async def timed_handler(request: Request):
+            start = time.perf_counter()
+            status = 500
+            try:
+                response = await handler(request)
+                status = response.status_code
+                return response
+            except HTTPException as e:
+                status = e.status_code
+                raise
+            finally:
+                http_request_duration.observe(
+                    time.perf_counter() - start, request.method, path, str(status)
+                )
+
+        return timed_handler
@@ -1,3 +1,16 @@
+from lnbits.db import SQLITE
+
+
+def _index_on(db, index: str, table: str) -> str:
+    """
+    The `index ON table` part of a CREATE INDEX. SQLite takes the schema on
+    the index name, Postgres on the table.
+    """
+    if db.type == SQLITE:
+        return f"subscriptions.{index} ON {table}"
+    return f"{index} ON subscriptions.{table}"
+
+
 async def m001_initial(db):
     """
     Initial subscriptions tables.
@@ -24,10 +37,10 @@ async def m001_initial(db):
     )
 
     await db.execute(
-        """
+        f"""
         CREATE TABLE subscriptions.subscriptions (
             id TEXT PRIMARY KEY,
-            plan_id TEXT NOT NULL REFERENCES subscriptions.plans (id),
+            plan_id TEXT NOT NULL REFERENCES {db.references_schema}plans (id),
             wallet TEXT NOT NULL,
             subscriber_email TEXT,
             subscriber_name TEXT,
@@ -49,10 +62,10 @@ async def m001_initial(db):
     )
 
     await db.execute(
-        """
+        f"""
         CREATE TABLE subscriptions.payments (
             id TEXT PRIMARY KEY,
-            subscription_id TEXT NOT NULL REFERENCES subscriptions.subscriptions (id),
+            subscription_id TEXT NOT NULL REFERENCES {db.references_schema}subscriptions (id),
             payment_hash TEXT NOT NULL,
             amount INTEGER NOT NULL,
             status TEXT NOT NULL DEFAULT 'pending',
@@ -67,64 +80,324 @@ async def m001_initial(db):
 
     # Create indexes for better performance
     await db.execute(
-        "CREATE INDEX idx_plans_wallet ON subscriptions.plans (wallet);"
+        f"CREATE INDEX {_index_on(db, 'idx_plans_wallet', 'plans')} (wallet);"
     )
     await db.execute(
-        "CREATE INDEX idx_subscriptions_plan_id ON subscriptions.subscriptions (plan_id);"
+        f"CREATE INDEX {_index_on(db, 'idx_subscriptions_plan_id', 'subscriptions')} (plan_id);"
     )
     await db.execute(
-        "CREATE INDEX idx_subscriptions_wallet ON subscriptions.subscriptions (wallet);"
+        f"CREATE INDEX {_index_on(db, 'idx_subscriptions_wallet', 'subscriptions')} (wallet);"
     )
     await db.execute(
-        "CREATE INDEX idx_subscriptions_status ON subscriptions.subscriptions (status);"
+        f"CREATE INDEX {_index_on(db, 'idx_subscriptions_status', 'subscriptions')} (status);"
     )
     await db.execute(
-        "CREATE INDEX idx_subscriptions_next_payment ON subscriptions.subscriptions (next_payment_date);"
+        f"CREATE INDEX {_index_on(db, 'idx_subscriptions_next_payment', 'subscriptions')} (next_payment_date);"
     )
     await db.execute(
-        "CREATE INDEX idx_payments_subscription_id ON subscriptions.payments (subscription_id);"
+        f"CREATE INDEX {_index_on(db, 'idx_payments_subscription_id', 'payments')} (subscription_id);"
     )
     await db.execute(
-        "CREATE INDEX idx_payments_hash ON subscriptions.payments (payment_hash);"
+        f"CREATE INDEX {_index_on(db, 'idx_payments_hash', 'payments')} (payment_hash);"
     )
 
-    # Add security constraints
+    # Add security constraints; SQLite can't add a constraint to an existing table
+    if db.type != SQLITE:
+        for constraint in (
+            "check_amount_positive CHECK (amount > 0)",
+            "check_trial_days_non_negative CHECK (trial_days >= 0)",
+            "check_trial_days_max CHECK (trial_days <= 365)",
+            "check_max_subscriptions_positive CHECK (max_subscriptions IS NULL OR max_subscriptions > 0)",
+            "check_name_length CHECK (LENGTH(name) >= 1 AND LENGTH(name) <= 100)",
+            "check_valid_interval CHECK (interval IN ('daily', 'weekly', 'monthly', 'yearly'))",
+        ):
+            await db.execute(
+                f"ALTER TABLE subscriptions.plans ADD CONSTRAINT {constraint};"
+            )
+    
+    # Create audit table for security events
     await db.execute(
-        "ALTER TABLE subscriptions.plans ADD CONSTRAINT check_amount_positive CHECK (amount > 0);"
+        f"""
+        CREATE TABLE subscriptions.security_audit (
+            id {db.serial_primary_key},
+            event_type TEXT NOT NULL,
+            user_id TEXT,
+            ip_address TEXT,
+            details TEXT,
+            timestamp TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+        );
+        """
     )
+    
     await db.execute(
-        "ALTER TABLE subscriptions.plans ADD CONSTRAINT check_trial_days_non_negative CHECK (trial_days >= 0);"
+        f"CREATE INDEX {_index_on(db, 'idx_audit_timestamp', 'security_audit')} (timestamp);"
     )
     await db.execute(
-        "ALTER TABLE subscriptions.plans ADD CONSTRAINT check_trial_days_max CHECK (trial_days <= 365);"
+        f"CREATE INDEX {_index_on(db, 'idx_audit_event_type', 'security_audit')} (event_type);"
+    ) 
+
+async def m002_renewal_keyset_index(db):
+    """
+    Composite index backing the keyset-paginated renewal sweep.
+    """
+    await db.execute(
+        f"CREATE INDEX {_index_on(db, 'idx_subscriptions_due', 'subscriptions')} (next_payment_date, id);"
     )
+
+
+async def m003_list_keyset_indexes(db):
+    """
+    Composite indexes so every paginated list page is one index range scan.
+    """
     await db.execute(
-        "ALTER TABLE subscriptions.plans ADD CONSTRAINT check_max_subscriptions_positive CHECK (max_subscriptions IS NULL OR max_subscriptions > 0);"
+        f"CREATE INDEX {_index_on(db, 'idx_subscriptions_wallet_created', 'subscriptions')} (wallet, created_at, id);"
     )
     await db.execute(
-        "ALTER TABLE subscriptions.plans ADD CONSTRAINT check_name_length CHECK (LENGTH(name) >= 1 AND LENGTH(name) <= 100);"
+        f"CREATE INDEX {_index_on(db, 'idx_subscriptions_wallet_status_created', 'subscriptions')} (wallet, status, created_at, id);"
     )
     await db.execute(
-        "ALTER TABLE subscriptions.plans ADD CONSTRAINT check_valid_interval CHECK (interval IN ('daily', 'weekly', 'monthly', 'yearly'));"
+        f"CREATE INDEX {_index_on(db, 'idx_subscriptions_plan_created', 'subscriptions')} (plan_id, created_at, id);"
     )
-    
-    # Create audit table for security events
+    await db.execute(
+        f"CREATE INDEX {_index_on(db, 'idx_payments_subscription_created', 'payments')} (subscription_id, created_at, id);"
+    )
+
+
+async def m004_recount_active_subscriptions(db):
+    """
+    Recount plan slots; earlier versions never released them on cancellation.
+    """
     await db.execute(
         """
-        CREATE TABLE subscriptions.security_audit (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            event_type TEXT NOT NULL,
-            user_id TEXT,
-            ip_address TEXT,
-            details TEXT,
-            timestamp TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+        UPDATE subscriptions.plans SET active_subscriptions = (
+            SELECT COUNT(*) FROM subscriptions.subscriptions s
+            WHERE s.plan_id = plans.id
+            AND s.status IN ('active', 'trialing', 'past_due')
         );
         """
     )
-    
+
+
+async def m005_payments_ledger_index(db):
+    """
+    Index for resumable, oldest-first payment ledger exports.
+    """
+    await db.execute(
+        f"CREATE INDEX {_index_on(db, 'idx_payments_created', 'payments')} (created_at, id);"
+    )
+
+
+async def m006_webhook_outbox(db):
+    """
+    Durable outbox of webhook events plus a per-plan signing secret.
+    """
+    import secrets
+
+    await db.execute("ALTER TABLE subscriptions.plans ADD COLUMN webhook_secret TEXT;")
+    rows = await db.fetchall("SELECT id FROM subscriptions.plans")
+    for row in rows:
+        await db.execute(
+            "UPDATE subscriptions.plans SET webhook_secret = ? WHERE id = ?",
+            (secrets.token_hex(32), row["id"]),
+        )
+
+    await db.execute(
+        """
+        CREATE TABLE subscriptions.webhook_outbox (
+            id TEXT PRIMARY KEY,
+            plan_id TEXT NOT NULL,
+            url TEXT NOT NULL,
+            event TEXT NOT NULL,
+            payload TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt_at TIMESTAMP NOT NULL,
+            last_error TEXT,
+            delivered_at TIMESTAMP,
+            created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+        );
+        """
+    )
+    await db.execute(
+        f"CREATE INDEX {_index_on(db, 'idx_webhook_outbox_due', 'webhook_outbox')} (status, next_attempt_at);"
+    )
+
+
+async def m007_dunning(db):
+    """
+    Per-plan dunning schedules and a time-ordered queue of unpaid renewals.
+    """
+    await db.execute("ALTER TABLE subscriptions.plans ADD COLUMN dunning_schedule TEXT;")
+    await db.execute(
+        """
+        CREATE TABLE subscriptions.dunning_queue (
+            subscription_id TEXT PRIMARY KEY,
+            payment_id TEXT NOT NULL,
+            attempt INTEGER NOT NULL DEFAULT 0,
+            due_at TIMESTAMP NOT NULL,
+            next_attempt_at TIMESTAMP NOT NULL,
+            created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+        );
+        """
+    )
+    await db.execute(
+        f"CREATE INDEX {_index_on(db, 'idx_dunning_queue_next', 'dunning_queue')} (next_attempt_at, subscription_id);"
+    )
+
+
+async def m008_period_end_index(db):
+    """
+    Index for finalising cancellations scheduled at period end.
+    """
+    await db.execute(
+        f"CREATE INDEX {_index_on(db, 'idx_subscriptions_period_end', 'subscriptions')} (cancel_at_period_end, current_period_end, id);"
+    )
+
+
+async def m009_billing_anchor(db):
+    """
+    Day of month that calendar renewals are anchored to.
+    """
+    await db.execute(
+        "ALTER TABLE subscriptions.subscriptions ADD COLUMN billing_anchor INTEGER;"
+    )
+
+
+async def m010_payment_hash_unique(db):
+    """
+    Make payment hashes unique, so a settlement matches exactly one row, and
+    index payments by status for the pending-invoice sweeps.
+    """
+    await db.execute("DROP INDEX IF EXISTS subscriptions.idx_payments_hash;")
+    await db.execute(
+        f"CREATE UNIQUE INDEX {_index_on(db, 'idx_payments_hash_unique', 'payments')} (payment_hash);"
+    )
+    await db.execute(
+        f"CREATE INDEX {_index_on(db, 'idx_payments_status_created', 'payments')} (status, created_at);"
+    )
+
+
+async def m011_payment_archive(db):
+    """
+    Cold storage for settled payments past the archive horizon.
+    """
+    await db.execute(
+        """
+        CREATE TABLE subscriptions.payments_archive (
+            id TEXT PRIMARY KEY,
+            subscription_id TEXT NOT NULL,
+            payment_hash TEXT NOT NULL,
+            amount INTEGER NOT NULL,
+            status TEXT NOT NULL,
+            period_start TIMESTAMP NOT NULL,
+            period_end TIMESTAMP NOT NULL,
+            payment_date TIMESTAMP,
+            failure_reason TEXT,
+            created_at TIMESTAMP NOT NULL,
+            archived_at TIMESTAMP NOT NULL
+        );
+        """
+    )
+    await db.execute(
+        f"CREATE INDEX {_index_on(db, 'idx_payments_archive_subscription_created', 'payments_archive')} (subscription_id, created_at, id);"
+    )
     await db.execute(
-        "CREATE INDEX idx_audit_timestamp ON subscriptions.security_audit (timestamp);"
+        f"CREATE INDEX {_index_on(db, 'idx_payments_archive_created', 'payments_archive')} (created_at, id);"
+    )
+
+
+async def m012_plan_stats(db):
+    """
+    Incrementally maintained per-plan status counts and revenue, backfilled
+    here from the subscriptions, payments and payment archive tables.
+    """
+    from datetime import datetime
+
+    await db.execute(
+        f"""
+        CREATE TABLE subscriptions.plan_stats (
+            plan_id TEXT PRIMARY KEY,
+            trialing_count INTEGER NOT NULL DEFAULT 0,
+            active_count INTEGER NOT NULL DEFAULT 0,
+            past_due_count INTEGER NOT NULL DEFAULT 0,
+            canceled_count INTEGER NOT NULL DEFAULT 0,
+            paid_payments INTEGER NOT NULL DEFAULT 0,
+            failed_payments INTEGER NOT NULL DEFAULT 0,
+            revenue_total {db.big_int} NOT NULL DEFAULT 0,
+            revenue_month {db.big_int} NOT NULL DEFAULT 0,
+            revenue_month_start TIMESTAMP NOT NULL,
+            updated_at TIMESTAMP NOT NULL
+        );
+        """
     )
+    now = datetime.now()
+    month = datetime(now.year, now.month, 1)
     await db.execute(
-        "CREATE INDEX idx_audit_event_type ON subscriptions.security_audit (event_type);"
-    ) 
\ No newline at end of file
+        """
+        INSERT INTO subscriptions.plan_stats (
+            plan_id, trialing_count, active_count, past_due_count, canceled_count,
+            paid_payments, failed_payments, revenue_total, revenue_month,
+            revenue_month_start, updated_at
+        )
+        SELECT pl.id,
+            COALESCE(s.trialing_count, 0), COALESCE(s.active_count, 0),
+            COALESCE(s.past_due_count, 0), COALESCE(s.canceled_count, 0),
+            COALESCE(pay.paid_payments, 0), COALESCE(pay.failed_payments, 0),
+            COALESCE(pay.revenue_total, 0), COALESCE(pay.revenue_month, 0),
+            ?, ?
+        FROM subscriptions.plans pl
+        LEFT JOIN (
+            SELECT plan_id,
+                SUM(CASE WHEN status = 'trialing' THEN 1 ELSE 0 END) AS trialing_count,
+                SUM(CASE WHEN status = 'active' THEN 1 ELSE 0 END) AS active_count,
+                SUM(CASE WHEN status = 'past_due' THEN 1 ELSE 0 END) AS past_due_count,
+                SUM(CASE WHEN status = 'canceled' THEN 1 ELSE 0 END) AS canceled_count
+            FROM subscriptions.subscriptions
+            GROUP BY plan_id
+        ) AS s ON s.plan_id = pl.id
+        LEFT JOIN (
+            SELECT sub.plan_id,
+                SUM(CASE WHEN p.status = 'paid' THEN 1 ELSE 0 END) AS paid_payments,
+                SUM(CASE WHEN p.status = 'failed' THEN 1 ELSE 0 END) AS failed_payments,
+                SUM(CASE WHEN p.status = 'paid' THEN p.amount ELSE 0 END) AS revenue_total,
+                SUM(
+                    CASE WHEN p.status = 'paid' AND p.payment_date >= ? THEN p.amount ELSE 0 END
+                ) AS revenue_month
+            FROM (
+                SELECT subscription_id, status, amount, payment_date FROM subscriptions.payments
+                UNION ALL
+                SELECT subscription_id, status, amount, payment_date
+                FROM subscriptions.payments_archive
+            ) AS p
+            JOIN subscriptions.subscriptions sub ON sub.id = p.subscription_id
+            GROUP BY sub.plan_id
+        ) AS pay ON pay.plan_id = pl.id
+        """,
+        (month, now, month),
+    )
+
+
+async def m013_job_leases(db):
+    """
+    Leases that keep each background job, or each shard of a sharded sweep,
+    on one worker at a time.
+    """
+    await db.execute(
+        """
+        CREATE TABLE subscriptions.job_leases (
+            name TEXT PRIMARY KEY,
+            owner TEXT NOT NULL,
+            expires_at TIMESTAMP NOT NULL
+        );
+        """
+    )
+
+
+async def m014_subscriptions_wallet_canceled(db):
+    """
+    Recent cancellations per wallet, for churn on the dashboard now that
+    status counts come from plan_stats.
+    """
+    await db.execute(
+        f"CREATE INDEX {_index_on(db, 'idx_subscriptions_wallet_canceled', 'subscriptions')} (wallet, canceled_at);"
+    )
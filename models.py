@@ -6,6 +6,19 @@ from urllib.parse import urlparse
 from lnbits.helpers import urlsafe_short_hash
 from pydantic import BaseModel, Field, validator, HttpUrl
 
+# Days after a missed renewal at which an unpaid invoice is retried; the last
+# entry cancels the subscription instead of retrying
+DEFAULT_DUNNING_SCHEDULE = [1, 3, 7]
+
+
+def parse_dunning_schedule(v):
+    """Accept a stored JSON schedule and fall back to the default when unset."""
+    if v is None:
+        return list(DEFAULT_DUNNING_SCHEDULE)
+    if isinstance(v, str):
+        return json.loads(v)
+    return v
+
 
 class CreateSubscriptionPlan(BaseModel):
     name: str = Field(..., min_length=1, max_length=100, description="Plan name")
@@ -17,6 +30,9 @@ class CreateSubscriptionPlan(BaseModel):
     webhook_url: Optional[str] = Field(None, max_length=500, description="Webhook URL")
     success_message: Optional[str] = Field(None, max_length=200, description="Success message")
     success_url: Optional[str] = Field(None, max_length=500, description="Success redirect URL")
+    dunning_schedule: Optional[List[int]] = Field(
+        None, description="Days after a missed renewal to retry; the last entry cancels"
+    )
     
     @validator('webhook_url')
     def validate_webhook_url(cls, v):
@@ -42,6 +58,15 @@ class CreateSubscriptionPlan(BaseModel):
                 raise ValueError('Invalid success URL format')
         return v
 
+    @validator('dunning_schedule')
+    def validate_dunning_schedule(cls, v):
+        if v is not None:
+            if not 1 <= len(v) <= 10:
+                raise ValueError('Dunning schedule must have between 1 and 10 entries')
+            if any(day < 1 or day > 90 for day in v) or v != sorted(set(v)):
+                raise ValueError('Dunning schedule must be increasing days between 1 and 90')
+        return v
+
 
 class SubscriptionPlan(BaseModel):
     id: str
@@ -56,9 +81,15 @@ class SubscriptionPlan(BaseModel):
     webhook_url: Optional[str]
     success_message: Optional[str]
     success_url: Optional[str]
+    webhook_secret: Optional[str]
+    dunning_schedule: List[int] = DEFAULT_DUNNING_SCHEDULE
     created_at: datetime
     updated_at: datetime
 
+    _dunning_schedule = validator("dunning_schedule", pre=True, allow_reuse=True)(
+        parse_dunning_schedule
+    )
+
     @classmethod
     def from_row(cls, row):
         return cls(**dict(row))
@@ -117,6 +148,8 @@ class Subscription(BaseModel):
     last_payment_date: Optional[datetime]
     failed_payment_count: int = 0
     next_payment_date: datetime
+    # Day of month renewals fall on for monthly and yearly plans
+    billing_anchor: Optional[int]
 
     @classmethod
     def from_row(cls, row):
@@ -131,7 +164,7 @@ class SubscriptionPayment(BaseModel):
     subscription_id: str
     payment_hash: str
     amount: int
-    status: str  # "pending", "paid", "failed"
+    status: str  # "pending", "paid", "failed", "expired", "refund_due"
     period_start: datetime
     period_end: datetime
     payment_date: Optional[datetime]
@@ -140,4 +173,137 @@ class SubscriptionPayment(BaseModel):
 
     @classmethod
     def from_row(cls, row):
-        return cls(**dict(row)) 
\ No newline at end of file
+        return cls(**dict(row)) 
+
+class DueSubscription(BaseModel):
+    """Lightweight renewal candidate joined with the billing fields of its plan."""
+    id: str
+    plan_id: str
+    wallet: str
+    status: str
+    current_period_end: datetime
+    next_payment_date: datetime
+    billing_anchor: Optional[int]
+    amount: int
+    interval: str
+    plan_name: str
+    dunning_schedule: List[int] = DEFAULT_DUNNING_SCHEDULE
+
+    _dunning_schedule = validator("dunning_schedule", pre=True, allow_reuse=True)(
+        parse_dunning_schedule
+    )
+
+    @classmethod
+    def from_row(cls, row):
+        return cls(**dict(row))
+
+
+class DunningEntry(BaseModel):
+    """An unpaid renewal awaiting its next dunning check, with its plan's billing fields."""
+    subscription_id: str
+    payment_id: str
+    attempt: int
+    due_at: datetime
+    next_attempt_at: datetime
+    plan_id: str
+    wallet: str
+    status: str
+    period_start: datetime
+    period_end: datetime
+    amount: int
+    plan_name: str
+    dunning_schedule: List[int] = DEFAULT_DUNNING_SCHEDULE
+
+    _dunning_schedule = validator("dunning_schedule", pre=True, allow_reuse=True)(
+        parse_dunning_schedule
+    )
+
+    @property
+    def is_final(self) -> bool:
+        return self.attempt + 1 >= len(self.dunning_schedule)
+
+    @classmethod
+    def from_row(cls, row):
+        return cls(**dict(row))
+
+
+class PlanStats(BaseModel):
+    plan_id: str
+    name: str
+    interval: str
+    amount: int
+    active: int = 0
+    trialing: int = 0
+    past_due: int = 0
+    canceled_recently: int = 0
+    monthly_revenue: int = 0
+
+
+class PlanCounters(BaseModel):
+    """Per-plan counters kept up to date by every status change and settlement."""
+
+    plan_id: str
+    trialing_count: int = 0
+    active_count: int = 0
+    past_due_count: int = 0
+    canceled_count: int = 0
+    paid_payments: int = 0
+    failed_payments: int = 0
+    revenue_total: int = 0
+    # Revenue settled since revenue_month_start, the first day of its month
+    revenue_month: int = 0
+    revenue_month_start: datetime
+    updated_at: datetime
+
+    @classmethod
+    def from_row(cls, row):
+        return cls(**dict(row))
+
+
+class WalletStats(BaseModel):
+    total_plans: int = 0
+    active_subscriptions: int = 0
+    monthly_revenue: int = 0
+    churn_rate: float = 0.0
+    plans: List[PlanStats] = []
+
+
+class PaymentLedgerEntry(BaseModel):
+    """A payment joined with its subscription and plan, for accounting exports."""
+    id: str
+    subscription_id: str
+    payment_hash: str
+    amount: int
+    status: str
+    period_start: datetime
+    period_end: datetime
+    payment_date: Optional[datetime]
+    failure_reason: Optional[str]
+    created_at: datetime
+    plan_id: str
+    plan_name: str
+    interval: str
+    subscriber_email: Optional[str]
+    subscriber_name: Optional[str]
+
+    @classmethod
+    def from_row(cls, row):
+        return cls(**dict(row))
+
+
+class WebhookEvent(BaseModel):
+    id: str
+    plan_id: str
+    url: str
+    event: str
+    payload: str
+    status: str  # "pending", "delivered", "failed"
+    attempts: int = 0
+    next_attempt_at: datetime
+    last_error: Optional[str]
+    delivered_at: Optional[datetime]
+    created_at: datetime
+
+    @classmethod
+    def from_row(cls, row):
+        return cls(**dict(row))
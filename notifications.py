@@ -0,0 +1,30 @@
+"""In-process fan-out of payment settlements to waiting checkout pages."""
+
+import asyncio
+from collections import defaultdict
+from typing import Dict, Set
+
+_payment_waiters: Dict[str, Set[asyncio.Queue]] = defaultdict(set)
+
+
+def add_payment_waiter(payment_hash: str) -> asyncio.Queue:
+    """Register interest in a payment hash; the queue receives its new status."""
+    queue: asyncio.Queue = asyncio.Queue(maxsize=1)
+    _payment_waiters[payment_hash].add(queue)
+    return queue
+
+
+def remove_payment_waiter(payment_hash: str, queue: asyncio.Queue) -> None:
+    waiters = _payment_waiters.get(payment_hash)
+    if waiters is None:
+        return
+    waiters.discard(queue)
+    if not waiters:
+        del _payment_waiters[payment_hash]
+
+
+def notify_payment(payment_hash: str, status: str) -> None:
+    """Push a status change to every page waiting on `payment_hash`."""
+    for queue in _payment_waiters.pop(payment_hash, ()):
+        if not queue.full():
+            queue.put_nowait(status)
@@ -0,0 +1,165 @@
+"""Sliding-window rate limiting for the public API routes."""
+
+import os
+import time
+from collections import OrderedDict
+from typing import Dict, Tuple
+
+from fastapi import Request
+from loguru import logger
+
+from .metrics import rate_limit_rejections
+
+try:
+    import redis.asyncio as aioredis
+except ImportError:  # pragma: no cover - redis is optional
+    aioredis = None
+
+
+class RateLimitPolicy:
+    """Allow `max_requests` per client within a sliding `window_seconds`."""
+
+    def __init__(self, name: str, max_requests: int, window_seconds: int):
+        self.name = name
+        self.max_requests = max_requests
+        self.window_seconds = window_seconds
+
+
+# Per-route policies, keyed by the name passed to `check_rate_limit`
+POLICIES: Dict[str, RateLimitPolicy] = {
+    "public_subscribe": RateLimitPolicy("public_subscribe", 5, 60),
+    "public_read": RateLimitPolicy("public_read", 120, 60),
+}
+
+
+def _window_weight(now: float, window_seconds: int) -> Tuple[int, float]:
+    """Return the current window index and the share of the previous window still in view."""
+    window = int(now // window_seconds)
+    elapsed = now - window * window_seconds
+    return window, 1.0 - elapsed / window_seconds
+
+
+class MemoryBackend:
+    """
+    Bounded in-process sliding-window counters.
+
+    Each key keeps the counts of the current and previous fixed window, which
+    approximates a true sliding window in O(1). Keys are kept in last-touched
+    order so expired ones are dropped from the front without scanning, and the
+    oldest keys are evicted once `max_keys` is reached.
+    """
+
+    def __init__(self, max_keys: int = 100_000):
+        self.max_keys = max_keys
+        # key -> [window index, current count, previous count, expires at]
+        self._counters: "OrderedDict[str, list]" = OrderedDict()
+
+    async def hit(self, key: str, policy: RateLimitPolicy, now: float) -> bool:
+        self._expire(now)
+
+        window, weight = _window_weight(now, policy.window_seconds)
+        counter = self._counters.get(key)
+        if counter is None:
+            counter = [window, 0, 0, 0.0]
+        elif counter[0] != window:
+            previous = counter[1] if counter[0] == window - 1 else 0
+            counter = [window, 0, previous, 0.0]
+
+        estimate = counter[2] * weight + counter[1]
+        allowed = estimate < policy.max_requests
+        if allowed:
+            counter[1] += 1
+
+        counter[3] = (window + 2) * policy.window_seconds
+        self._counters[key] = counter
+        self._counters.move_to_end(key)
+        if len(self._counters) > self.max_keys:
+            self._counters.popitem(last=False)
+        return allowed
+
+    def _expire(self, now: float) -> None:
+        # Expiry times follow touch order within a policy, so stop at the first
+        # live key instead of walking the dict; anything left behind it is
+        # still bounded by max_keys
+        while self._counters:
+            key, counter = next(iter(self._counters.items()))
+            if counter[3] > now:
+                break
+            del self._counters[key]
+
+    def __len__(self) -> int:
+        return len(self._counters)
+
+
+# Checks the estimate before counting, so rejected requests don't use up the
+# window; as a script it runs atomically on the Redis server
+REDIS_HIT_SCRIPT = """
+local current = tonumber(redis.call('GET', KEYS[1]) or '0')
+local previous = tonumber(redis.call('GET', KEYS[2]) or '0')
+if previous * tonumber(ARGV[1]) + current >= tonumber(ARGV[2]) then
+    return 0
+end
+redis.call('INCR', KEYS[1])
+redis.call('EXPIRE', KEYS[1], ARGV[3])
+return 1
+"""
+
+
+class RedisBackend:
+    """
+    Sliding-window counters shared by every worker through Redis. Like
+    MemoryBackend, only allowed requests are counted.
+    """
+
+    def __init__(self, url: str, prefix: str = "subscriptions:ratelimit"):
+        if aioredis is None:
+            raise RuntimeError("redis package is required for RedisBackend")
+        self.redis = aioredis.from_url(url)
+        self.prefix = prefix
+        self._hit = self.redis.register_script(REDIS_HIT_SCRIPT)
+
+    async def hit(self, key: str, policy: RateLimitPolicy, now: float) -> bool:
+        window, weight = _window_weight(now, policy.window_seconds)
+        allowed = await self._hit(
+            keys=[f"{self.prefix}:{key}:{window}", f"{self.prefix}:{key}:{window - 1}"],
+            args=[weight, policy.max_requests, policy.window_seconds * 2],
+        )
+        return bool(allowed)
+
+
+class RateLimiter:
+    """Applies named policies to client addresses using a pluggable backend."""
+
+    def __init__(self, backend=None):
+        self.backend = backend or MemoryBackend()
+
+    async def check(self, client: str, policy_name: str) -> bool:
+        policy = POLICIES[policy_name]
+        key = f"{policy.name}:{client}"
+        try:
+            allowed = await self.backend.hit(key, policy, time.time())
+        except Exception as e:
+            # Never take the public API down because the shared store is away
+            logger.warning(f"Rate limit backend error, allowing request: {e}")
+            return True
+        if not allowed:
+            rate_limit_rejections.inc(policy_name)
+        return allowed
+
+
+def _create_limiter() -> RateLimiter:
+    redis_url = os.getenv("SUBSCRIPTIONS_RATE_LIMIT_REDIS_URL")
+    if redis_url and aioredis is not None:
+        return RateLimiter(RedisBackend(redis_url))
+    if redis_url:
+        logger.warning("SUBSCRIPTIONS_RATE_LIMIT_REDIS_URL set but redis is not installed")
+    return RateLimiter()
+
+
+rate_limiter = _create_limiter()
+
+
+async def check_rate_limit(request: Request, policy_name: str) -> bool:
+    """Return False if the calling client exceeded the named policy."""
+    client_ip = request.client.host if request.client else "unknown"
+    return await rate_limiter.check(client_ip, policy_name)
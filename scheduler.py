@@ -0,0 +1,101 @@
+"""Database leases that keep each background job on one worker at a time."""
+
+import asyncio
+import os
+import random
+import secrets
+import socket
+import string
+from typing import Awaitable, Callable, List, Optional, TypeVar
+
+from loguru import logger
+
+from .crud import IdRange, claim_job_lease, release_job_lease
+from .metrics import job_lease_skipped
+
+# A crashed worker's jobs are taken over once its lease runs out
+JOB_LEASE_SECONDS = int(os.getenv("SUBSCRIPTIONS_JOB_LEASE_SECONDS", "60"))
+# Shards of the renewal and dunning sweeps, so several workers can share one
+JOB_SHARDS = int(os.getenv("SUBSCRIPTIONS_JOB_SHARDS", "1"))
+
+# LNbits ids are drawn from these characters; shard boundaries split them evenly
+ID_ALPHABET = string.digits + string.ascii_uppercase + string.ascii_lowercase
+
+# Lease owner name of this process
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}:{secrets.token_hex(4)}"
+
+T = TypeVar("T")
+
+
+class LeaseLost(Exception):
+    """Another worker took over a lease while its job was still running."""
+
+
+def shard_ranges(shards: int) -> List[IdRange]:
+    """Split the subscription ids into `shards` contiguous, non-overlapping ranges."""
+    shards = max(1, min(shards, len(ID_ALPHABET)))
+    bounds = [ID_ALPHABET[len(ID_ALPHABET) * i // shards] for i in range(1, shards)]
+    edges = [None, *bounds, None]
+    return list(zip(edges, edges[1:]))
+
+
+async def run_leased(name: str, job: Callable[[], Awaitable[T]]) -> Optional[T]:
+    """
+    Run `job` if this worker can take the lease `name` and return its result,
+    or None when another worker holds it.
+
+    The lease is renewed while the job runs. Should it be lost anyway, e.g.
+    because the event loop stalled past the lease, the job is cancelled and
+    LeaseLost raised, so two workers never keep running it side by side.
+    """
+    if not await claim_job_lease(name, WORKER_ID, JOB_LEASE_SECONDS):
+        job_lease_skipped.inc(name.split(":")[0])
+        return None
+
+    task = asyncio.ensure_future(job())
+    heartbeat = asyncio.ensure_future(_renew_lease(name, task))
+    try:
+        return await task
+    except asyncio.CancelledError:
+        if heartbeat.done():
+            raise LeaseLost(f"Lease {name} was taken over by another worker")
+        raise
+    finally:
+        heartbeat.cancel()
+        try:
+            await release_job_lease(name, WORKER_ID)
+        except Exception as e:
+            logger.warning(f"Could not release job lease {name}, it will expire: {e}")
+
+
+async def _renew_lease(name: str, task: asyncio.Future) -> None:
+    while True:
+        await asyncio.sleep(JOB_LEASE_SECONDS / 3)
+        try:
+            held = await claim_job_lease(name, WORKER_ID, JOB_LEASE_SECONDS)
+        except Exception as e:
+            logger.warning(f"Could not renew job lease {name}: {e}")
+            continue
+        if not held:
+            logger.error(f"Job lease {name} was lost, stopping the job")
+            task.cancel()
+            return
+
+
+async def run_sharded(
+    name: str, job: Callable[[IdRange], Awaitable[int]], shards: int = JOB_SHARDS
+) -> int:
+    """
+    Run `job` on every subscription id shard whose lease this worker can
+    take and return the summed results. Shards are tried from a random
+    offset so workers ticking together spread over different shards.
+    """
+    ranges = shard_ranges(shards)
+    offset = random.randrange(len(ranges))
+    total = 0
+    for step in range(len(ranges)):
+        index = (offset + step) % len(ranges)
+        id_range = ranges[index]
+        done = await run_leased(f"{name}:{index}/{len(ranges)}", lambda: job(id_range))
+        total += done or 0
+    return total
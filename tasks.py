@@ -0,0 +1,341 @@
+import asyncio
+import os
+from datetime import datetime, timedelta
+from typing import Optional, Tuple
+
+from lnbits.core.models import Payment
+from loguru import logger
+
+from .billing import period_ends
+from .crud import (
+    IdRange,
+    apply_dunning,
+    apply_renewals,
+    archive_payments,
+    expire_pending_payments,
+    finalize_scheduled_cancellations,
+    get_due_dunning,
+    get_due_subscriptions,
+    reconcile_plan_stats,
+    settle_subscription_payment,
+)
+from .invoices import INVOICE_EXPIRY_SECONDS, issue_invoice, register_paid_listener
+from .metrics import job_duration, job_processed
+from .models import DueSubscription, DunningEntry
+from .notifications import notify_payment
+from .scheduler import run_leased, run_sharded
+
+# Renewal sweep tuning
+RENEWAL_INTERVAL_SECONDS = 60
+RENEWAL_CHUNK_SIZE = 100
+RENEWAL_INVOICE_CONCURRENCY = 20
+PERIOD_END_BATCH_SIZE = 500
+
+# Dunning tick tuning
+DUNNING_INTERVAL_SECONDS = 60
+DUNNING_CHUNK_SIZE = 100
+
+# Expired invoice reaper tuning; the grace period leaves time for late paid events
+EXPIRY_INTERVAL_SECONDS = 300
+EXPIRY_BATCH_SIZE = 500
+EXPIRY_GRACE_SECONDS = 600
+
+# Payment archive compactor tuning; settled payments older than the horizon move
+PAYMENT_ARCHIVE_DAYS = int(os.getenv("SUBSCRIPTIONS_PAYMENT_ARCHIVE_DAYS", "365"))
+ARCHIVE_INTERVAL_SECONDS = 3600
+ARCHIVE_BATCH_SIZE = 1000
+
+# Plan stats are kept incrementally; this pass only corrects drift
+STATS_RECONCILE_INTERVAL_SECONDS = 24 * 3600
+
+
+async def wait_for_paid_invoices():
+    invoice_queue = asyncio.Queue()
+    register_paid_listener(invoice_queue)
+
+    while True:
+        payment = await invoice_queue.get()
+        await on_invoice_paid(payment)
+
+
+async def on_invoice_paid(payment: Payment) -> None:
+    if not payment.extra or payment.extra.get("tag") != "subscriptions":
+        return
+
+    try:
+        settled = await settle_subscription_payment(payment.payment_hash)
+    except Exception as e:
+        logger.error(f"Error settling subscription payment {payment.payment_hash}: {e}")
+        return
+
+    if settled:
+        notify_payment(payment.payment_hash, settled.status)
+
+
+async def run_renewal_worker():
+    """
+    Periodically close ended periods and bill every subscription that is due.
+    Each shard of the sweep runs on whichever worker holds its lease.
+    """
+    while True:
+        try:
+            with job_duration.time("period_ends"):
+                canceled = await run_leased("period_ends", process_period_ends)
+            job_processed.inc("period_ends", amount=canceled or 0)
+            with job_duration.time("renewals"):
+                renewed = await run_sharded(
+                    "renewals", lambda id_range: process_due_renewals(id_range=id_range)
+                )
+            job_processed.inc("renewals", amount=renewed)
+        except Exception as e:
+            logger.error(f"Error during subscription renewal sweep: {e}")
+        await asyncio.sleep(RENEWAL_INTERVAL_SECONDS)
+
+
+async def process_period_ends(batch_size: int = PERIOD_END_BATCH_SIZE) -> int:
+    """
+    Cancel every subscription whose period ended with cancel_at_period_end
+    set, in set-based batches, and return how many were canceled. Expired
+    trials are converted by the renewal sweep, which invoices their first
+    period.
+    """
+    now = datetime.now()
+    canceled = 0
+    while True:
+        batch = await finalize_scheduled_cancellations(limit=batch_size, now=now)
+        canceled += batch
+        if batch < batch_size:
+            break
+
+    if canceled:
+        logger.info(f"Subscription period-end sweep canceled {canceled} subscriptions")
+    return canceled
+
+
+async def process_due_renewals(
+    chunk_size: int = RENEWAL_CHUNK_SIZE,
+    concurrency: int = RENEWAL_INVOICE_CONCURRENCY,
+    id_range: Optional[IdRange] = None,
+) -> int:
+    """
+    Run one renewal sweep, over the subscriptions in `id_range` if given, and
+    return the number of subscriptions renewed.
+
+    Due subscriptions are paged in keyset order so memory stays flat. Invoices
+    for a chunk are created concurrently (bounded by `concurrency`) and the
+    chunk's payments and period advances are committed in one transaction.
+    """
+    now = datetime.now()
+    semaphore = asyncio.Semaphore(concurrency)
+    after: Optional[Tuple[datetime, str]] = None
+    renewed = 0
+
+    while True:
+        chunk = await get_due_subscriptions(
+            limit=chunk_size, after=after, now=now, id_range=id_range
+        )
+        if not chunk:
+            break
+        after = (chunk[-1].next_payment_date, chunk[-1].id)
+
+        ends = period_ends(
+            [subscription.current_period_end for subscription in chunk],
+            [subscription.interval for subscription in chunk],
+            [subscription.billing_anchor for subscription in chunk],
+        )
+        results = await asyncio.gather(
+            *[
+                _invoice_renewal(subscription, period_end, semaphore)
+                for subscription, period_end in zip(chunk, ends)
+            ]
+        )
+        renewed += await apply_renewals([r for r in results if r])
+
+        if len(chunk) < chunk_size:
+            break
+
+    if renewed:
+        logger.info(f"Subscription renewal sweep renewed {renewed} subscriptions")
+    return renewed
+
+
+async def _invoice_renewal(
+    subscription: DueSubscription, period_end: datetime, semaphore: asyncio.Semaphore
+) -> Optional[Tuple[DueSubscription, str, datetime, datetime]]:
+    period_start = subscription.current_period_end
+    async with semaphore:
+        try:
+            payment = await issue_invoice(
+                wallet_id=subscription.wallet,
+                amount=subscription.amount,
+                memo=f"Subscription payment for {subscription.plan_name}",
+                extra={"tag": "subscriptions", "subscription_id": subscription.id},
+                source="renewal",
+                shed=False,
+            )
+        except Exception as e:
+            logger.error(f"Error creating renewal invoice for {subscription.id}: {e}")
+            return None
+    return subscription, payment.payment_hash, period_start, period_end
+
+
+async def run_dunning_worker():
+    """Periodically retry or cancel subscriptions with unpaid renewals."""
+    while True:
+        try:
+            with job_duration.time("dunning"):
+                handled = await run_sharded(
+                    "dunning", lambda id_range: process_dunning(id_range=id_range)
+                )
+            job_processed.inc("dunning", amount=handled)
+        except Exception as e:
+            logger.error(f"Error during subscription dunning tick: {e}")
+        await asyncio.sleep(DUNNING_INTERVAL_SECONDS)
+
+
+async def process_dunning(
+    chunk_size: int = DUNNING_CHUNK_SIZE,
+    concurrency: int = RENEWAL_INVOICE_CONCURRENCY,
+    id_range: Optional[IdRange] = None,
+) -> int:
+    """
+    Run one dunning tick, over the subscriptions in `id_range` if given, and
+    return the number of subscriptions handled.
+
+    Only the due head of the queue is read, in keyset pages. Entries with
+    schedule steps left get a fresh invoice and move to past_due; entries at
+    their last step are canceled. Each chunk is applied in one transaction.
+    An entry whose retry invoice can't be created is left for the next tick.
+    """
+    now = datetime.now()
+    semaphore = asyncio.Semaphore(concurrency)
+    after: Optional[Tuple[datetime, str]] = None
+    handled = 0
+
+    while True:
+        chunk = await get_due_dunning(
+            limit=chunk_size, after=after, now=now, id_range=id_range
+        )
+        if not chunk:
+            break
+        after = (chunk[-1].next_attempt_at, chunk[-1].subscription_id)
+
+        retries = await asyncio.gather(
+            *[_invoice_retry(entry, semaphore) for entry in chunk if not entry.is_final]
+        )
+        handled += await apply_dunning(
+            [r for r in retries if r], [entry for entry in chunk if entry.is_final]
+        )
+
+        if len(chunk) < chunk_size:
+            break
+
+    if handled:
+        logger.info(f"Subscription dunning tick handled {handled} unpaid renewals")
+    return handled
+
+
+async def _invoice_retry(
+    entry: DunningEntry, semaphore: asyncio.Semaphore
+) -> Optional[Tuple[DunningEntry, str]]:
+    async with semaphore:
+        try:
+            payment = await issue_invoice(
+                wallet_id=entry.wallet,
+                amount=entry.amount,
+                memo=f"Subscription payment for {entry.plan_name}",
+                extra={"tag": "subscriptions", "subscription_id": entry.subscription_id},
+                source="dunning",
+                shed=False,
+            )
+        except Exception as e:
+            logger.error(f"Error creating retry invoice for {entry.subscription_id}: {e}")
+            return None
+    return entry, payment.payment_hash
+
+
+async def run_expiry_worker():
+    """Periodically expire unpaid invoices and close checkouts never paid for."""
+    while True:
+        try:
+            with job_duration.time("expiry"):
+                report = await run_leased("expiry", process_expired_invoices)
+            if report:
+                job_processed.inc("expiry", amount=report["payments"])
+        except Exception as e:
+            logger.error(f"Error during expired invoice sweep: {e}")
+        await asyncio.sleep(EXPIRY_INTERVAL_SECONDS)
+
+
+async def process_expired_invoices(batch_size: int = EXPIRY_BATCH_SIZE) -> dict:
+    """
+    Run one expiry sweep in set-based batches and report what it reaped.
+
+    Pending payments older than the invoice expiry plus a grace period are
+    marked expired. Subscriptions that were opened by one of those invoices
+    and never paid for are canceled, releasing their plan slots.
+    """
+    now = datetime.now()
+    cutoff = now - timedelta(seconds=INVOICE_EXPIRY_SECONDS + EXPIRY_GRACE_SECONDS)
+    report = {"payments": 0, "subscriptions": 0, "batches": 0}
+    while True:
+        payments, subscriptions = await expire_pending_payments(
+            cutoff, limit=batch_size, now=now
+        )
+        report["payments"] += payments
+        report["subscriptions"] += subscriptions
+        report["batches"] += 1
+        if payments < batch_size:
+            break
+
+    if report["payments"]:
+        logger.info(
+            f"Expired invoice sweep expired {report['payments']} payments and canceled "
+            f"{report['subscriptions']} unpaid subscriptions in {report['batches']} batches"
+        )
+    return report
+
+
+async def run_archive_worker():
+    """Periodically move old settled payments out of the hot payments table."""
+    while True:
+        try:
+            with job_duration.time("archive"):
+                archived = await run_leased("archive", process_payment_archive)
+            job_processed.inc("archive", amount=archived or 0)
+        except Exception as e:
+            logger.error(f"Error during payment archive compaction: {e}")
+        await asyncio.sleep(ARCHIVE_INTERVAL_SECONDS)
+
+
+async def process_payment_archive(batch_size: int = ARCHIVE_BATCH_SIZE) -> int:
+    """
+    Archive every paid, failed or expired payment created before the archive
+    horizon, one batch per transaction, and return how many moved. Batches
+    are small so each transaction holds its locks briefly.
+    """
+    before = datetime.now() - timedelta(days=PAYMENT_ARCHIVE_DAYS)
+    archived = 0
+    while True:
+        batch = await archive_payments(before, limit=batch_size)
+        archived += batch
+        if batch < batch_size:
+            break
+
+    if archived:
+        logger.info(f"Payment archive compaction moved {archived} payments")
+    return archived
+
+
+async def run_stats_reconcile_worker():
+    """Recount plan stats at startup and then daily, correcting any drift."""
+    while True:
+        try:
+            with job_duration.time("stats_reconcile"):
+                drifted = await run_leased("stats_reconcile", reconcile_plan_stats)
+            job_processed.inc("stats_reconcile", amount=len(drifted or []))
+            if drifted:
+                logger.warning(f"Plan stats drifted and were recounted for plans {drifted}")
+        except Exception as e:
+            logger.error(f"Error during plan stats reconciliation: {e}")
+        await asyncio.sleep(STATS_RECONCILE_INTERVAL_SECONDS)
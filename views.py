@@ -49,7 +49,7 @@ async def public_subscribe_page(request: Request, plan_id: str):
         "subscriptions/subscribe.html", 
         {
             "request": request, 
-            "plan": plan.dict(),
+            "plan": plan.dict(exclude={"webhook_secret"}),
             "plan_id": plan_id
         }
     ) 
\ No newline at end of file
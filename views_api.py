@@ -1,45 +1,20 @@
 import asyncio
+import hmac
 import json
 from datetime import datetime, timedelta
 from http import HTTPStatus
 from typing import List, Optional
 import ipaddress
 
-from fastapi import Depends, HTTPException, Query, Request
+from fastapi import Depends, Header, HTTPException, Query, Request, Response
+from fastapi.responses import StreamingResponse
 from lnbits.core.crud import get_user, get_wallet
 from lnbits.core.models import Payment, User, Wallet
-from lnbits.core.services import create_invoice, pay_invoice
+from lnbits.core.services import pay_invoice
 from lnbits.decorators import WalletTypeInfo, get_key_type, require_admin_key
 from lnbits.helpers import template_renderer
 from loguru import logger
 
-# Simple rate limiting storage (in production, use Redis)
-_rate_limit_storage = {}
-
-def check_rate_limit(request: Request, max_requests: int = 5, window_minutes: int = 1) -> bool:
-    """Simple rate limiting implementation."""
-    client_ip = request.client.host if request.client else "unknown"
-    current_time = datetime.now()
-    window_key = f"{client_ip}:{current_time.strftime('%Y-%m-%d-%H-%M')}"
-    
-    # Clean old entries
-    keys_to_remove = []
-    for key in _rate_limit_storage:
-        key_time = datetime.strptime(key.split(':', 1)[1], '%Y-%m-%d-%H-%M')
-        if (current_time - key_time).total_seconds() > window_minutes * 60:
-            keys_to_remove.append(key)
-    
-    for key in keys_to_remove:
-        del _rate_limit_storage[key]
-    
-    # Check current rate
-    current_count = _rate_limit_storage.get(window_key, 0)
-    if current_count >= max_requests:
-        return False
-    
-    _rate_limit_storage[window_key] = current_count + 1
-    return True
-
 async def validate_plan_id(plan_id: str) -> None:
     """Validate plan ID format to prevent injection attacks."""
     if not plan_id or len(plan_id) < 5 or len(plan_id) > 50:
@@ -61,22 +36,94 @@ from .crud import (
     update_subscription_plan,
     delete_subscription_plan,
     cancel_subscription,
+    delete_subscription,
     get_subscription,
     create_subscription_payment,
     get_subscription_payments,
     update_payment_status,
     get_due_subscriptions,
+    get_payment_by_hash,
+    encode_cursor,
+    get_plan_counters,
+    get_queue_depths,
+    get_wallet_stats,
+    plan_cache,
+    wallet_stats_cache,
 )
 from .models import (
     CreateSubscriptionPlan,
     CreateSubscription,
+    PlanCounters,
     SubscriptionPlan,
     Subscription,
     SubscriptionPayment,
 )
+from .bulk import export_payments, export_subscriptions, import_subscriptions
+from .idempotency import (
+    IDEMPOTENCY_KEY_MAX_LENGTH,
+    IdempotencyConflict,
+    idempotency_store,
+    request_fingerprint,
+)
+from .invoices import InvoiceBackpressure, invoice_issuer, issue_invoice
+from .metrics import METRICS_TOKEN, cache_stats, queue_depth, registry
+from .notifications import add_payment_waiter, remove_payment_waiter
+from .rate_limit import check_rate_limit
+
+# Payment status stream tuning
+PAYMENT_STREAM_KEEPALIVE_SECONDS = 15
+PAYMENT_STREAM_RECHECK_SECONDS = 60
+PAYMENT_STREAM_MAX_SECONDS = 3600
+
+# List endpoint page sizes
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+
+async def run_idempotent(
+    response: Response, idempotency_key: Optional[str], scope: str, data, operation
+):
+    """
+    Run `operation` at most once per Idempotency-Key within `scope`, replaying
+    the first result (marked with an Idempotent-Replayed header) on retries.
+    """
+    if not idempotency_key:
+        return await operation()
+    if len(idempotency_key) > IDEMPOTENCY_KEY_MAX_LENGTH:
+        raise HTTPException(
+            status_code=HTTPStatus.BAD_REQUEST, detail="Idempotency-Key is too long"
+        )
+    try:
+        result, replayed = await idempotency_store.run(
+            f"{scope}:{idempotency_key}",
+            request_fingerprint(scope, data.dict()),
+            operation,
+        )
+    except IdempotencyConflict:
+        raise HTTPException(
+            status_code=HTTPStatus.UNPROCESSABLE_ENTITY,
+            detail="Idempotency-Key was already used with a different request",
+        )
+    if replayed:
+        response.headers["Idempotent-Replayed"] = "true"
+    return result
+
+
+def set_next_cursor(response: Response, rows: list, limit: int) -> None:
+    """Expose the keyset cursor of the next page, if any, as X-Next-Cursor."""
+    if len(rows) == limit:
+        response.headers["X-Next-Cursor"] = encode_cursor(rows[-1].created_at, rows[-1].id)
+
+
+def _with_stats(plan: SubscriptionPlan, counters: Optional[PlanCounters]) -> dict:
+    """Serialize a plan with its incrementally maintained counters."""
+    data = plan.dict(exclude={"webhook_secret"})
+    data["stats"] = counters.dict(exclude={"plan_id"}) if counters else None
+    return data
 
 
 # Subscription Plans API
+# The webhook signing secret is only returned to admin-key routes
 @subscriptions_ext.post("/api/v1/plans")
 async def api_create_plan(
     data: CreateSubscriptionPlan, wallet: WalletTypeInfo = Depends(require_admin_key)
@@ -100,7 +147,8 @@ async def api_get_plans(
     """Get all subscription plans for a wallet."""
     try:
         plans = await get_subscription_plans(wallet.wallet.id)
-        return [plan.dict() for plan in plans]
+        counters = await get_plan_counters([plan.id for plan in plans])
+        return [_with_stats(plan, counters.get(plan.id)) for plan in plans]
     except Exception as e:
         logger.error(f"Error fetching subscription plans: {e}")
         raise HTTPException(
@@ -125,7 +173,27 @@ async def api_get_plan(
             status_code=HTTPStatus.FORBIDDEN, detail="Access denied"
         )
     
-    return plan.dict()
+    counters = await get_plan_counters([plan.id])
+    return _with_stats(plan, counters.get(plan.id))
+
+
+@subscriptions_ext.get("/api/v1/plans/{plan_id}/webhook-secret")
+async def api_get_plan_webhook_secret(
+    plan_id: str, wallet: WalletTypeInfo = Depends(require_admin_key)
+):
+    """Get the secret that signs a plan's webhooks."""
+    plan = await get_subscription_plan(plan_id)
+    if not plan:
+        raise HTTPException(
+            status_code=HTTPStatus.NOT_FOUND, detail="Plan not found"
+        )
+    
+    if plan.wallet != wallet.wallet.id:
+        raise HTTPException(
+            status_code=HTTPStatus.FORBIDDEN, detail="Access denied"
+        )
+    
+    return {"webhook_secret": plan.webhook_secret}
 
 
 @subscriptions_ext.put("/api/v1/plans/{plan_id}")
@@ -173,36 +241,90 @@ async def api_delete_plan(
             status_code=HTTPStatus.FORBIDDEN, detail="Access denied"
         )
     
-    # Check if there are active subscriptions
-    subscriptions = await get_subscriptions_by_plan(plan_id)
-    active_subs = [s for s in subscriptions if s.status in ["active", "trialing", "past_due"]]
+    # The cached plan's counter can be stale, so the delete itself checks it
+    try:
+        deleted = await delete_subscription_plan(plan_id)
+    except Exception as e:
+        logger.error(f"Error deleting subscription plan: {e}")
+        raise HTTPException(
+            status_code=HTTPStatus.INTERNAL_SERVER_ERROR,
+            detail="Could not delete subscription plan"
+        )
     
-    if active_subs:
+    if not deleted:
+        plan_cache.invalidate(plan_id)
+        plan = await get_subscription_plan(plan_id)
+        live = plan.active_subscriptions if plan else 0
         raise HTTPException(
             status_code=HTTPStatus.BAD_REQUEST,
-            detail=f"Cannot delete plan with {len(active_subs)} active subscriptions"
+            detail=f"Cannot delete plan with {live} active subscriptions"
         )
-    
+    return {"message": "Plan deleted successfully"}
+
+
+@subscriptions_ext.get("/api/v1/stats")
+async def api_get_stats(wallet: WalletTypeInfo = Depends(get_key_type)):
+    """Get aggregated dashboard statistics for a wallet."""
     try:
-        await delete_subscription_plan(plan_id)
-        return {"message": "Plan deleted successfully"}
+        stats = await get_wallet_stats(wallet.wallet.id)
+        return stats.dict()
     except Exception as e:
-        logger.error(f"Error deleting subscription plan: {e}")
+        logger.error(f"Error fetching subscription stats: {e}")
         raise HTTPException(
             status_code=HTTPStatus.INTERNAL_SERVER_ERROR,
-            detail="Could not delete subscription plan"
+            detail="Could not fetch subscription stats"
         )
 
 
+@registry.collector
+async def collect_extension_metrics() -> None:
+    for queue, depth in (await get_queue_depths()).items():
+        queue_depth.set(queue, value=depth)
+    queue_depth.set("invoices_waiting", value=invoice_issuer.waiting)
+    queue_depth.set("invoices_in_flight", value=invoice_issuer.active)
+    caches = {
+        "plans": plan_cache.stats(),
+        "wallet_stats": wallet_stats_cache.stats(),
+        "idempotency": idempotency_store.stats(),
+    }
+    for cache, stats in caches.items():
+        for stat, value in stats.items():
+            cache_stats.set(cache, stat, value=value)
+
+
+@subscriptions_ext.get("/api/v1/metrics")
+async def api_metrics(authorization: Optional[str] = Header(None)):
+    """Prometheus metrics for this LNbits process, behind SUBSCRIPTIONS_METRICS_TOKEN."""
+    if not METRICS_TOKEN:
+        raise HTTPException(status_code=HTTPStatus.NOT_FOUND, detail="Metrics are disabled")
+    if not authorization or not hmac.compare_digest(
+        authorization.encode(), f"Bearer {METRICS_TOKEN}".encode()
+    ):
+        raise HTTPException(status_code=HTTPStatus.UNAUTHORIZED, detail="Invalid metrics token")
+    return Response(
+        content=await registry.render(), media_type="text/plain; version=0.0.4"
+    )
+
+
 # Subscriptions API
 @subscriptions_ext.post("/api/v1/subscriptions")
 async def api_create_subscription(
-    data: CreateSubscription, wallet: WalletTypeInfo = Depends(require_admin_key)
+    response: Response,
+    data: CreateSubscription,
+    wallet: WalletTypeInfo = Depends(require_admin_key),
+    idempotency_key: Optional[str] = Header(None),
 ):
     """Create a new subscription."""
-    try:
+    async def create():
         subscription = await create_subscription(data.plan_id, wallet.wallet.id, data)
         return subscription.dict()
+
+    try:
+        return await run_idempotent(
+            response, idempotency_key, f"subscriptions:{wallet.wallet.id}", data, create
+        )
+    except HTTPException:
+        raise
     except ValueError as e:
         raise HTTPException(status_code=HTTPStatus.BAD_REQUEST, detail=str(e))
     except Exception as e:
@@ -215,12 +337,30 @@ async def api_create_subscription(
 
 @subscriptions_ext.get("/api/v1/subscriptions")
 async def api_get_subscriptions(
+    response: Response,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = Query(None, max_length=200),
+    status: Optional[str] = Query(None, max_length=20),
+    plan_id: Optional[str] = Query(None, max_length=50),
+    created_after: Optional[datetime] = Query(None),
+    created_before: Optional[datetime] = Query(None),
     wallet: WalletTypeInfo = Depends(get_key_type)
 ) -> List[dict]:
-    """Get all subscriptions for a wallet."""
+    """Get one page of subscriptions for a wallet, newest first."""
     try:
-        subscriptions = await get_subscriptions(wallet.wallet.id)
+        subscriptions = await get_subscriptions(
+            wallet.wallet.id,
+            limit=limit,
+            cursor=cursor,
+            status=status,
+            plan_id=plan_id,
+            created_after=created_after,
+            created_before=created_before,
+        )
+        set_next_cursor(response, subscriptions, limit)
         return [sub.dict() for sub in subscriptions]
+    except ValueError as e:
+        raise HTTPException(status_code=HTTPStatus.BAD_REQUEST, detail=str(e))
     except Exception as e:
         logger.error(f"Error fetching subscriptions: {e}")
         raise HTTPException(
@@ -229,6 +369,47 @@ async def api_get_subscriptions(
         )
 
 
+@subscriptions_ext.post("/api/v1/subscriptions/import")
+async def api_import_subscriptions(
+    request: Request,
+    format: Optional[str] = Query(None, regex="^(ndjson|csv)$"),
+    wallet: WalletTypeInfo = Depends(require_admin_key)
+):
+    """Bulk-create subscriptions from a streamed NDJSON or CSV request body."""
+    if not format:
+        content_type = request.headers.get("content-type", "")
+        format = "csv" if content_type.startswith("text/csv") else "ndjson"
+    
+    try:
+        return await import_subscriptions(wallet.wallet.id, request.stream(), format)
+    except ValueError as e:
+        raise HTTPException(status_code=HTTPStatus.BAD_REQUEST, detail=str(e))
+    except Exception as e:
+        logger.error(f"Error importing subscriptions: {e}")
+        raise HTTPException(
+            status_code=HTTPStatus.INTERNAL_SERVER_ERROR,
+            detail="Could not import subscriptions"
+        )
+
+
+@subscriptions_ext.get("/api/v1/subscriptions/export")
+async def api_export_subscriptions(
+    format: str = Query("ndjson", regex="^(ndjson|csv)$"),
+    status: Optional[str] = Query(None, max_length=20),
+    plan_id: Optional[str] = Query(None, max_length=50),
+    wallet: WalletTypeInfo = Depends(get_key_type)
+):
+    """Stream every subscription of a wallet as NDJSON or CSV."""
+    media_type = "text/csv" if format == "csv" else "application/x-ndjson"
+    return StreamingResponse(
+        export_subscriptions(wallet.wallet.id, format, status=status, plan_id=plan_id),
+        media_type=media_type,
+        headers={
+            "Content-Disposition": f'attachment; filename="subscriptions.{format}"'
+        },
+    )
+
+
 @subscriptions_ext.get("/api/v1/subscriptions/{subscription_id}")
 async def api_get_subscription(
     subscription_id: str, wallet: WalletTypeInfo = Depends(get_key_type)
@@ -277,11 +458,45 @@ async def api_cancel_subscription(
         )
 
 
+@subscriptions_ext.delete("/api/v1/subscriptions/{subscription_id}")
+async def api_delete_subscription(
+    subscription_id: str, wallet: WalletTypeInfo = Depends(require_admin_key)
+):
+    """Delete a subscription and its payment history."""
+    subscription = await get_subscription(subscription_id)
+    if not subscription:
+        raise HTTPException(
+            status_code=HTTPStatus.NOT_FOUND, detail="Subscription not found"
+        )
+    
+    if subscription.wallet != wallet.wallet.id:
+        raise HTTPException(
+            status_code=HTTPStatus.FORBIDDEN, detail="Access denied"
+        )
+    
+    try:
+        await delete_subscription(subscription_id)
+        return {"message": "Subscription deleted successfully"}
+    except Exception as e:
+        logger.error(f"Error deleting subscription: {e}")
+        raise HTTPException(
+            status_code=HTTPStatus.INTERNAL_SERVER_ERROR,
+            detail="Could not delete subscription"
+        )
+
+
 @subscriptions_ext.get("/api/v1/plans/{plan_id}/subscriptions")
 async def api_get_plan_subscriptions(
-    plan_id: str, wallet: WalletTypeInfo = Depends(get_key_type)
+    plan_id: str,
+    response: Response,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = Query(None, max_length=200),
+    status: Optional[str] = Query(None, max_length=20),
+    created_after: Optional[datetime] = Query(None),
+    created_before: Optional[datetime] = Query(None),
+    wallet: WalletTypeInfo = Depends(get_key_type)
 ) -> List[dict]:
-    """Get all subscriptions for a specific plan."""
+    """Get one page of subscriptions for a specific plan, newest first."""
     plan = await get_subscription_plan(plan_id)
     if not plan:
         raise HTTPException(
@@ -294,8 +509,18 @@ async def api_get_plan_subscriptions(
         )
     
     try:
-        subscriptions = await get_subscriptions_by_plan(plan_id)
+        subscriptions = await get_subscriptions_by_plan(
+            plan_id,
+            limit=limit,
+            cursor=cursor,
+            status=status,
+            created_after=created_after,
+            created_before=created_before,
+        )
+        set_next_cursor(response, subscriptions, limit)
         return [sub.dict() for sub in subscriptions]
+    except ValueError as e:
+        raise HTTPException(status_code=HTTPStatus.BAD_REQUEST, detail=str(e))
     except Exception as e:
         logger.error(f"Error fetching plan subscriptions: {e}")
         raise HTTPException(
@@ -307,9 +532,20 @@ async def api_get_plan_subscriptions(
 # Payments API
 @subscriptions_ext.get("/api/v1/subscriptions/{subscription_id}/payments")
 async def api_get_subscription_payments(
-    subscription_id: str, wallet: WalletTypeInfo = Depends(get_key_type)
+    subscription_id: str,
+    response: Response,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = Query(None, max_length=200),
+    status: Optional[str] = Query(None, max_length=20),
+    created_after: Optional[datetime] = Query(None),
+    created_before: Optional[datetime] = Query(None),
+    include_archived: bool = Query(False),
+    wallet: WalletTypeInfo = Depends(get_key_type)
 ) -> List[dict]:
-    """Get all payments for a subscription."""
+    """
+    Get one page of payments for a subscription, newest first. Payments moved
+    to the archive are only included with include_archived.
+    """
     subscription = await get_subscription(subscription_id)
     if not subscription:
         raise HTTPException(
@@ -322,8 +558,19 @@ async def api_get_subscription_payments(
         )
     
     try:
-        payments = await get_subscription_payments(subscription_id)
+        payments = await get_subscription_payments(
+            subscription_id,
+            limit=limit,
+            cursor=cursor,
+            status=status,
+            created_after=created_after,
+            created_before=created_before,
+            include_archive=include_archived,
+        )
+        set_next_cursor(response, payments, limit)
         return [payment.dict() for payment in payments]
+    except ValueError as e:
+        raise HTTPException(status_code=HTTPStatus.BAD_REQUEST, detail=str(e))
     except Exception as e:
         logger.error(f"Error fetching subscription payments: {e}")
         raise HTTPException(
@@ -332,12 +579,63 @@ async def api_get_subscription_payments(
         )
 
 
+@subscriptions_ext.get("/api/v1/payments/export")
+async def api_export_payments(
+    format: str = Query("ndjson", regex="^(ndjson|csv)$"),
+    status: Optional[str] = Query(None, max_length=20),
+    created_after: Optional[datetime] = Query(None),
+    created_before: Optional[datetime] = Query(None),
+    after_created_at: Optional[datetime] = Query(None),
+    after_id: Optional[str] = Query(None, max_length=50),
+    include_archived: bool = Query(False),
+    wallet: WalletTypeInfo = Depends(get_key_type)
+):
+    """
+    Stream the payment ledger of a wallet, oldest first, as NDJSON or CSV.
+    Resume an interrupted export with the created_at and id of the last row.
+    Archived payments are only included with include_archived.
+    """
+    if (after_created_at is None) != (after_id is None):
+        raise HTTPException(
+            status_code=HTTPStatus.BAD_REQUEST,
+            detail="after_created_at and after_id must be given together"
+        )
+    
+    after = (after_created_at, after_id) if after_id else None
+    media_type = "text/csv" if format == "csv" else "application/x-ndjson"
+    return StreamingResponse(
+        export_payments(
+            wallet.wallet.id,
+            format,
+            status=status,
+            created_after=created_after,
+            created_before=created_before,
+            after=after,
+            include_archive=include_archived,
+        ),
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="payments.{format}"'},
+    )
+
+
 # Public API for subscription creation (without auth)
 @subscriptions_ext.post("/api/v1/public/subscribe/{plan_id}")
-async def api_public_subscribe(request: Request, plan_id: str, data: CreateSubscription):
-    """Public endpoint for creating subscriptions."""
+async def api_public_subscribe(
+    request: Request,
+    response: Response,
+    plan_id: str,
+    data: CreateSubscription,
+    idempotency_key: Optional[str] = Header(None),
+):
+    """
+    Public endpoint for creating subscriptions.
+
+    Clients may send an Idempotency-Key header; retries with the same key and
+    body return the first response without creating another subscription or
+    invoice.
+    """
     # Rate limiting
-    if not check_rate_limit(request, max_requests=5, window_minutes=1):
+    if not await check_rate_limit(request, "public_subscribe"):
         raise HTTPException(
             status_code=HTTPStatus.TOO_MANY_REQUESTS,
             detail="Rate limit exceeded. Please try again later."
@@ -345,7 +643,25 @@ async def api_public_subscribe(request: Request, plan_id: str, data: CreateSubsc
     
     # Validate plan ID format
     await validate_plan_id(plan_id)
-    
+
+    return await run_idempotent(
+        response,
+        idempotency_key,
+        f"public_subscribe:{plan_id}",
+        data,
+        lambda: _public_subscribe(plan_id, data),
+    )
+
+
+def invoice_queue_full(retry_after: int) -> HTTPException:
+    return HTTPException(
+        status_code=HTTPStatus.TOO_MANY_REQUESTS,
+        detail="Payment node is busy. Please try again shortly.",
+        headers={"Retry-After": str(retry_after)},
+    )
+
+
+async def _public_subscribe(plan_id: str, data: CreateSubscription) -> dict:
     plan = await get_subscription_plan(plan_id)
     if not plan:
         raise HTTPException(
@@ -359,25 +675,40 @@ async def api_public_subscribe(request: Request, plan_id: str, data: CreateSubsc
             detail="Plan has reached maximum number of subscriptions"
         )
     
+    # Shed load before reserving a plan slot if the node is already saturated
+    if plan.trial_days == 0 and invoice_issuer.saturated:
+        raise invoice_queue_full(invoice_issuer.retry_after())
+    
     try:
-        subscription = await create_subscription(plan_id, plan.wallet, data)
+        subscription = await create_subscription(
+            plan_id, plan.wallet, data, first_period_invoiced=plan.trial_days == 0
+        )
         
         # Create initial payment if not in trial
         if plan.trial_days == 0:
-            payment_request = await create_invoice(
-                wallet_id=plan.wallet,
-                amount=plan.amount,
-                memo=f"Subscription payment for {plan.name}",
-                extra={"tag": "subscriptions", "subscription_id": subscription.id}
-            )
-            
-            await create_subscription_payment(
-                subscription.id,
-                payment_request.payment_hash,
-                plan.amount,
-                subscription.current_period_start,
-                subscription.current_period_end
-            )
+            # A subscription without its first invoice would hold a slot for
+            # free, so any failure here removes it again; webhooks get a
+            # subscription.deleted after the subscription.created
+            try:
+                payment_request = await issue_invoice(
+                    wallet_id=plan.wallet,
+                    amount=plan.amount,
+                    memo=f"Subscription payment for {plan.name}",
+                    extra={"tag": "subscriptions", "subscription_id": subscription.id},
+                    source="subscribe",
+                )
+                await create_subscription_payment(
+                    subscription.id,
+                    payment_request.payment_hash,
+                    plan.amount,
+                    subscription.current_period_start,
+                    subscription.current_period_end
+                )
+            except Exception as e:
+                await delete_subscription(subscription.id)
+                if isinstance(e, InvoiceBackpressure):
+                    raise invoice_queue_full(e.retry_after)
+                raise
             
             return {
                 "subscription": subscription.dict(),
@@ -391,6 +722,10 @@ async def api_public_subscribe(request: Request, plan_id: str, data: CreateSubsc
             "message": f"Trial period of {plan.trial_days} days activated"
         }
         
+    except HTTPException:
+        raise
+    except ValueError as e:
+        raise HTTPException(status_code=HTTPStatus.BAD_REQUEST, detail=str(e))
     except Exception as e:
         logger.error(f"Error creating public subscription: {e}")
         raise HTTPException(
@@ -400,8 +735,13 @@ async def api_public_subscribe(request: Request, plan_id: str, data: CreateSubsc
 
 
 @subscriptions_ext.get("/api/v1/public/plans/{plan_id}")
-async def api_public_get_plan(plan_id: str):
+async def api_public_get_plan(request: Request, plan_id: str):
     """Public endpoint to get plan details."""
+    if not await check_rate_limit(request, "public_read"):
+        raise HTTPException(
+            status_code=HTTPStatus.TOO_MANY_REQUESTS,
+            detail="Rate limit exceeded. Please try again later."
+        )
     plan = await get_subscription_plan(plan_id)
     if not plan:
         raise HTTPException(
@@ -420,4 +760,83 @@ async def api_public_get_plan(plan_id: str):
             plan.max_subscriptions - plan.active_subscriptions
             if plan.max_subscriptions else None
         )
-    } 
\ No newline at end of file
+    } 
+
+
+def validate_payment_hash(payment_hash: str) -> None:
+    """Validate payment hash format (32 bytes, hex encoded)."""
+    import re
+    if not re.match(r'^[a-fA-F0-9]{64}$', payment_hash):
+        raise HTTPException(status_code=HTTPStatus.BAD_REQUEST, detail="Invalid payment hash format")
+
+
+@subscriptions_ext.get("/api/v1/public/payment-status/{payment_hash}")
+async def api_public_payment_status(request: Request, payment_hash: str):
+    """Public endpoint to check whether a subscription invoice was paid."""
+    if not await check_rate_limit(request, "public_read"):
+        raise HTTPException(
+            status_code=HTTPStatus.TOO_MANY_REQUESTS,
+            detail="Rate limit exceeded. Please try again later."
+        )
+    validate_payment_hash(payment_hash)
+    payment = await get_payment_by_hash(payment_hash)
+    if not payment:
+        raise HTTPException(
+            status_code=HTTPStatus.NOT_FOUND, detail="Payment not found"
+        )
+    
+    return {"status": payment.status, "paid": payment.status == "paid"}
+
+
+@subscriptions_ext.get("/api/v1/public/payment-status/{payment_hash}/stream")
+async def api_public_payment_status_stream(request: Request, payment_hash: str):
+    """Server-sent events stream that pushes once the invoice is paid."""
+    if not await check_rate_limit(request, "public_read"):
+        raise HTTPException(
+            status_code=HTTPStatus.TOO_MANY_REQUESTS,
+            detail="Rate limit exceeded. Please try again later."
+        )
+    validate_payment_hash(payment_hash)
+    # Wait before reading, so a settlement in between is not missed
+    queue = add_payment_waiter(payment_hash)
+    try:
+        payment = await get_payment_by_hash(payment_hash)
+    except Exception:
+        remove_payment_waiter(payment_hash, queue)
+        raise
+    if not payment:
+        remove_payment_waiter(payment_hash, queue)
+        raise HTTPException(
+            status_code=HTTPStatus.NOT_FOUND, detail="Payment not found"
+        )
+    
+    async def event_stream():
+        try:
+            waited = 0
+            status = payment.status
+            while status != "paid" and waited < PAYMENT_STREAM_MAX_SECONDS:
+                try:
+                    status = await asyncio.wait_for(
+                        queue.get(), timeout=PAYMENT_STREAM_KEEPALIVE_SECONDS
+                    )
+                    break
+                except asyncio.TimeoutError:
+                    pass
+                waited += PAYMENT_STREAM_KEEPALIVE_SECONDS
+                if await request.is_disconnected():
+                    return
+                # Settlements handled by another worker process never reach
+                # this queue, so fall back to an occasional database read
+                if waited % PAYMENT_STREAM_RECHECK_SECONDS == 0:
+                    current = await get_payment_by_hash(payment_hash)
+                    status = current.status if current else status
+                yield ": keepalive\n\n"
+            yield f"data: {json.dumps({'status': status, 'paid': status == 'paid'})}\n\n"
+        finally:
+            remove_payment_waiter(payment_hash, queue)
+    
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
@@ -0,0 +1,174 @@
+"""Outbox-driven delivery of subscription lifecycle webhooks."""
+
+import asyncio
+import hashlib
+import hmac
+import os
+import random
+import time
+from collections import defaultdict
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Tuple
+
+import httpx
+from loguru import logger
+
+from .crud import (
+    claim_due_webhooks,
+    get_subscription_plan,
+    purge_delivered_webhooks,
+    record_webhook_results,
+)
+from .metrics import job_duration, job_processed
+from .models import WebhookEvent
+from .scheduler import run_leased
+
+# Delivery tuning
+WEBHOOK_POLL_SECONDS = 2
+WEBHOOK_CLAIM_SIZE = 500
+WEBHOOK_LEASE_SECONDS = 120
+WEBHOOK_TIMEOUT_SECONDS = 10
+WEBHOOK_MAX_CONCURRENCY = 100
+WEBHOOK_ENDPOINT_CONCURRENCY = 4
+WEBHOOK_MAX_ATTEMPTS = 10
+WEBHOOK_BACKOFF_BASE_SECONDS = 30
+WEBHOOK_BACKOFF_MAX_SECONDS = 6 * 3600
+WEBHOOK_RETENTION_DAYS = 7
+# Events per POST; above 1 the body is {"events": [...]}
+WEBHOOK_BATCH_SIZE = int(os.getenv("SUBSCRIPTIONS_WEBHOOK_BATCH_SIZE", "1"))
+
+_http_client: Optional[httpx.AsyncClient] = None
+
+
+def get_http_client() -> httpx.AsyncClient:
+    """Shared pooled client so deliveries reuse connections per endpoint."""
+    global _http_client
+    if _http_client is None or _http_client.is_closed:
+        _http_client = httpx.AsyncClient(
+            timeout=WEBHOOK_TIMEOUT_SECONDS,
+            limits=httpx.Limits(
+                max_connections=WEBHOOK_MAX_CONCURRENCY,
+                max_keepalive_connections=WEBHOOK_MAX_CONCURRENCY,
+            ),
+            follow_redirects=False,
+        )
+    return _http_client
+
+
+def sign_payload(secret: str, body: bytes, timestamp: int) -> str:
+    """Signature header value: HMAC-SHA256 over "<timestamp>.<body>"."""
+    digest = hmac.new(
+        secret.encode(), f"{timestamp}.".encode() + body, hashlib.sha256
+    ).hexdigest()
+    return f"t={timestamp},v1={digest}"
+
+
+def backoff_delay(attempts: int) -> float:
+    """Exponential backoff with jitter for the given number of failed attempts."""
+    delay = min(WEBHOOK_BACKOFF_BASE_SECONDS * 2 ** (attempts - 1), WEBHOOK_BACKOFF_MAX_SECONDS)
+    return delay * random.uniform(0.8, 1.2)
+
+
+async def run_webhook_worker():
+    """
+    Drain the webhook outbox, polling while it is empty. Claiming is not
+    atomic across processes, so only the worker holding the lease delivers.
+    """
+    last_purge = 0.0
+    while True:
+        claimed = 0
+        try:
+            with job_duration.time("webhooks"):
+                claimed = await run_leased("webhooks", deliver_due_webhooks) or 0
+            job_processed.inc("webhooks", amount=claimed)
+            if time.monotonic() - last_purge > 3600:
+                await run_leased(
+                    "webhook_purge",
+                    lambda: purge_delivered_webhooks(
+                        datetime.now() - timedelta(days=WEBHOOK_RETENTION_DAYS)
+                    ),
+                )
+                last_purge = time.monotonic()
+        except Exception as e:
+            logger.error(f"Error delivering subscription webhooks: {e}")
+        # Keep going without pause while there is a backlog
+        if claimed < WEBHOOK_CLAIM_SIZE:
+            await asyncio.sleep(WEBHOOK_POLL_SECONDS)
+
+
+async def deliver_due_webhooks() -> int:
+    """
+    Claim one batch of due events, deliver them and record the outcomes.
+    Returns the number of events claimed.
+
+    Delivery is at-least-once: receivers should dedupe on the event id.
+    """
+    events = await claim_due_webhooks(WEBHOOK_CLAIM_SIZE, WEBHOOK_LEASE_SECONDS)
+    if not events:
+        return 0
+
+    grouped: Dict[Tuple[str, str], List[WebhookEvent]] = defaultdict(list)
+    for event in events:
+        grouped[(event.plan_id, event.url)].append(event)
+
+    limit = asyncio.Semaphore(WEBHOOK_MAX_CONCURRENCY)
+    endpoints: Dict[str, asyncio.Semaphore] = defaultdict(
+        lambda: asyncio.Semaphore(WEBHOOK_ENDPOINT_CONCURRENCY)
+    )
+    posts = []
+    for (plan_id, url), group in grouped.items():
+        for i in range(0, len(group), max(1, WEBHOOK_BATCH_SIZE)):
+            chunk = group[i : i + max(1, WEBHOOK_BATCH_SIZE)]
+            posts.append(_deliver(plan_id, url, chunk, limit, endpoints[url]))
+    outcomes = await asyncio.gather(*posts)
+
+    delivered: List[str] = []
+    retries: List[Tuple[str, int, Optional[datetime], str]] = []
+    now = datetime.now()
+    for chunk, error in outcomes:
+        for event in chunk:
+            if error is None:
+                delivered.append(event.id)
+                continue
+            attempts = event.attempts + 1
+            next_attempt_at = (
+                now + timedelta(seconds=backoff_delay(attempts))
+                if attempts < WEBHOOK_MAX_ATTEMPTS
+                else None
+            )
+            retries.append((event.id, attempts, next_attempt_at, error))
+
+    await record_webhook_results(delivered, retries)
+    return len(events)
+
+
+async def _deliver(
+    plan_id: str,
+    url: str,
+    chunk: List[WebhookEvent],
+    limit: asyncio.Semaphore,
+    endpoint_limit: asyncio.Semaphore,
+) -> Tuple[List[WebhookEvent], Optional[str]]:
+    plan = await get_subscription_plan(plan_id)
+    if not plan or not plan.webhook_secret:
+        return chunk, "Plan no longer exists"
+
+    if len(chunk) == 1:
+        body = chunk[0].payload.encode()
+    else:
+        body = ('{"events": [' + ", ".join(event.payload for event in chunk) + "]}").encode()
+    headers = {
+        "Content-Type": "application/json",
+        "User-Agent": "LNbits-Subscriptions-Webhook",
+        "X-Subscriptions-Event": chunk[0].event if len(chunk) == 1 else "batch",
+        "X-Subscriptions-Signature": sign_payload(plan.webhook_secret, body, int(time.time())),
+    }
+
+    async with endpoint_limit, limit:
+        try:
+            response = await get_http_client().post(url, content=body, headers=headers)
+        except httpx.HTTPError as e:
+            return chunk, f"{type(e).__name__}: {e}"
+    if response.is_success:
+        return chunk, None
+    return chunk, f"HTTP {response.status_code}"